@@ -10,20 +10,769 @@ this mail to all subscribers using SMTP.
 """
 
 import argparse
+import asyncio
+import base64
+import collections
 import configparser
+import copy
+import cProfile
+import functools
+import hashlib
+import hmac
+import http.server
+import imaplib
+import io
 import json
 import smtplib
+import socket
+import sqlite3
+import string
+import struct
 import logging
+import mmap
+import multiprocessing
 import os
+import re
+import signal
+import ssl
 import sys
+import tempfile
+import threading
+import time
+import uuid
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os.path import exists
-from time import sleep
+from time import sleep, monotonic
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
-from imap_tools import MailBox, AND, MailMessageFlags
-from dotenv import load_dotenv
+from email import encoders, message_from_bytes, quoprimime
+from email.generator import BytesGenerator
+from email.header import decode_header, make_header
+from email.message import Message as EmailMessage
+from email.parser import BytesHeaderParser
+from imap_tools import MailBox, MailBoxUnencrypted, MailMessage, AND, U, MailMessageFlags
+from dotenv import dotenv_values
+
+# Errors which indicate a lost IMAP connection.
+IMAP_CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError)
+
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes.
+IDLE_MAX_TIMEOUT = 29 * 60
+
+# Interval for NOOP polling on servers without IDLE support.
+NOOP_POLL_INTERVAL = 5
+
+# Chunk size for reading and streaming spooled messages.
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+# UID of a FETCH response.
+FETCH_UID_PATTERN = re.compile(rb'\bUID (\d+)')
+
+# Placeholders available in the footer snippets.
+FOOTER_FIELDS = ('list_name', 'tags', 'address')
+
+# Per-receiver placeholders available in the footer snippets, if personalized.
+PERSONAL_FIELDS = ('receiver', 'token', 'unsubscribe_url')
+
+# Placeholders available in the personalized unsubscribe URL.
+UNSUBSCRIBE_URL_FIELDS = ('receiver', 'token')
+
+# Placeholders available in the subscribe and unsubscribe snippets.
+WELCOME_FIELDS = ('list_name',)
+
+# Number of rendered footers kept, one per unsubscribe tag scope.
+FOOTER_CACHE_SIZE = 256
+
+# Record of the DedupeStore file: BLAKE2 digest of the key, and time seen.
+DEDUPE_RECORD = struct.Struct('<16sI')
+
+
+def write_file_atomic(path: str, data):
+    """
+    Write the file using a temporary file and rename.
+
+    Data is bytes or an iterable of byte chunks. Readers see either
+    the old or the new content, also if the process crashes while
+    writing.
+    """
+    if isinstance(data, bytes):
+        data = [data]
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        for chunk in data:
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+def unsubscribe_token(secret: str, address: str) -> str:
+    """
+    Get the token which authorizes unsubscribing the given address.
+    """
+    return hmac.new(secret.encode('utf-8'), address.lower().encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def smtp_executor(config: 'Config') -> ThreadPoolExecutor:
+    """
+    Create the worker pool for sending batches and personalized messages.
+    """
+    return ThreadPoolExecutor(max_workers=min(config.smtp_workers, config.smtp_pool_size),
+                              thread_name_prefix='smtp')
+
+
+def open_mailbox(config: 'Config') -> MailBox:
+    """
+    Create a mailbox for the configured server, using SSL or not.
+    """
+    if config.mailbox_ssl:
+        return MailBox(config.mailbox_server, port=config.mailbox_port)
+    return MailBoxUnencrypted(config.mailbox_server, port=config.mailbox_port)
+
+
+def smtp_data_chunks(chunks):
+    """
+    Convert message chunks into SMTP DATA chunks, with CRLF line
+    endings, dot-stuffing and the final dot line.
+    """
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        yield b''.join(_smtp_data_line(line) for line in lines)
+    if tail:
+        yield _smtp_data_line(tail)
+    yield b'.\r\n'
+
+
+def _smtp_data_line(line: bytes) -> bytes:
+    """
+    Convert one line of the message into a DATA line.
+    """
+    line = line.rstrip(b'\r')
+    if line.startswith(b'.'):
+        line = b'.' + line
+    return line + b'\r\n'
+
+
+def fetch_literals(data: list) -> dict:
+    """
+    Get the literals of FETCH responses, in the format of imaplib, by UID.
+    """
+    literals = {}
+    for item in data:
+        if isinstance(item, tuple):
+            match = FETCH_UID_PATTERN.search(item[0])
+            if match is not None:
+                literals[match.group(1).decode()] = item[1]
+    return literals
+
+
+def fetch_batches(msgs: list, limit: int) -> list[list]:
+    """
+    Group header only messages into batches for fetching the full messages.
+
+    The messages of a batch have at most limit bytes in total. Larger
+    messages get an own batch, and are fetched in chunks.
+    """
+    batches = []
+    batch = []
+    size = 0
+    for msg in msgs:
+        if msg.size_rfc822 > limit:
+            batches.append([msg])
+            continue
+        if size + msg.size_rfc822 > limit and len(batch) > 0:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(msg)
+        size += msg.size_rfc822
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def decode_text(part: EmailMessage) -> str:
+    """
+    Decode the payload of a text part.
+    """
+    charset = part.get_content_charset() or 'us-ascii'
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+class Metrics:
+    """
+    Metrics collects stage timings, counters and gauges.
+
+    Stage timings are histograms with fixed buckets, in seconds.
+    Gauges are set directly, or read from callbacks when the metrics
+    are exported. All methods are thread-safe.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+        self._callbacks = {}
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Record the duration of one stage run.
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = {
+                    'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Record the duration of the with block.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, monotonic() - start)
+
+    def inc(self, name: str, value: int = 1):
+        """
+        Increase a counter.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Set a gauge.
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def register(self, key, name: str, callback):
+        """
+        Register a callback for gauges, which returns a list of
+        (labels, value) tuples. A callback with the same key replaces
+        the previous one.
+        """
+        with self._lock:
+            self._callbacks[key] = (name, callback)
+
+    def _read_gauges(self) -> dict:
+        """
+        Get all gauges, including the callback gauges.
+        """
+        with self._lock:
+            gauges = dict(self._gauges)
+            callbacks = list(self._callbacks.values())
+        for name, callback in callbacks:
+            try:
+                for labels, value in callback():
+                    gauges[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:  # pylint: disable=broad-except
+                logging.debug('metrics callback %s failed: %s', name, e)
+        return gauges
+
+    def snapshot(self) -> dict:
+        """
+        Get all metrics as JSON serializable dict.
+        """
+        gauges = self._read_gauges()
+        with self._lock:
+            return {'time': time.time(),
+                    'stages': {stage: {'buckets': dict(zip(self.buckets, histogram['buckets'])),
+                                       'count': histogram['count'],
+                                       'sum': histogram['sum']}
+                               for stage, histogram in self._stages.items()},
+                    'counters': dict(self._counters),
+                    'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                               for (name, labels), value in gauges.items()]}
+
+    def prometheus(self) -> str:
+        """
+        Get all metrics in the Prometheus text format.
+        """
+        def format_labels(labels) -> str:
+            if len(labels) == 0:
+                return ''
+            values = ','.join('{}="{}"'.format(
+                key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, value in labels)
+            return '{' + values + '}'
+
+        gauges = self._read_gauges()
+        lines = []
+        with self._lock:
+            lines.append('# TYPE maillist_stage_seconds histogram')
+            for stage, histogram in sorted(self._stages.items()):
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    lines.append(f'maillist_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} '
+                                 f'{count}')
+                lines.append(f'maillist_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} '
+                             f'{histogram["count"]}')
+                lines.append(f'maillist_stage_seconds_count{{stage="{stage}"}} '
+                             f'{histogram["count"]}')
+                lines.append(f'maillist_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'# TYPE maillist_{name}_total counter')
+                lines.append(f'maillist_{name}_total {value}')
+        names = set()
+        for (name, labels), value in sorted(gauges.items(), key=lambda item: item[0]):
+            if name not in names:
+                names.add(name)
+                lines.append(f'# TYPE maillist_{name} gauge')
+            lines.append(f'maillist_{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the process, exported by the MetricsExporter.
+METRICS = Metrics()
+
+
+class SnippetTemplate:
+    """
+    SnippetTemplate is a snippet with str.format placeholders.
+
+    The snippet is parsed once, and unknown placeholders or syntax
+    errors are raised as ValueError when it is created.
+    """
+
+    def __init__(self, text: str, fields: tuple):
+        self.text = text
+        self._formatter = string.Formatter()
+        self._parts = []
+        for literal, field, spec, conversion in self._formatter.parse(text):
+            if field is not None and field not in fields:
+                raise ValueError(f'unknown placeholder {{{field}}}, '
+                                 f'use one of {", ".join(fields)}')
+            if spec and '{' in spec:
+                raise ValueError(f'nested placeholder in {{{field}:{spec}}}')
+            self._parts.append((literal, field, spec, conversion))
+
+    def render(self, **values) -> str:
+        """
+        Fill in the placeholders.
+        """
+        result = []
+        for literal, field, spec, conversion in self._parts:
+            result.append(literal)
+            if field is not None:
+                value = self._formatter.convert_field(values[field], conversion)
+                result.append(self._formatter.format_field(value, spec))
+        return ''.join(result)
+
+
+class MessageSpool:
+    """
+    MessageSpool holds a serialized message in a file.
+
+    It is used for messages larger than spool_threshold, which
+    are not kept in memory, but read in chunks when sending.
+    Several threads can read the chunks at the same time.
+    """
+
+    def __init__(self, file, size: int):
+        self._file = file
+        self._lock = threading.Lock()
+        self.size = size
+
+    @classmethod
+    def open(cls, path: str) -> 'MessageSpool':
+        """
+        Create a spool for an existing file.
+        """
+        return cls(open(path, 'rb'), os.path.getsize(path))  # pylint: disable=consider-using-with
+
+    def chunks(self, chunk_size: int = SPOOL_CHUNK_SIZE):
+        """
+        Iterate over the message data.
+        """
+        offset = 0
+        while offset < self.size:
+            with self._lock:
+                self._file.seek(offset)
+                chunk = self._file.read(chunk_size)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        """
+        Close the spool file, temporary files are removed.
+        """
+        self._file.close()
+
+
+class PersonalizedSpool(MessageSpool):
+    """
+    PersonalizedSpool is the spooled message of a MessageTemplate
+    for one receiver.
+
+    It reads the shared spool file, and splices in the values of
+    the receiver, so the message is never copied.
+    """
+
+    def __init__(self, template: 'MessageTemplate', headers: bytes, values: dict):
+        spool = template.data
+        super().__init__(spool._file, template.size(headers, values))  # pylint: disable=protected-access
+        self._lock = spool._lock  # pylint: disable=protected-access
+        self._template = template
+        self._headers = headers
+        self._values = values
+
+    def chunks(self, chunk_size: int = SPOOL_CHUNK_SIZE):
+        """
+        Iterate over the personalized message data.
+        """
+        yield self._headers
+        for start, end, name in self._template.segments:
+            offset = start
+            while offset < end:
+                with self._lock:
+                    self._file.seek(offset)
+                    chunk = self._file.read(min(chunk_size, end - offset))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+            if name is not None:
+                yield self._values[name]
+
+    def close(self):
+        """
+        The shared spool file is closed by the owner of the template.
+        """
+
+
+class MessageTemplate:
+    """
+    MessageTemplate is a serialized message with per-receiver placeholders.
+
+    The message is serialized once, and the placeholders are searched
+    once. The message for a receiver is created by splicing the values
+    of the receiver into the serialized data, and adding the headers
+    of the receiver in front.
+    """
+
+    def __init__(self, data, markers: dict):
+        self.data = data
+        self.markers = markers
+        # literal (start, end) spans, each followed by the named placeholder
+        self.segments = []
+        start = 0
+        for offset, name in self._find():
+            self.segments.append((start, offset, name))
+            start = offset + len(markers[name])
+        end = len(data) if isinstance(data, bytes) else data.size
+        self.segments.append((start, end, None))
+
+    def _find(self) -> list:
+        """
+        Find the offsets of all placeholders.
+        """
+        overlap = max(len(marker) for marker in self.markers.values()) - 1
+        chunks = [self.data] if isinstance(self.data, bytes) else self.data.chunks()
+        found = {}
+        base = 0
+        window = b''
+        for chunk in chunks:
+            window += chunk
+            for name, marker in self.markers.items():
+                i = window.find(marker)
+                while i >= 0:
+                    found[base + i] = name
+                    i = window.find(marker, i + len(marker))
+            keep = min(overlap, len(window))
+            base += len(window) - keep
+            window = window[len(window) - keep:]
+        return sorted(found.items())
+
+    def size(self, headers: bytes, values: dict) -> int:
+        """
+        Get the size of the personalized message.
+        """
+        return len(headers) + sum(end - start + (len(values[name]) if name else 0)
+                                  for start, end, name in self.segments)
+
+    def render(self, headers: bytes, values: dict):
+        """
+        Create the message for one receiver.
+
+        Returns bytes, or a PersonalizedSpool for spooled messages.
+        """
+        if isinstance(self.data, MessageSpool):
+            return PersonalizedSpool(self, headers, values)
+
+        parts = [headers]
+        for start, end, name in self.segments:
+            parts.append(self.data[start:end])
+            if name is not None:
+                parts.append(values[name])
+        return b''.join(parts)
+
+
+class RawPart:
+    """
+    RawPart is a leaf MIME part of a RawMessage.
+
+    The part is given by its offsets in the data of the message, so
+    it can be forwarded by copying its bytes. Only the headers are
+    parsed, the payload is parsed when it is needed.
+    """
+
+    def __init__(self, message: 'RawMessage', start: int, body_start: int, end: int,
+                 headers: EmailMessage):
+        self.message = message
+        self.start = start
+        self.body_start = body_start
+        self.end = end
+        self.headers = headers
+
+    @property
+    def content_type(self) -> str:
+        """
+        Content type of the part.
+        """
+        return self.headers.get_content_type()
+
+    @property
+    def filename(self) -> str:
+        """
+        Decoded filename of the part, or an empty string.
+        """
+        return str(make_header(decode_header(self.headers.get_filename() or '')))
+
+    def is_attachment(self) -> bool:
+        """
+        Check if the part is an attachment, like imap_tools does.
+        """
+        return self.headers.get('Content-ID') is not None or \
+            self.headers.get_filename() is not None or \
+            self.content_type == 'message/rfc822'
+
+    def get_message(self) -> EmailMessage:
+        """
+        Parse the part, including its payload.
+        """
+        return message_from_bytes(self.message.data[self.start:self.end])
+
+    def write(self, file):
+        """
+        Write the part, headers and payload as they are.
+        """
+        self.message.copy(file, self.start, self.end)
+
+
+class RawMessage:
+    """
+    RawMessage is a fetched message, kept as bytes, or in a spool
+    file mapped into memory.
+
+    Only the headers are parsed. The MIME structure is scanned for
+    the offsets of the leaf parts, so parts are forwarded by copying
+    their bytes, and only replaced parts, like the text parts with
+    the footers, are serialized again.
+
+    The headers can be changed like the headers of an EmailMessage.
+    """
+
+    # Nesting depth of multiparts which is scanned, deeper parts are kept as they are.
+    max_depth = 16
+
+    def __init__(self, data, file=None):
+        self.data = data
+        self._file = file
+        self.body_start = self._body_start(0, len(data))
+        self.headers = BytesHeaderParser().parsebytes(data[:self.body_start])
+        self.parts = []
+        self._replaced = {}
+        self._scan(0, self.body_start, len(data), self.headers, 0)
+
+    @classmethod
+    def open(cls, file) -> 'RawMessage':
+        """
+        Create a message for a spool file, using a memory map.
+        """
+        file.flush()
+        return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), file)
+
+    @property
+    def policy(self):
+        """
+        Policy of the headers.
+        """
+        return self.headers.policy
+
+    def __getitem__(self, name: str):
+        return self.headers[name]
+
+    def __setitem__(self, name: str, value):
+        self.headers[name] = value
+
+    def __delitem__(self, name: str):
+        del self.headers[name]
+
+    def _body_start(self, start: int, end: int) -> int:
+        """
+        Get the offset after the blank line which ends the headers.
+        """
+        for blank in (b'\r\n', b'\n'):
+            if self.data[start:start + len(blank)] == blank:
+                return start + len(blank)
+        found = []
+        for blank in (b'\n\r\n', b'\n\n'):
+            i = self.data.find(blank, start, end)
+            if i >= 0:
+                found.append(i + len(blank))
+        return min(found) if len(found) > 0 else end
+
+    def _scan(self, start: int, body_start: int, end: int, headers: EmailMessage, depth: int):
+        """
+        Add the leaf parts of a part.
+        """
+        boundary = headers.get_boundary() if headers.get_content_maintype() == 'multipart' \
+            else None
+        if boundary is None or depth >= self.max_depth:
+            self.parts.append(RawPart(self, start, body_start, end, headers))
+            return
+
+        delimiters = self._delimiters(boundary.encode('ascii', 'replace'), body_start, end)
+        for (_, part_start), (part_end, _) in zip(delimiters, delimiters[1:]):
+            # the line break before a delimiter belongs to the delimiter
+            if self.data[part_end - 2:part_end] == b'\r\n':
+                part_end -= 2
+            elif self.data[part_end - 1:part_end] == b'\n':
+                part_end -= 1
+            part_end = max(part_start, part_end)
+            part_body = self._body_start(part_start, part_end)
+            part_headers = BytesHeaderParser().parsebytes(self.data[part_start:part_body])
+            self._scan(part_start, part_body, part_end, part_headers, depth + 1)
+
+    def _delimiters(self, boundary: bytes, start: int, end: int) -> list[tuple[int, int]]:
+        """
+        Find the delimiter lines of a multipart body.
+
+        Returns the offsets of the delimiter lines and of the lines after
+        them. The last entry is the close delimiter, or the end of the body.
+        """
+        delimiter = b'--' + boundary
+        found = []
+        i = self.data.find(delimiter, start, end)
+        while i >= 0:
+            after = i + len(delimiter)
+            line_end = self.data.find(b'\n', after, end)
+            next_line = end if line_end < 0 else line_end + 1
+            if i == start or self.data[i - 1:i] == b'\n':
+                rest = self.data[after:min(next_line, after + 80)].rstrip()
+                if rest == b'--':
+                    found.append((i, next_line))
+                    return found
+                if rest == b'':
+                    found.append((i, next_line))
+            i = self.data.find(delimiter, next_line, end)
+        found.append((end, end))
+        return found
+
+    def _body(self, content_type: str) -> str:
+        """
+        Get the first body part of the given type.
+        """
+        for part in self.parts:
+            if part.content_type == content_type and part.headers.get_filename() is None:
+                return decode_text(part.get_message())
+        return ''
+
+    @property
+    def text(self) -> str:
+        """
+        Plain text of the message.
+        """
+        return self._body('text/plain')
+
+    @property
+    def html(self) -> str:
+        """
+        HTML text of the message.
+        """
+        return self._body('text/html')
+
+    @property
+    def attachments(self) -> list[RawPart]:
+        """
+        Attachments of the message.
+        """
+        return [part for part in self.parts if part.is_attachment()]
+
+    def replace(self, part: RawPart, msg: EmailMessage):
+        """
+        Use a new message object for a leaf part.
+        """
+        if part.start == 0:
+            # a single part message, the new object has the headers too
+            self.headers = msg
+        self._replaced[part.start] = (part, msg)
+
+    def walk(self):
+        """
+        Iterate over the replaced parts, like EmailMessage.walk.
+        """
+        return [msg for _, msg in self._replaced.values()]
+
+    def copy(self, file, start: int, end: int):
+        """
+        Write a range of the data in chunks, without copying it in memory.
+        """
+        view = memoryview(self.data)
+        try:
+            for offset in range(start, end, SPOOL_CHUNK_SIZE):
+                file.write(view[offset:min(offset + SPOOL_CHUNK_SIZE, end)])
+        finally:
+            view.release()
+
+    def write(self, file, policy):
+        """
+        Write the message. The headers and the replaced parts are
+        serialized, and all other data is copied.
+        """
+        generator = BytesGenerator(file, mangle_from_=False, policy=policy)
+        generator.flatten(self.headers)
+        if 0 in self._replaced:
+            return
+
+        offset = self.body_start
+        for start in sorted(self._replaced):
+            part, msg = self._replaced[start]
+            self.copy(file, offset, part.start)
+            generator.flatten(msg)
+            offset = part.end
+        self.copy(file, offset, len(self.data))
+
+    def close(self):
+        """
+        Close the memory map and the spool file.
+        """
+        if self._file is not None:
+            self.data.close()
+            self._file.close()
 
 
 class Attachment:
@@ -33,10 +782,16 @@ class Attachment:
     Attachment is a internal data type to group
     the information for one attachment. It is used
     to transfer the attachments form IMAP to SMTP.
+
+    If part is set, the original MIME part, with its
+    already encoded payload, is forwarded, and data
+    is not used. A RawPart is copied from the fetched
+    message when the message is serialized.
     """
     filename: str = None
     mimetype: str = "application/octet-stream"
     data: bytes = None
+    part: EmailMessage | RawPart = None
 
 
 class Message:
@@ -47,6 +802,10 @@ class Message:
     the information needed for a mail which shall be sent
     using SMTP. It is used for mail forwarding as well as
     replies.
+
+    If raw is set, the original message is forwarded with
+    rewritten headers, and text, html and attachments are
+    not used.
     """
     sender_name: str = ""
     receivers: list[str] = []
@@ -54,6 +813,7 @@ class Message:
     text: str = ""
     html: str = ""
     attachments: list[Attachment] = []
+    raw: EmailMessage | RawMessage = None
 
 
 class SubscriberCheckResult:
@@ -67,6 +827,64 @@ class SubscriberCheckResult:
     forward: bool = False
     receivers: list[str] = []
     unsubscribe_tag: str = ''
+    scope: str = 'subscribers'
+    digest: bytes = None
+
+
+class SendResult:
+    """
+    Data type for the outcome of Sender.send_mail.
+
+    SendResult aggregates the results of all recipient batches
+    of one message.
+    """
+
+    def __init__(self):
+        self.refused: dict[str, tuple] = {}
+        self.failed: list[str] = []
+
+    @property
+    def ok(self) -> bool:
+        """
+        True if the message was accepted for all receivers.
+        """
+        return len(self.refused) == 0 and len(self.failed) == 0
+
+
+class CycleResult:
+    """
+    Data type for the outcome of one processing cycle.
+
+    CycleResult counts the processed mails, and the new mails
+    left for the next cycle.
+    """
+
+    def __init__(self, processed: int = 0, remaining: int = 0):
+        self.processed = processed
+        self.remaining = remaining
+
+    def add(self, other: 'CycleResult'):
+        """
+        Add the counts of another cycle, e.g. of another hosted list.
+        """
+        self.processed += other.processed
+        self.remaining += other.remaining
+
+
+class PostDelivery:
+    """
+    Data type for the queued deliveries of one forwarded post.
+
+    PostDelivery counts the messages of the post in the deliver stage
+    of the AsyncEngine, so the post is remembered for dedupe only when
+    all of them were sent.
+    """
+
+    def __init__(self, digest: bytes = None):
+        self.digest = digest
+        # held by the process stage until all messages are queued
+        self.pending = 1
+        self.failed = False
 
 
 class Config:
@@ -76,8 +894,10 @@ class Config:
 
     def __init__(self):
         self._get_args()
-        self._get_config()
-        self._get_secrets()
+        # hosted lists have their own config files, see for_list
+        if self.lists_path is None:
+            self._get_config()
+            self._get_secrets()
 
     def _interface_argparse(self):
         """
@@ -91,13 +911,29 @@ class Config:
         parser.add_argument('-l', '--logfile', default='./data/maillist.log', type=str,
                             help='maillist logfile')
         parser.add_argument('-s', '--sleep', default='60', type=int,
-                            help='sleep time between mail checks in seconds')
+                            help='period between mail checks in seconds, '
+                            'see the [schedule] section for the adaptive schedule')
         parser.add_argument('-v', '--verbose', action="store_true",
                             help='print logs')
         parser.add_argument('-t', '--test', action="store_true",
                             help='send test mail on startup')
         parser.add_argument('-d', '--daemon', action="store_true",
                             help='run as daemon')
+        parser.add_argument('-i', '--idle', action="store_true",
+                            help='keep the mailbox session open and wait for new mails '
+                            'using IMAP IDLE, sleep is used as IDLE timeout, '
+                            'not supported with --lists or --asyncio')
+        parser.add_argument('-a', '--asyncio', action="store_true",
+                            help='use the asyncio engine, which fetches, processes '
+                            'and delivers mails concurrently')
+        parser.add_argument('-L', '--lists', default=None, type=str,
+                            help='host all lists of this folder, one sub-folder '
+                            'with config, maillist.json and .env per list')
+        parser.add_argument('-P', '--processes', default='1', type=int,
+                            help='number of processes for hosting lists')
+        parser.add_argument('-p', '--profile', action="store_true",
+                            help='profile the mail processing cycles, '
+                            'SIGUSR1 toggles profiling at runtime')
         parser.add_argument('-r', '--reduce_logs', action="store_true",
                             help='log only errors')
 
@@ -131,18 +967,68 @@ class Config:
         self.daemon = args.daemon
         logging.info('running as daemon: %r', self.daemon)
 
+        self.idle = args.idle
+        logging.info('using IMAP IDLE: %r', self.idle)
+
+        self.use_asyncio = args.asyncio
+        logging.info('using asyncio engine: %r', self.use_asyncio)
+
+        self.profile = args.profile
+        logging.info('profiling cycles: %r', self.profile)
+
         self.sleep = args.sleep
         logging.info('sleep time set to %i seconds', self.sleep)
 
         self.config_file = args.config
         logging.debug('using config file %s', self.config_file)
 
-        self.maillist_file = args.maillist
-        logging.debug('using maillist file %s', self.maillist_file)
+        self._set_maillist_file(args.maillist)
+        self.env_file = './data/.env'
+
+        self.lists_path = args.lists
+        logging.debug('hosting lists of %s', self.lists_path)
+
+        self.processes = args.processes
+        logging.debug('hosting processes: %i', self.processes)
 
         self.send_test_mail = args.test
         logging.debug('send test mail: %r', self.send_test_mail)
 
+    def _set_maillist_file(self, maillist_file: str):
+        """
+        Set the maillist file, and the state files next to it.
+        """
+        self.maillist_file = maillist_file
+        logging.debug('using maillist file %s', self.maillist_file)
+
+        self.sync_file = os.path.splitext(self.maillist_file)[0] + '.sync.json'
+        logging.debug('using sync state file %s', self.sync_file)
+
+        self.database_file = os.path.splitext(self.maillist_file)[0] + '.db'
+
+        self.dedupe_file = os.path.splitext(self.maillist_file)[0] + '.dedupe'
+        logging.debug('using dedupe file %s', self.dedupe_file)
+
+    def for_list(self, path: str) -> 'Config':
+        """
+        Get the config of a hosted list.
+
+        The folder of the list contains the config, maillist.json
+        and .env files of the list. Command line options are shared.
+        A relative outbox path is relative to the folder of the list,
+        so the lists never share an outbox.
+        """
+        config = copy.copy(self)
+        config.config_file = os.path.join(path, 'config')
+        config.env_file = os.path.join(path, '.env')
+        config._set_maillist_file(os.path.join(path, 'maillist.json'))  # pylint: disable=protected-access
+        config._get_config()  # pylint: disable=protected-access
+        config._get_secrets()  # pylint: disable=protected-access
+        if config.outbox_path is not None and not os.path.isabs(config.outbox_path):
+            config.outbox_path = os.path.normpath(os.path.join(path, config.outbox_path))
+            logging.debug('outbox path of the list: %s', config.outbox_path)
+        return config
+
     def _interface_configparser(self):
         """
         Encapsulate calls to configparser.
@@ -167,12 +1053,27 @@ class Config:
             mailbox = config['mailbox']
             self.mailbox_server = mailbox.get('server', None)
             self.mailbox_user = mailbox.get('user', None)
+            self.mailbox_folder = mailbox.get('folder', 'INBOX')
+            self.mailbox_ssl = mailbox.get('ssl', 'true').lower() == 'true'
+            self.mailbox_port = int(mailbox.get('port', '993' if self.mailbox_ssl else '143'))
+            self.mailbox_page_size = int(mailbox.get('page_size', '100'))
+            self.mailbox_max_size = int(mailbox.get('max_size', '0'))
         else:
             self.mailbox_server = None
             self.mailbox_user = None
+            self.mailbox_folder = 'INBOX'
+            self.mailbox_ssl = True
+            self.mailbox_port = 993
+            self.mailbox_page_size = 100
+            self.mailbox_max_size = 0
 
         logging.debug('mailbox server: %s', self.mailbox_server)
         logging.debug('mailbox user: %s', self.mailbox_user)
+        logging.debug('mailbox folder: %s', self.mailbox_folder)
+        logging.debug('mailbox ssl: %s', self.mailbox_ssl)
+        logging.debug('mailbox port: %i', self.mailbox_port)
+        logging.debug('mailbox page size: %i', self.mailbox_page_size)
+        logging.debug('mailbox max message size: %i', self.mailbox_max_size)
 
         if 'smtp' in config:
             smtp = config['smtp']
@@ -181,16 +1082,32 @@ class Config:
             self.smtp_port = smtp.get('port', '587')
             tls = smtp.get('tls', 'true')
             self.smtp_tls = tls.lower() == 'true'
+            self.smtp_pool_size = int(smtp.get('pool_size', '4'))
+            self.smtp_max_messages = int(smtp.get('max_messages', '100'))
+            self.smtp_idle_timeout = int(smtp.get('idle_timeout', '240'))
+            self.smtp_batch_size = int(smtp.get('batch_size', '50'))
+            self.smtp_workers = int(smtp.get('workers', '4'))
         else:
             self.smtp_server = None
             self.smtp_user = None
             self.smtp_port = '587'
             self.smtp_tls = True
+            self.smtp_pool_size = 4
+            self.smtp_max_messages = 100
+            self.smtp_idle_timeout = 240
+            self.smtp_batch_size = 50
+            self.smtp_workers = 4
 
         logging.debug('smtp server: %s', self.smtp_server)
         logging.debug('smtp user: %s', self.smtp_user)
         logging.debug('smtp port: %s', self.smtp_port)
         logging.debug('use tls: %s', self.smtp_tls)
+        logging.debug('smtp pool size: %i', self.smtp_pool_size)
+        logging.debug('smtp max messages per session: %i',
+                      self.smtp_max_messages)
+        logging.debug('smtp idle timeout: %i', self.smtp_idle_timeout)
+        logging.debug('smtp batch size: %i', self.smtp_batch_size)
+        logging.debug('smtp workers: %i', self.smtp_workers)
 
         if 'sender' in config:
             sender = config['sender']
@@ -210,23 +1127,188 @@ class Config:
 
         logging.debug('test receiver: %s', self.test_receiver)
 
-        if 'snippets' in config:
-            snippets = config['snippets']
-            self.list_name = snippets.get('list_name', self.sender_address)
-            self.subscribe_subject = snippets.get(
-                'subscribe_subject', 'Welcome!')
-            self.unsubscribe_subject = snippets.get(
-                'unsubscribe_subject', 'Bye!')
+        if 'spool' in config:
+            spool = config['spool']
+            self.spool_threshold = int(spool.get('threshold', '1048576'))
+            self.spool_path = spool.get('path', None)
+        else:
+            self.spool_threshold = 1048576
+            self.spool_path = None
 
-            footer_text_file = snippets.get('footer_text', None)
-            if footer_text_file is not None and exists(footer_text_file):
-                with open(footer_text_file, 'r', encoding='utf-8') as f:
-                    self.footer_text = f.read()
-            else:
-                self.footer_text = ""
+        logging.debug('spool threshold: %i', self.spool_threshold)
+        logging.debug('spool path: %s', self.spool_path)
 
-            footer_html_file = snippets.get('footer_html', None)
-            if footer_html_file is not None and exists(footer_html_file):
+        if 'forwarding' in config:
+            self.forward_mode = config['forwarding'].get('mode', 'rebuild')
+        else:
+            self.forward_mode = 'rebuild'
+
+        logging.debug('forwarding mode: %s', self.forward_mode)
+
+        if 'personalize' in config:
+            personalize = config['personalize']
+            self.personalize = personalize.get('enabled', 'false').lower() == 'true'
+            self.personalize_url = personalize.get('url', None)
+        else:
+            self.personalize = False
+            self.personalize_url = None
+
+        logging.debug('personalize: %s', self.personalize)
+        logging.debug('personalize url: %s', self.personalize_url)
+
+        if 'dedupe' in config:
+            dedupe = config['dedupe']
+            self.dedupe = dedupe.get('enabled', 'false').lower() == 'true'
+            self.dedupe_ttl = int(dedupe.get('ttl', '604800'))
+            self.dedupe_max_entries = int(dedupe.get('max_entries', '100000'))
+        else:
+            self.dedupe = False
+            self.dedupe_ttl = 604800
+            self.dedupe_max_entries = 100000
+
+        logging.debug('dedupe: %s', self.dedupe)
+        logging.debug('dedupe ttl: %i', self.dedupe_ttl)
+        logging.debug('dedupe max entries: %i', self.dedupe_max_entries)
+
+        if 'asyncio' in config:
+            self.async_queue_size = int(config['asyncio'].get('queue_size', '64'))
+        else:
+            self.async_queue_size = 64
+
+        logging.debug('asyncio queue size: %i', self.async_queue_size)
+
+        if 'limits' in config:
+            limits = config['limits']
+            self.limit_sender_rate = int(limits.get('sender_rate', '0'))
+            self.limit_sender_burst = int(limits.get('sender_burst', '20'))
+            self.limit_scope_rate = int(limits.get('scope_rate', '0'))
+            self.limit_scope_burst = int(limits.get('scope_burst', '100'))
+            self.limit_policy = limits.get('policy', 'defer')
+            self.limit_defer_max_age = int(limits.get('defer_max_age', '86400'))
+            self.limit_defer_max_count = int(limits.get('defer_max_count', '1000'))
+            precedence = limits.get('precedence', 'bulk,junk,auto_reply')
+        else:
+            self.limit_sender_rate = 0
+            self.limit_sender_burst = 20
+            self.limit_scope_rate = 0
+            self.limit_scope_burst = 100
+            self.limit_policy = 'defer'
+            self.limit_defer_max_age = 86400
+            self.limit_defer_max_count = 1000
+            precedence = 'bulk,junk,auto_reply'
+        self.loop_precedence = [value.strip().lower() for value in precedence.split(',')
+                                if value.strip()]
+
+        logging.debug('sender rate limit: %i per hour, burst %i',
+                      self.limit_sender_rate, self.limit_sender_burst)
+        logging.debug('scope rate limit: %i per hour, burst %i',
+                      self.limit_scope_rate, self.limit_scope_burst)
+        logging.debug('rate limit policy: %s', self.limit_policy)
+        logging.debug('deferred mails max age: %i', self.limit_defer_max_age)
+        logging.debug('deferred mails max count: %i', self.limit_defer_max_count)
+        logging.debug('loop precedence: %r', self.loop_precedence)
+
+        if 'schedule' in config:
+            schedule = config['schedule']
+            self.schedule_max_messages = int(schedule.get('max_messages', '0'))
+            self.schedule_active_sleep = int(schedule.get('active_sleep', '5'))
+            self.schedule_max_sleep = int(schedule.get('max_sleep', '600'))
+            self.schedule_backoff = float(schedule.get('backoff', '1.0'))
+        else:
+            self.schedule_max_messages = 0
+            self.schedule_active_sleep = 5
+            self.schedule_max_sleep = 600
+            self.schedule_backoff = 1.0
+
+        logging.debug('schedule max messages per cycle: %i', self.schedule_max_messages)
+        logging.debug('schedule active sleep: %i', self.schedule_active_sleep)
+        logging.debug('schedule max sleep: %i', self.schedule_max_sleep)
+        logging.debug('schedule backoff: %f', self.schedule_backoff)
+
+        if 'metrics' in config:
+            metrics = config['metrics']
+            self.metrics_port = int(metrics.get('port', '0'))
+            self.metrics_address = metrics.get('address', '127.0.0.1')
+            self.metrics_dump = metrics.get('dump', None)
+            self.metrics_dump_interval = int(metrics.get('dump_interval', '60'))
+        else:
+            self.metrics_port = 0
+            self.metrics_address = '127.0.0.1'
+            self.metrics_dump = None
+            self.metrics_dump_interval = 60
+
+        logging.debug('metrics port: %i', self.metrics_port)
+        logging.debug('metrics address: %s', self.metrics_address)
+        logging.debug('metrics dump: %s', self.metrics_dump)
+        logging.debug('metrics dump interval: %i', self.metrics_dump_interval)
+
+        if 'profile' in config:
+            profile = config['profile']
+            self.profile_mode = profile.get('mode', 'cprofile')
+            self.profile_path = profile.get('path', './data/profiles')
+            self.profile_threshold = float(profile.get('threshold', '1.0'))
+            self.profile_keep = int(profile.get('keep', '20'))
+            self.profile_interval = int(profile.get('interval', '10'))
+        else:
+            self.profile_mode = 'cprofile'
+            self.profile_path = './data/profiles'
+            self.profile_threshold = 1.0
+            self.profile_keep = 20
+            self.profile_interval = 10
+
+        logging.debug('profile mode: %s', self.profile_mode)
+        logging.debug('profile path: %s', self.profile_path)
+        logging.debug('profile threshold: %f', self.profile_threshold)
+        logging.debug('profile keep: %i', self.profile_keep)
+        logging.debug('profile sampling interval: %i', self.profile_interval)
+
+        if 'storage' in config:
+            storage = config['storage']
+            self.storage_backend = storage.get('backend', 'json')
+            self.database_file = storage.get('path', self.database_file)
+            self.storage_compact_after = int(storage.get('compact_after', '1000'))
+        else:
+            self.storage_backend = 'json'
+            self.storage_compact_after = 1000
+
+        logging.debug('storage backend: %s', self.storage_backend)
+        logging.debug('database file: %s', self.database_file)
+        logging.debug('compact journal after %i changes', self.storage_compact_after)
+
+        if 'outbox' in config:
+            outbox = config['outbox']
+            self.outbox_path = outbox.get('path', './data/outbox')
+            self.outbox_workers = int(outbox.get('workers', '4'))
+            self.outbox_retries = int(outbox.get('retries', '8'))
+            self.outbox_backoff = int(outbox.get('backoff', '60'))
+        else:
+            self.outbox_path = None
+            self.outbox_workers = 4
+            self.outbox_retries = 8
+            self.outbox_backoff = 60
+
+        logging.debug('outbox path: %s', self.outbox_path)
+        logging.debug('outbox workers: %i', self.outbox_workers)
+        logging.debug('outbox retries: %i', self.outbox_retries)
+        logging.debug('outbox backoff: %i', self.outbox_backoff)
+
+        if 'snippets' in config:
+            snippets = config['snippets']
+            self.list_name = snippets.get('list_name', self.sender_address)
+            self.subscribe_subject = snippets.get(
+                'subscribe_subject', 'Welcome!')
+            self.unsubscribe_subject = snippets.get(
+                'unsubscribe_subject', 'Bye!')
+
+            footer_text_file = snippets.get('footer_text', None)
+            if footer_text_file is not None and exists(footer_text_file):
+                with open(footer_text_file, 'r', encoding='utf-8') as f:
+                    self.footer_text = f.read()
+            else:
+                self.footer_text = ""
+
+            footer_html_file = snippets.get('footer_html', None)
+            if footer_html_file is not None and exists(footer_html_file):
                 with open(footer_html_file, 'r', encoding='utf-8') as f:
                     self.footer_html = f.read()
             else:
@@ -236,8 +1318,6 @@ class Config:
             if subscribe_text_file is not None and exists(subscribe_text_file):
                 with open(subscribe_text_file, 'r', encoding='utf-8') as f:
                     self.subscribe_text = f.read()
-                    self.subscribe_text = self.subscribe_text.format(
-                        list_name=self.list_name)
             else:
                 self.subscribe_text = ""
 
@@ -245,8 +1325,6 @@ class Config:
             if subscribe_html_file is not None and exists(subscribe_html_file):
                 with open(subscribe_html_file, 'r', encoding='utf-8') as f:
                     self.subscribe_html = f.read()
-                    self.subscribe_html = self.subscribe_html.format(
-                        list_name=self.list_name)
             else:
                 self.subscribe_html = ""
 
@@ -254,8 +1332,6 @@ class Config:
             if unsubscribe_text_file is not None and exists(unsubscribe_text_file):
                 with open(unsubscribe_text_file, 'r', encoding='utf-8') as f:
                     self.unsubscribe_text = f.read()
-                    self.unsubscribe_text = self.unsubscribe_text.format(
-                        list_name=self.list_name)
             else:
                 self.unsubscribe_text = ""
 
@@ -263,8 +1339,6 @@ class Config:
             if unsubscribe_html_file is not None and exists(unsubscribe_html_file):
                 with open(unsubscribe_html_file, 'r', encoding='utf-8') as f:
                     self.unsubscribe_html = f.read()
-                    self.unsubscribe_html = self.unsubscribe_html.format(
-                        list_name=self.list_name)
             else:
                 self.unsubscribe_html = ""
         else:
@@ -288,19 +1362,59 @@ class Config:
         logging.debug('unsubscribe text: %s', self.unsubscribe_text)
         logging.debug('unsubscribe html: %s', self.unsubscribe_html)
 
+        self._compile_snippets()
+
+    def _compile_snippets(self):
+        """
+        Parse the snippets, and report broken snippets at startup.
+        """
+        footer_fields = FOOTER_FIELDS + PERSONAL_FIELDS if self.personalize else FOOTER_FIELDS
+        snippets = (('footer_text', footer_fields),
+                    ('footer_html', footer_fields),
+                    ('subscribe_text', WELCOME_FIELDS),
+                    ('subscribe_html', WELCOME_FIELDS),
+                    ('unsubscribe_text', WELCOME_FIELDS),
+                    ('unsubscribe_html', WELCOME_FIELDS))
+        templates = {}
+        for name, fields in snippets:
+            try:
+                templates[name] = SnippetTemplate(getattr(self, name), fields)
+            except ValueError as e:
+                print(f'Snippet {name} is invalid: {e}')
+                logging.error('Snippet %s is invalid: %s', name, e)
+                sys.exit(1)
+
+        self.footer_text_template = templates['footer_text']
+        self.footer_html_template = templates['footer_html']
+        for name, _ in snippets[2:]:
+            setattr(self, name, templates[name].render(list_name=self.list_name))
+
+        if self.personalize_url:
+            try:
+                self.personalize_url = SnippetTemplate(self.personalize_url,
+                                                       UNSUBSCRIBE_URL_FIELDS)
+            except ValueError as e:
+                print(f'Personalize url is invalid: {e}')
+                logging.error('Personalize url is invalid: %s', e)
+                sys.exit(1)
+
     def _get_secrets(self):
         """
         Read secrets from .env
         """
-        load_dotenv('./data/.env')
-        self.mailbox_password = os.environ.get('mailbox_password')
+        # the environment wins, like with load_dotenv, but the .env files
+        # of hosted lists are not mixed up in os.environ
+        secrets = {**dotenv_values(self.env_file), **os.environ}
+        self.mailbox_password = secrets.get('mailbox_password')
         if self.mailbox_password is None or len(self.mailbox_password) == 0:
             logging.info('mailbox password is empty')
 
-        self.smtp_password = os.environ.get('smtp_password')
+        self.smtp_password = secrets.get('smtp_password')
         if self.smtp_password is None or len(self.smtp_password) == 0:
             logging.info('smtp password is empty')
 
+        self.unsubscribe_secret = secrets.get('unsubscribe_secret')
+
     def check_config(self):
         """
         Assert that all mandatory config parameters are available.
@@ -312,17 +1426,344 @@ class Config:
             assert self.test_receiver is not None
         if self.daemon:
             assert self.sleep > 0
+        assert self.mailbox_page_size > 0
+        assert self.forward_mode in ('rebuild', 'raw')
+        assert self.storage_backend in ('json', 'journal', 'sqlite')
+        assert self.storage_compact_after > 0
+        assert self.smtp_pool_size > 0
+        assert self.smtp_max_messages > 0
+        assert self.smtp_batch_size > 0
+        assert self.smtp_workers > 0
+        if self.outbox_path is not None:
+            assert self.outbox_workers > 0
+            assert self.outbox_backoff > 0
+        if self.personalize:
+            assert self.unsubscribe_secret
+        if self.dedupe:
+            assert self.dedupe_ttl > 0
+            assert self.dedupe_max_entries > 0
+        assert self.async_queue_size > 0
+        assert self.limit_sender_rate >= 0
+        assert self.limit_scope_rate >= 0
+        assert self.limit_sender_burst > 0
+        assert self.limit_scope_burst > 0
+        assert self.limit_policy in ('defer', 'drop')
+        assert self.limit_defer_max_age > 0
+        assert self.limit_defer_max_count > 0
+        assert self.schedule_max_messages >= 0
+        assert self.schedule_active_sleep >= 0
+        assert self.schedule_max_sleep >= self.schedule_active_sleep
+        assert self.schedule_backoff >= 1
+        assert 0 <= self.metrics_port < 65536
+        if self.metrics_dump is not None:
+            assert self.metrics_dump_interval > 0
+        assert self.profile_mode in ('cprofile', 'sample')
+        assert self.profile_threshold >= 0
+        assert self.profile_keep > 0
+        assert self.profile_interval > 0
+        assert self.processes > 0
+        if self.lists_path is not None:
+            # hosted lists share one scheduler loop, which doesn't use IDLE
+            assert not self.idle
+        if self.use_asyncio:
+            # the engine logs in every cycle, there is no session to IDLE on
+            assert not self.idle
+
+
+class SmtpSession:
+    """
+    SMTP session data type.
+
+    SmtpSession groups an authenticated smtplib connection
+    with the bookkeeping needed by the SmtpPool.
+    """
 
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = monotonic()
 
-class Sender:
+
+class SmtpPool:
     """
-    The sender takes care of sending the mails.
+    SmtpPool keeps authenticated SMTP sessions alive.
+
+    Sessions are reused across send_mail calls and processing
+    cycles, checked with RSET before reuse, kept alive with NOOP
+    while idle, and closed after smtp_max_messages messages.
     """
 
     def __init__(self, config: Config):
         self.config = config
+        self._idle: list[SmtpSession] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config.smtp_pool_size)
+        self._local = threading.local()
+
+    def _interface_smtplib(self) -> smtplib.SMTP:
+        """
+        Encapsulate calls to smtplib.
+        """
+        smtp = smtplib.SMTP(self.config.smtp_server,
+                            port=self.config.smtp_port)
+        if self.config.smtp_tls:
+            smtp.starttls()
+        if self.config.smtp_user:
+            smtp.login(self.config.smtp_user,
+                       self.config.smtp_password)
+        return smtp
+
+    def _connect(self) -> SmtpSession:
+        """
+        Open a new authenticated session.
+        """
+        logging.debug('opening new smtp session to %s',
+                      self.config.smtp_server)
+        return SmtpSession(self._interface_smtplib())
+
+    def _is_alive(self, session: SmtpSession) -> bool:
+        """
+        Check if an idle session can be reused.
+        """
+        if monotonic() - session.last_used > self.config.smtp_idle_timeout:
+            return False
+        try:
+            return session.smtp.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _dropped(error: OSError) -> bool:
+        """
+        True if the error is a lost connection, and not an SMTP reply.
+        """
+        # SMTPException is an OSError, but the session is still usable after a reply
+        return isinstance(error, smtplib.SMTPServerDisconnected) or \
+            not isinstance(error, smtplib.SMTPException)
+
+    def _close(self, session: SmtpSession):
+        """
+        Close the given session, ignoring errors of dropped connections.
+        """
+        try:
+            session.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            session.smtp.close()
+
+    def acquire(self) -> SmtpSession:
+        """
+        Get a usable session, reusing an idle one if possible.
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    session = self._idle.pop()
+                if self._is_alive(session):
+                    return session
+                logging.debug('dropping stale smtp session')
+                self._close(session)
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, session: SmtpSession, broken: bool = False):
+        """
+        Return a session to the pool.
+        """
+        try:
+            if broken or session.messages >= self.config.smtp_max_messages:
+                self._close(session)
+            else:
+                session.last_used = monotonic()
+                with self._lock:
+                    self._idle.append(session)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager for a pooled session.
+        """
+        session = self.acquire()
+        broken = False
+        try:
+            yield session
+        except OSError as e:
+            broken = self._dropped(e)
+            raise
+        finally:
+            self.release(session, broken)
+
+    @contextmanager
+    def pinned(self):
+        """
+        Context manager to send all mails of the current thread
+        using one session, without checks between the mails.
+
+        The session is acquired on the first mail.
+        """
+        self._local.pinned = True
+        try:
+            yield
+        finally:
+            session = getattr(self._local, 'session', None)
+            self._local.pinned = False
+            self._local.session = None
+            if session is not None:
+                self.release(session)
+
+    def _send(self, smtp: smtplib.SMTP, sender: str, receivers: list[str], message) -> dict:
+        """
+        Send a message, given as bytes or MessageSpool, using the given connection.
+        """
+        if isinstance(message, MessageSpool):
+            return self._send_spool(smtp, sender, receivers, message)
+        return smtp.sendmail(sender, receivers, message)
+
+    def _send_spool(self, smtp: smtplib.SMTP, sender: str, receivers: list[str],
+                    spool: MessageSpool) -> dict:
+        """
+        Send a spooled message, streaming the DATA in chunks.
+
+        Follows smtplib.SMTP.sendmail, but never holds the full
+        message in memory.
+        """
+        smtp.ehlo_or_helo_if_needed()
+        options = []
+        if smtp.does_esmtp and smtp.has_extn('size'):
+            options.append(f'size={spool.size}')
+        code, resp = smtp.mail(sender, options)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+
+        refused = {}
+        for receiver in receivers:
+            code, resp = smtp.rcpt(receiver)
+            if code not in (250, 251):
+                refused[receiver] = (code, resp)
+        if len(refused) == len(receivers):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = smtp.docmd('data')
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        for data in smtp_data_chunks(spool.chunks()):
+            smtp.send(data)
+        code, resp = smtp.getreply()
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _send_pinned(self, sender: str, receivers: list[str], message) -> dict:
+        """
+        Send a message using the pinned session of the current thread.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.acquire()
+        elif session.messages >= self.config.smtp_max_messages:
+            self._close(session)
+            session.smtp = self._interface_smtplib()
+            session.messages = 0
+
+        session.messages += 1
+        try:
+            return self._send(session.smtp, sender, receivers, message)
+        except OSError as e:
+            if self._dropped(e):
+                # reconnect on the next mail
+                session.messages = self.config.smtp_max_messages
+            raise
+
+    def sendmail(self, sender: str, receivers: list[str], message) -> dict:
+        """
+        Send a message using a pooled session.
+
+        If the server dropped the session, or the connection failed,
+        the message is sent again using a new session.
+        """
+        for attempt in range(2):
+            try:
+                if getattr(self._local, 'pinned', False):
+                    return self._send_pinned(sender, receivers, message)
+                with self.session() as session:
+                    session.messages += 1
+                    return self._send(session.smtp, sender, receivers, message)
+            except OSError as e:
+                if attempt > 0 or not self._dropped(e):
+                    raise
+                logging.info('smtp session was dropped (%s), reconnecting', e)
+        return {}
+
+    def keepalive(self):
+        """
+        Send NOOP on all idle sessions and drop the dead ones.
+        """
+        with self._lock:
+            sessions = self._idle
+            self._idle = []
+
+        alive = []
+        for session in sessions:
+            try:
+                if session.smtp.noop()[0] == 250:
+                    session.last_used = monotonic()
+                    alive.append(session)
+                    continue
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(session)
+
+        with self._lock:
+            self._idle += alive
+
+    def close(self):
+        """
+        Close all idle sessions.
+        """
+        with self._lock:
+            sessions = self._idle
+            self._idle = []
+        for session in sessions:
+            self._close(session)
+
+
+class Sender:
+    """
+    The sender takes care of sending the mails.
+    """
+
+    # Headers of the original message which are not forwarded in raw mode.
+    raw_drop_headers = ('From', 'To', 'Cc', 'Bcc', 'Sender', 'Reply-To', 'Return-Path',
+                        'Delivered-To', 'X-Original-To', 'Received', 'DKIM-Signature',
+                        'ARC-Seal', 'ARC-Message-Signature', 'ARC-Authentication-Results',
+                        'Authentication-Results', 'List-Id', 'List-Post', 'List-Help',
+                        'List-Subscribe', 'List-Unsubscribe', 'List-Unsubscribe-Post',
+                        'List-Archive', 'List-Owner')
 
-    def send_mail(self, message: Message):
+    def __init__(self, config: Config, pool: SmtpPool = None,
+                 executor: ThreadPoolExecutor = None):
+        self.config = config
+        self.pool = pool if pool is not None else SmtpPool(config)
+        self.outbox = None
+        self.list_id = f"<{config.sender_address.replace('@', '.')}>"
+        # placeholders for the per-receiver values of personalized messages
+        self.markers = {field: f'%%{uuid.uuid4().hex}-{field}%%'
+                        for field in PERSONAL_FIELDS}
+        # a shared executor is shut down by its owner
+        self._own_executor = executor is None
+        self._executor = executor if executor is not None else smtp_executor(config)
+
+    def send_mail(self, message: Message) -> SendResult:
         """
         Send the given message.
         """
@@ -335,11 +1776,203 @@ class Sender:
 
         smtp_sender = f"{message.sender_name} <{self.config.sender_address}>"
 
+        # original parts which are copied when serializing
+        parts = []
+        with METRICS.timer('build'):
+            if message.raw is not None:
+                msg = self._rewrite_headers(message.raw, smtp_sender)
+            else:
+                msg = self._build(message, smtp_sender)
+                parts = [attachment.part for attachment in message.attachments
+                         if isinstance(attachment.part, RawPart)]
+
+        logging.debug('Sending message to %r', message.receivers)
+
+        sender = self.config.sender_address
+
+        if self.config.personalize:
+            return self._send_personalized(msg, sender, message.receivers, parts)
+
+        data = self._serialize(msg, parts)
+        try:
+            if self.outbox is not None:
+                self.outbox.put(sender, message.receivers, data)
+                return SendResult()
+
+            return self.submit(sender, message.receivers, data)
+        finally:
+            if isinstance(data, MessageSpool):
+                data.close()
+
+    def _send_personalized(self, msg: EmailMessage, sender: str,
+                           receivers: list[str], parts: list[RawPart] = ()) -> SendResult:
+        """
+        Send an own copy of the message to each receiver.
+
+        The message is serialized only once, and the copies are
+        created by splicing in the values of the receiver.
+        """
+        del msg['List-Unsubscribe']
+        del msg['List-Unsubscribe-Post']
+        self._encode_placeholders(msg)
+
+        data = self._serialize(msg, parts)
+        try:
+            template = MessageTemplate(data, {name: marker.encode('ascii')
+                                              for name, marker in self.markers.items()})
+            logging.debug('Personalizing message with %i placeholders for %i receivers',
+                          len(template.segments) - 1, len(receivers))
+
+            if self.outbox is not None:
+                for receiver in receivers:
+                    self.outbox.put(sender, [receiver], self._personalize(template, receiver))
+                return SendResult()
+
+            return self._merge(self._executor.map(
+                lambda receiver: self._submit_batch(
+                    sender, [receiver], self._personalize(template, receiver)),
+                receivers))
+        finally:
+            if isinstance(data, MessageSpool):
+                data.close()
+
+    def _encode_placeholders(self, msg: EmailMessage):
+        """
+        Use quoted-printable encoding for the text parts with placeholders.
+
+        Each placeholder is put on an own line between soft line breaks,
+        so it can be found in the serialized message, and is replaced
+        by the quoted-printable encoded value. The lines of the part
+        stay within the limit of RFC 2045, and no 8BITMIME is needed.
+        """
+        markers = self.markers.values()
+        pattern = re.compile('(' + '|'.join(re.escape(marker) for marker in markers) + ')')
+        for part in msg.walk():
+            if part.is_multipart() or part.get_content_maintype() != 'text' or \
+                    part.get_content_disposition() == 'attachment':
+                continue
+
+            text = decode_text(part)
+            if not any(marker in text for marker in markers):
+                continue
+
+            lines = []
+            for i, segment in enumerate(pattern.split(text)):
+                if i % 2 == 1:
+                    # placeholder
+                    lines.append(f'=\n{segment}=\n')
+                elif len(segment) > 0:
+                    lines.append(quoprimime.body_encode(
+                        segment.encode('utf-8').decode('latin-1'), eol='\n'))
+
+            del part['Content-Transfer-Encoding']
+            part['Content-Transfer-Encoding'] = 'quoted-printable'
+            part.set_param('charset', 'utf-8')
+            part.set_payload(''.join(lines))
+
+    def _personalize(self, template: MessageTemplate, receiver: str):
+        """
+        Create the message for one receiver.
+        """
+        token = unsubscribe_token(self.config.unsubscribe_secret, receiver)
+        mailto = f'mailto:{self.config.sender_address}?subject=$>unsubscribe'
+        headers = f'List-Unsubscribe: <{mailto}>\r\n'
+        url = mailto
+        if self.config.personalize_url:
+            url = self.config.personalize_url.render(
+                receiver=urllib.parse.quote(receiver, safe='@'), token=token)
+            headers = f'List-Unsubscribe: <{url}>, <{mailto}>\r\n' \
+                'List-Unsubscribe-Post: List-Unsubscribe=One-Click\r\n'
+
+        values = {'receiver': receiver, 'token': token, 'unsubscribe_url': url}
+        return template.render(headers.encode('utf-8'), {
+            name: quoprimime.body_encode(value.encode('utf-8').decode('latin-1'),
+                                         eol='\r\n').encode('ascii')
+            for name, value in values.items()})
+
+    def _serialize(self, msg: EmailMessage, parts: list[RawPart] = ()):
+        """
+        Serialize the message with CRLF line endings.
+
+        Returns bytes, or a MessageSpool if the message is larger
+        than spool_threshold.
+        """
+        with METRICS.timer('serialize'):
+            return self._serialize_file(msg, parts)
+
+    def _serialize_file(self, msg: EmailMessage, parts: list[RawPart] = ()):
+        """
+        Serialize the message into a spooled temporary file.
+
+        Original parts of a RawMessage are copied into the file, so
+        their payload is never held in memory.
+        """
+        threshold = self.config.spool_threshold
+        file = tempfile.SpooledTemporaryFile(max_size=threshold,  # pylint: disable=consider-using-with
+                                             dir=self.config.spool_path)
+        policy = msg.policy.clone(linesep='\r\n')
+        if isinstance(msg, RawMessage):
+            msg.write(file, policy)
+        elif len(parts) > 0:
+            self._write_parts(file, msg, parts, policy)
+        else:
+            BytesGenerator(file, mangle_from_=False, policy=policy).flatten(msg)
+
+        size = file.tell()
+        if size > threshold:
+            logging.debug('Spooling message of %i bytes to disk', size)
+            return MessageSpool(file, size)
+
+        file.seek(0)
+        data = file.read()
+        file.close()
+        return data
+
+    def _write_parts(self, file, msg: MIMEMultipart, parts: list[RawPart], policy):
+        """
+        Write a built message, and add the original parts before
+        its close delimiter.
+        """
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, mangle_from_=False, policy=policy).flatten(msg)
+        data = buffer.getvalue()
+        boundary = msg.get_boundary().encode('ascii')
+        end = data.rfind(b'--' + boundary + b'--')
+        file.write(data[:end])
+        for part in parts:
+            file.write(b'--' + boundary + b'\r\n')
+            part.write(file)
+            file.write(b'\r\n')
+        file.write(data[end:])
+
+    def _rewrite_headers(self, msg: EmailMessage, smtp_sender: str) -> EmailMessage:
+        """
+        Rewrite the headers of an original message for forwarding.
+        """
+        for header in self.raw_drop_headers:
+            del msg[header]
+
+        msg['From'] = smtp_sender
+        # Mention the sender address as receiver, all subscribers are BCC receivers
+        msg['To'] = smtp_sender
+        msg['Sender'] = self.config.sender_address
+        msg['List-Id'] = self.list_id
+        msg['X-Loop'] = self.config.sender_address
+        msg['List-Post'] = f'<mailto:{self.config.sender_address}>'
+        msg['List-Unsubscribe'] = f'<mailto:{self.config.sender_address}?subject=$>unsubscribe>'
+        return msg
+
+    def _build(self, message: Message, smtp_sender: str) -> MIMEMultipart:
+        """
+        Build a new MIME message for the given message.
+        """
         msg = MIMEMultipart()
         msg['Subject'] = message.subject
         msg['From'] = smtp_sender
         # Mention the sender address as receiver, all subscribers are BCC receivers
         msg['To'] = smtp_sender
+        msg['List-Id'] = self.list_id
+        msg['X-Loop'] = self.config.sender_address
 
         if len(message.html) > 0 and len(message.text) > 0:
             # Text and HTML -> alternative representations
@@ -355,6 +1988,13 @@ class Sender:
             msg.attach(MIMEText(message.html, 'html'))
 
         for attachment in message.attachments:
+            if isinstance(attachment.part, RawPart):
+                # copied from the fetched message when serializing
+                continue
+            if attachment.part is not None:
+                # forward the original part without decoding and encoding the payload
+                msg.attach(attachment.part)
+                continue
             maintype, subtype = attachment.mimetype.split('/')
             part = MIMEBase(maintype, subtype)
             part.set_payload(attachment.data)
@@ -363,314 +2003,2867 @@ class Sender:
                             'attachment', filename=attachment.filename)
             msg.attach(part)
 
-        logging.debug('Sending message to %r', message.receivers)
+        return msg
 
-        sender = self.config.sender_address
+    def send_mails(self, messages: list[Message]) -> list[SendResult]:
+        """
+        Send the given messages, using one SMTP session.
+        """
+        if self.outbox is not None:
+            return [self.send_mail(message) for message in messages]
+
+        with self.pool.pinned():
+            return [self.send_mail(message) for message in messages]
+
+    def submit(self, sender: str, receivers: list[str], data) -> SendResult:
+        """
+        Submit the serialized message in batches of smtp_batch_size receivers.
+
+        Batches are sent concurrently, using the worker pool, and
+        the batch results are merged into one SendResult.
+        """
+        size = self.config.smtp_batch_size
+        batches = [receivers[i:i + size]
+                   for i in range(0, len(receivers), size)] or [receivers]
 
-        self._interface_smtplib(sender, message.receivers, msg.as_string())
+        if len(batches) == 1:
+            results = [self._submit_batch(sender, batches[0], data)]
+        else:
+            results = self._executor.map(
+                lambda batch: self._submit_batch(sender, batch, data), batches)
+
+        return self._merge(results)
+
+    def _merge(self, results) -> SendResult:
+        """
+        Merge the results of several submissions.
+        """
+        result = SendResult()
+        for batch_result in results:
+            result.refused.update(batch_result.refused)
+            result.failed += batch_result.failed
+
+        if not result.ok:
+            logging.error('Sending failed for %i receivers, refused: %r',
+                          len(result.failed), result.refused)
+        return result
+
+    def _submit_batch(self, sender: str, receivers: list[str], data) -> SendResult:
+        """
+        Submit the serialized message to one batch of receivers.
+        """
+        result = SendResult()
+        try:
+            with METRICS.timer('submit'):
+                result.refused.update(
+                    self._interface_smtplib(sender, receivers, data))
+        except smtplib.SMTPRecipientsRefused as e:
+            result.refused.update(e.recipients)
+        except (smtplib.SMTPException, OSError) as e:
+            logging.error('Sending to %i receivers failed: %s',
+                          len(receivers), e)
+            METRICS.inc('smtp_errors')
+            result.failed += receivers
+        METRICS.inc('recipients_delivered', len(receivers) - len(result.refused) - len(result.failed))
+        METRICS.inc('recipients_refused', len(result.refused))
+        return result
 
     def _interface_smtplib(self, sender, receivers, message):
         """
         Encapsulate calls to smtplib.
         """
-        smtp = smtplib.SMTP(self.config.smtp_server,
-                            port=self.config.smtp_port)
-        if self.config.smtp_tls:
-            smtp.starttls()
-        if len(self.config.smtp_user) > 0:
-            smtp.login(self.config.smtp_user,
-                       self.config.smtp_password)
-        smtp.sendmail(sender, receivers, message)
-        smtp.quit()
+        return self.pool.sendmail(sender, receivers, message)
+
+    def keepalive(self):
+        """
+        Keep the idle SMTP sessions alive.
+        """
+        self.pool.keepalive()
+
+    def close(self):
+        """
+        Close all SMTP sessions.
+        """
+        if self._own_executor:
+            self._executor.shutdown()
+        self.pool.close()
 
 
-class Subscribers:
+class Outbox:
     """
-    Subscribers manage the maillist subscribers.
+    Outbox is a crash-safe spool for outgoing messages.
+
+    Each entry consists of two files in the outbox folder: <id>.eml,
+    the serialized message, and <id>.json, the sender, the receivers
+    and the retry state. Both are written to a temporary file and
+    renamed, and the JSON file is written last, so only complete
+    entries are delivered. Failed deliveries are retried with
+    exponential backoff, and moved to the failed folder after
+    outbox_retries attempts.
     """
 
     def __init__(self, config: Config, sender: Sender):
         self.config = config
         self.sender = sender
-        self._get_list()
+        self.path = config.outbox_path
+        self.failed_path = os.path.join(self.path, 'failed')
+        self._wakeup = threading.Event()
+        self._thread = None
+        os.makedirs(self.failed_path, exist_ok=True)
+        self._cleanup()
+        METRICS.register(('outbox', self.path), 'backlog',
+                         lambda: [({'stage': 'outbox', 'path': self.path}, len(self._entries()))])
+
+    def _cleanup(self):
+        """
+        Remove incomplete entries left over by a crash.
+        """
+        for name in os.listdir(self.path):
+            base, ext = os.path.splitext(name)
+            incomplete = ext == '.tmp' or (
+                ext == '.eml' and not exists(os.path.join(self.path, base + '.json')))
+            if incomplete:
+                logging.warning('Removing incomplete outbox file %s', name)
+                os.remove(os.path.join(self.path, name))
+
+    def _write_meta(self, entry_id: str, meta: dict):
+        """
+        Write the metadata of an entry.
+        """
+        write_file_atomic(os.path.join(self.path, entry_id + '.json'),
+                          json.dumps(meta).encode('utf-8'))
 
-    def _get_list(self):
+    def put(self, sender: str, receivers: list[str], data) -> str:
         """
-        Read maillist from JSON file.
+        Add a serialized message to the outbox.
         """
-        if exists(self.config.maillist_file):
-            with open(self.config.maillist_file, 'r', encoding='utf-8') as file:
-                self._list = json.load(file)
-            logging.info('Loading existing list.')
-        else:
-            self._list = {'subscribers': []}
-            self._save_list()
+        entry_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif isinstance(data, MessageSpool):
+            data = data.chunks()
+
+        write_file_atomic(os.path.join(self.path, entry_id + '.eml'), data)
+        self._write_meta(entry_id, {'sender': sender,
+                                    'receivers': receivers,
+                                    'attempts': 0,
+                                    'next_try': 0})
+        logging.debug('Queued outbox entry %s for %i receivers',
+                      entry_id, len(receivers))
+
+        self._wakeup.set()
+        return entry_id
+
+    def _entries(self) -> list[str]:
+        """
+        Get the ids of all complete entries, oldest first.
+        """
+        return sorted(name[:-5] for name in os.listdir(self.path)
+                      if name.endswith('.json'))
 
-        logging.debug('Subscribers: %r', self._list)
+    def _remove(self, entry_id: str):
+        """
+        Remove a delivered entry.
+        """
+        os.remove(os.path.join(self.path, entry_id + '.json'))
+        os.remove(os.path.join(self.path, entry_id + '.eml'))
 
-    def _save_list(self):
+    def deliver(self) -> float:
         """
-        Save the maillist as JSON file.
+        Deliver all due entries.
+
+        Returns the time in seconds until the next retry is due, or None.
         """
-        with open(self.config.maillist_file, 'w', encoding='utf-8') as file:
-            json.dump(self._list, file)
+        now = time.time()
+        due = []
+        next_try = None
+        for entry_id in self._entries():
+            with open(os.path.join(self.path, entry_id + '.json'), 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            if meta['next_try'] <= now:
+                due.append((entry_id, meta))
+            elif next_try is None or meta['next_try'] < next_try:
+                next_try = meta['next_try']
+
+        if len(due) > 0:
+            logging.info('Delivering %i outbox entries ...', len(due))
+            with ThreadPoolExecutor(max_workers=self.config.outbox_workers,
+                                    thread_name_prefix='outbox') as executor:
+                for retry in executor.map(lambda entry: self._deliver_entry(*entry), due):
+                    if retry is not None and (next_try is None or retry < next_try):
+                        next_try = retry
+
+        if next_try is None:
+            return None
+        return max(0, next_try - time.time())
 
-    def _get_key(self, tags: list[str] = None) -> str:
+    def _deliver_entry(self, entry_id: str, meta: dict) -> float:
         """
-        Get key calculates a unique key for the given tags.
+        Deliver one entry.
 
-        If the list is empty, the default key is 'subscribers'.
+        Returns the time of the next retry, or None.
         """
-        if tags is None or len(tags) == 0:
-            return 'subscribers'
+        path = os.path.join(self.path, entry_id + '.eml')
+        if os.path.getsize(path) > self.config.spool_threshold:
+            data = MessageSpool.open(path)
+        else:
+            with open(path, 'rb') as file:
+                data = file.read()
+
+        try:
+            result = self.sender.submit(meta['sender'], meta['receivers'], data)
+            retry = result.failed + [receiver for receiver, (code, _) in result.refused.items()
+                                     if 400 <= code < 500]
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Delivery of outbox entry %s failed: %s', entry_id, e)
+            retry = meta['receivers']
+        finally:
+            if isinstance(data, MessageSpool):
+                data.close()
+
+        if len(retry) == 0:
+            self._remove(entry_id)
+            return None
 
-        lower_tags = [tag.lower() for tag in tags]
-        lower_tags.sort()
-        return '#'.join(lower_tags)
+        meta['receivers'] = retry
+        meta['attempts'] += 1
+        if meta['attempts'] > self.config.outbox_retries:
+            logging.error('Giving up outbox entry %s for %r', entry_id, retry)
+            self._write_meta(entry_id, meta)
+            for ext in ('.eml', '.json'):
+                os.replace(os.path.join(self.path, entry_id + ext),
+                           os.path.join(self.failed_path, entry_id + ext))
+            return None
 
-    def _get_subscribers(self, tags: list[str] = None) -> list[str]:
-        if tags is None or len(tags) == 0:
-            return self._list.get('subscribers', [])
+        delay = self.config.outbox_backoff * 2 ** (meta['attempts'] - 1)
+        meta['next_try'] = time.time() + delay
+        logging.warning('Retrying outbox entry %s for %i receivers in %i seconds',
+                        entry_id, len(retry), delay)
+        self._write_meta(entry_id, meta)
+        return meta['next_try']
 
-        tags_subscribers = self._list.get(self._get_key(tags), [])
-        full_subscribers = self._list.get('subscribers', [])
-        subscribers = tags_subscribers + full_subscribers
+    @property
+    def running(self) -> bool:
+        """
+        True if the delivery thread is running.
+        """
+        return self._thread is not None
 
-        tags_set = set(tags)
-        for key in self._list.keys():
-            key_tags_set = set(key.split('#'))
-            if tags_set.issubset(key_tags_set):
-                subscribers += self._list[key]
+    def start(self):
+        """
+        Start the delivery thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
 
-        # remove duplicates
-        return list(set(subscribers))
+    def _run(self):
+        """
+        Deliver entries until the process ends.
+        """
+        while True:
+            self._wakeup.clear()
+            try:
+                timeout = self.deliver()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Outbox delivery failed')
+                timeout = self.config.outbox_backoff
+            self._wakeup.wait(timeout)
 
-    def _is_allowed(self, sender: str, tags: list[str] = None) -> bool:
-        if sender in self._list['subscribers']:
-            return True
 
-        tag_scope = None
-        for key in self._list.keys():
-            if sender in self._list[key]:
-                key_scope = set(key.split('#'))
-                if tag_scope is None:
-                    tag_scope = key_scope
-                elif key_scope.issubset(tag_scope):
-                    tag_scope = key_scope
+class SubscriberTable(dict):
+    """
+    SubscriberTable maps scope keys to lists of subscriber addresses.
+
+    It maintains an index from each tag to the scope keys containing
+    the tag, the tag set of each scope key, and an index from each
+    address to the scope keys it is subscribed to, so that scopes and
+    permissions can be resolved without walking all keys. The indexes
+    are updated when keys are assigned or deleted, and by add and
+    remove. Address lists must not be changed in place.
+    """
 
-        if tag_scope is None:
-            return False
+    def __init__(self, data: dict = None):
+        super().__init__()
+        self._key_tags: dict[str, frozenset] = {}
+        self._tag_index: dict[str, set[str]] = {}
+        self._address_index: dict[str, set[str]] = {}
+        for key, addresses in (data or {}).items():
+            self[key] = addresses
+
+    def __setitem__(self, key: str, addresses: list[str]):
+        if key in self._key_tags:
+            self._unindex_addresses(key)
         else:
-            return set(tags).issuperset(tag_scope)
+            tags = frozenset(key.split('#'))
+            self._key_tags[key] = tags
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+        super().__setitem__(key, addresses)
+        for address in addresses:
+            self._address_index.setdefault(address, set()).add(key)
+
+    def __delitem__(self, key: str):
+        self._unindex_addresses(key)
+        super().__delitem__(key)
+        for tag in self._key_tags.pop(key):
+            keys = self._tag_index[tag]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._tag_index[tag]
+
+    def _unindex_addresses(self, key: str):
+        """
+        Remove the addresses of the given key from the address index.
+        """
+        for address in self[key]:
+            self._unindex_address(key, address)
 
-    def _get_tags(self, subject: str) -> list[str]:
-        tags = []
-        for part in subject.strip().split(' '):
-            part = part.strip()
-            if part.startswith('#') and len(part) > 1:
-                tag = part[1:]
-                if '#' in tag:
-                    tags += tag.split('#')
-                else:
-                    tags.append(tag)
+    def _unindex_address(self, key: str, address: str):
+        """
+        Remove one subscription from the address index.
+        """
+        keys = self._address_index.get(address)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._address_index[address]
 
-        if len(tags) == 0:
-            return None
-        return tags
+    def add(self, key: str, address: str) -> bool:
+        """
+        Add the address to the given scope key.
 
-    def check(self, subject: str, sender: str) -> SubscriberCheckResult:
+        Returns False if the address was already subscribed.
         """
-        Check if mail is valid, process commands, and get
-        all receivers for the given subject and sender.
+        if key in self.scopes_of(address):
+            return False
+        if key not in self:
+            self[key] = []
+        super().__getitem__(key).append(address)
+        self._address_index.setdefault(address, set()).add(key)
+        return True
+
+    def remove(self, key: str, address: str) -> bool:
         """
-        tags = self._get_tags(subject)
-        forward = self._handle_command(subject, sender, tags)
+        Remove the address from the given scope key.
 
-        if not forward:
-            return SubscriberCheckResult()
+        Returns False if the address was not subscribed.
+        """
+        if key not in self.scopes_of(address):
+            return False
+        super().__getitem__(key).remove(address)
+        self._unindex_address(key, address)
+        return True
 
-        if self._is_allowed(sender, tags):
-            receivers = self._get_subscribers(tags).copy()
-            receivers.remove(sender)
+    def scopes_of(self, address: str) -> set[str]:
+        """
+        Get all scope keys the address is subscribed to.
+        """
+        return self._address_index.get(address, set())
 
-            result = SubscriberCheckResult()
-            result.receivers = receivers
-            result.forward = True
-            if tags is not None:
-                result.unsubscribe_tag = '#' + ' #'.join(tags)
-            return result
-        else:
+    def key_tags(self, key: str) -> frozenset:
+        """
+        Get the tag set of the given scope key.
+        """
+        return self._key_tags[key]
+
+    def scopes_with(self, tags: list[str]) -> set[str]:
+        """
+        Get all scope keys containing all of the given tags.
+        """
+        keys = sorted((self._tag_index.get(tag, set()) for tag in set(tags)), key=len)
+        if len(keys) == 0:
+            return set()
+        return keys[0].intersection(*keys[1:])
+
+    def receivers(self, keys: list[str]) -> list[str]:
+        """
+        Get the addresses subscribed to any of the given scope keys.
+        """
+        if len(keys) == 1:
+            return list(self.get(keys[0], []))
+        return list(dict.fromkeys(address for key in keys for address in self.get(key, [])))
+
+    def counts(self) -> dict[str, int]:
+        """
+        Get the number of subscribers per scope key.
+        """
+        return {key: len(addresses) for key, addresses in list(self.items())}
+
+
+class JsonStorage:
+    """
+    JsonStorage keeps the subscriber list in the maillist JSON file.
+
+    Every change rewrites the whole file.
+    """
+
+    def __init__(self, config: Config):
+        self.path = config.maillist_file
+
+    def load(self) -> dict:
+        """
+        Read the subscriber list, or None if there is none.
+        """
+        if not exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save(self, data: dict):
+        """
+        Write the complete subscriber list.
+        """
+        write_file_atomic(self.path, json.dumps(data).encode('utf-8'))
+
+    def apply(self, data: dict, changes: list[tuple[str, str, str]]):
+        """
+        Persist changes, given as (operation, key, address) tuples
+        with operation 'add' or 'remove', of the subscriber list data.
+        """
+        if len(changes) > 0:
+            self.save(data)
+
+
+class JournalStorage(JsonStorage):
+    """
+    JournalStorage appends changes to a journal next to the maillist JSON file.
+
+    The maillist JSON file is the snapshot. Each change is appended as
+    one JSON record to the journal and synced to disk. On startup the
+    journal is replayed over the snapshot. After storage_compact_after
+    changes, and after a replay, a new snapshot is written atomically
+    and the journal is truncated. Replaying a record is idempotent, so
+    a crash between both steps loses nothing.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.journal_path = os.path.splitext(self.path)[0] + '.journal'
+        self.compact_after = config.storage_compact_after
+        self._records = 0
+        self._journal = None
+
+    def _replay(self, data: dict, record: dict):
+        """
+        Apply one journal record to the subscriber list data.
+        """
+        addresses = data.setdefault(record['key'], [])
+        if record['op'] == 'add':
+            if record['address'] not in addresses:
+                addresses.append(record['address'])
+        elif record['address'] in addresses:
+            addresses.remove(record['address'])
+
+    def load(self) -> dict:
+        """
+        Read the snapshot and replay the journal.
+        """
+        data = super().load()
+        if not exists(self.journal_path):
+            return data
+
+        records = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning('Ignoring incomplete journal record %r', line)
+                    break
+                if data is None:
+                    data = {'subscribers': []}
+                self._replay(data, record)
+                records += 1
+
+        if records > 0:
+            logging.info('Replayed %i journal records', records)
+            self.save(data)
+        return data
+
+    def save(self, data: dict):
+        """
+        Write a new snapshot and truncate the journal.
+        """
+        super().save(data)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        with open(self.journal_path, 'wb') as file:
+            os.fsync(file.fileno())
+        self._records = 0
+
+    def apply(self, data: dict, changes: list[tuple[str, str, str]]):
+        """
+        Append changes, given as (operation, key, address) tuples
+        with operation 'add' or 'remove', to the journal.
+        """
+        if len(changes) == 0:
+            return
+
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')  # pylint: disable=consider-using-with
+        self._journal.write(''.join(
+            json.dumps({'op': operation, 'key': key, 'address': address}) + '\n'
+            for operation, key, address in changes).encode('utf-8'))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+        self._records += len(changes)
+        if self._records >= self.compact_after:
+            logging.info('Compacting journal after %i changes', self._records)
+            self.save(data)
+
+
+class SqliteStorage:
+    """
+    SqliteStorage keeps the subscriber list in an SQLite database.
+
+    Subscriptions are rows of an indexed (scope, address) table, so a
+    change costs one row update instead of a rewrite of the list, and
+    the known scopes, including empty ones, are rows of a scopes table.
+    The database uses WAL mode. An existing maillist JSON file is
+    imported once, when the database is created.
+
+    The subscriber list is not loaded into memory: table() returns a
+    SqliteSubscriberTable, which runs all lookups as indexed queries.
+    The connection may be used from several threads, e.g. the worker
+    threads of the asyncio engine, and is guarded by a lock.
+    """
+
+    def __init__(self, config: Config):
+        self.path = config.database_file
+        self.json_path = config.maillist_file
+        self._lock = threading.RLock()
+        self._db = self._interface_sqlite()
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS subscriptions ('
+                             'scope TEXT NOT NULL, address TEXT NOT NULL, '
+                             'PRIMARY KEY (scope, address))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS subscriptions_address '
+                             'ON subscriptions (address)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS scopes (scope TEXT PRIMARY KEY)')
+            self._db.execute('INSERT OR IGNORE INTO scopes (scope) '
+                             'SELECT DISTINCT scope FROM subscriptions')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                             'name TEXT PRIMARY KEY, value TEXT)')
+
+    def _interface_sqlite(self) -> sqlite3.Connection:
+        """
+        Encapsulate calls to sqlite3.
+        """
+        # used from the worker threads of the asyncio engine, guarded by the lock
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _check_migrated(self):
+        """
+        Import the maillist JSON file, if not done yet.
+        """
+        migrated = self._db.execute(
+            "SELECT value FROM meta WHERE name = 'migrated'").fetchone()
+        if migrated is None:
+            self._migrate()
+
+    def _migrate(self):
+        """
+        Import the maillist JSON file, if there is one.
+        """
+        data = None
+        if exists(self.json_path):
+            with open(self.json_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            logging.info('Migrating %s to %s', self.json_path, self.path)
+
+        with self._db:
+            if data is not None:
+                self._db.executemany('INSERT OR IGNORE INTO scopes (scope) VALUES (?)',
+                                     [(key,) for key in data])
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO subscriptions (scope, address) VALUES (?, ?)',
+                    [(key, address) for key, addresses in data.items()
+                     for address in addresses])
+            self._db.execute("INSERT OR IGNORE INTO scopes (scope) VALUES ('subscribers')")
+            self._db.execute("INSERT INTO meta (name, value) VALUES ('migrated', ?)",
+                             (self.json_path,))
+
+    def load(self) -> dict:
+        """
+        Read the subscriber list, or None if there is none.
+        """
+        with self._lock:
+            self._check_migrated()
+            data = {scope: [] for scope, in self._db.execute(
+                'SELECT scope FROM scopes ORDER BY rowid')}
+            for scope, address in self._db.execute(
+                    'SELECT scope, address FROM subscriptions ORDER BY rowid'):
+                data.setdefault(scope, []).append(address)
+        if len(data) == 0:
+            return None
+        return data
+
+    def table(self) -> 'SqliteSubscriberTable':
+        """
+        Get the subscriber table backed by the database.
+        """
+        with self._lock:
+            self._check_migrated()
+        return SqliteSubscriberTable(self)
+
+    def save(self, data: dict):
+        """
+        Write the complete subscriber list.
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM subscriptions')
+            self._db.execute('DELETE FROM scopes')
+            self._db.executemany('INSERT OR IGNORE INTO scopes (scope) VALUES (?)',
+                                 [(key,) for key in data])
+            self._db.executemany(
+                'INSERT OR IGNORE INTO subscriptions (scope, address) VALUES (?, ?)',
+                [(key, address) for key, addresses in data.items()
+                 for address in addresses])
+
+    def apply(self, data, changes: list[tuple[str, str, str]]):
+        """
+        Persist changes, given as (operation, key, address) tuples
+        with operation 'add' or 'remove', in one transaction.
+
+        Changes already made through the SqliteSubscriberTable are
+        part of the open transaction, and are committed here.
+        """
+        with self._lock, self._db:
+            for operation, key, address in changes:
+                if operation == 'add':
+                    self._add(key, address)
+                else:
+                    self._remove(key, address)
+
+    def _subscribed(self, scope: str, address: str) -> bool:
+        """
+        True if the address is subscribed to the scope.
+        """
+        return self._db.execute(
+            'SELECT 1 FROM subscriptions WHERE scope = ? AND address = ?',
+            (scope, address)).fetchone() is not None
+
+    def _add(self, scope: str, address: str) -> bool:
+        """
+        Insert a subscription, without committing.
+        """
+        # only write statements open a transaction, so a no-op leaves none open
+        if self._subscribed(scope, address):
+            return False
+        self._db.execute('INSERT OR IGNORE INTO scopes (scope) VALUES (?)', (scope,))
+        self._db.execute('INSERT INTO subscriptions (scope, address) VALUES (?, ?)',
+                         (scope, address))
+        return True
+
+    def _remove(self, scope: str, address: str) -> bool:
+        """
+        Delete a subscription, without committing.
+        """
+        if not self._subscribed(scope, address):
+            return False
+        self._db.execute('DELETE FROM subscriptions WHERE scope = ? AND address = ?',
+                         (scope, address))
+        return True
+
+    def add(self, scope: str, address: str) -> bool:
+        """
+        Add a subscription. It is committed by the next apply.
+
+        Returns False if the address was already subscribed.
+        """
+        with self._lock:
+            return self._add(scope, address)
+
+    def remove(self, scope: str, address: str) -> bool:
+        """
+        Remove a subscription. It is committed by the next apply.
+
+        Returns False if the address was not subscribed.
+        """
+        with self._lock:
+            return self._remove(scope, address)
+
+    def scopes(self) -> list[str]:
+        """
+        Get all known scopes.
+        """
+        with self._lock:
+            return [scope for scope, in self._db.execute(
+                'SELECT scope FROM scopes ORDER BY rowid')]
+
+    def scopes_of(self, address: str) -> set[str]:
+        """
+        Get the scopes the address is subscribed to, using the address index.
+        """
+        with self._lock:
+            return {scope for scope, in self._db.execute(
+                'SELECT scope FROM subscriptions WHERE address = ?', (address,))}
+
+    def receivers(self, scopes: list[str]) -> list[str]:
+        """
+        Get the addresses subscribed to any of the given scopes.
+        """
+        with self._lock:
+            if len(scopes) == 1:
+                rows = self._db.execute(
+                    'SELECT address FROM subscriptions WHERE scope = ? ORDER BY rowid',
+                    (scopes[0],))
+            else:
+                rows = self._db.execute(
+                    'SELECT DISTINCT address FROM subscriptions WHERE scope IN '
+                    f'({", ".join("?" * len(scopes))})', list(scopes))
+            return [address for address, in rows]
+
+    def counts(self) -> dict[str, int]:
+        """
+        Get the number of subscribers per scope.
+        """
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT scopes.scope, COUNT(address) FROM scopes LEFT JOIN subscriptions '
+                'ON scopes.scope = subscriptions.scope GROUP BY scopes.scope'))
+
+
+class SqliteSubscriberTable:
+    """
+    SqliteSubscriberTable is the SubscriberTable of the SQLite storage.
+
+    It has the interface of SubscriberTable, but only the scope keys
+    and their tag index are kept in memory, and the addresses are looked
+    up with indexed queries, so the list doesn't need to fit into memory.
+    """
+
+    def __init__(self, storage: SqliteStorage):
+        self._storage = storage
+        self._scopes = {}
+        self._tag_index: dict[str, set[str]] = {}
+        for key in storage.scopes():
+            self._add_scope(key)
+
+    def _add_scope(self, key: str):
+        """
+        Remember a scope key, and index its tags.
+        """
+        if key in self._scopes:
+            return
+        self._scopes[key] = None
+        for tag in self.key_tags(key):
+            self._tag_index.setdefault(tag, set()).add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._scopes
+
+    def __iter__(self):
+        return iter(list(self._scopes))
+
+    def __len__(self) -> int:
+        return len(self._scopes)
+
+    def __getitem__(self, key: str) -> list[str]:
+        if key not in self._scopes:
+            raise KeyError(key)
+        return self._storage.receivers([key])
+
+    def keys(self) -> list[str]:
+        """
+        Get all scope keys.
+        """
+        return list(self._scopes)
+
+    def get(self, key: str, default=None) -> list[str]:
+        """
+        Get the addresses of the scope key, or the default.
+        """
+        if key not in self._scopes:
+            return default
+        return self[key]
+
+    def items(self) -> list[tuple[str, list[str]]]:
+        """
+        Get all scope keys with their addresses.
+        """
+        return [(key, self[key]) for key in self.keys()]
+
+    def add(self, key: str, address: str) -> bool:
+        """
+        Add the address to the given scope key.
+
+        Returns False if the address was already subscribed.
+        """
+        self._add_scope(key)
+        return self._storage.add(key, address)
+
+    def remove(self, key: str, address: str) -> bool:
+        """
+        Remove the address from the given scope key.
+
+        Returns False if the address was not subscribed.
+        """
+        return self._storage.remove(key, address)
+
+    def scopes_of(self, address: str) -> set[str]:
+        """
+        Get all scope keys the address is subscribed to.
+        """
+        return self._storage.scopes_of(address)
+
+    def key_tags(self, key: str) -> frozenset:
+        """
+        Get the tag set of the given scope key.
+        """
+        return frozenset(key.split('#'))
+
+    def scopes_with(self, tags: list[str]) -> set[str]:
+        """
+        Get all scope keys containing all of the given tags.
+        """
+        keys = sorted((self._tag_index.get(tag, set()) for tag in set(tags)), key=len)
+        if len(keys) == 0:
+            return set()
+        return keys[0].intersection(*keys[1:])
+
+    def receivers(self, keys: list[str]) -> list[str]:
+        """
+        Get the addresses subscribed to any of the given scope keys.
+        """
+        return self._storage.receivers(keys)
+
+    def counts(self) -> dict[str, int]:
+        """
+        Get the number of subscribers per scope key.
+        """
+        return self._storage.counts()
+
+
+class Subscribers:
+    """
+    Subscribers manage the maillist subscribers.
+    """
+
+    def __init__(self, config: Config, sender: Sender):
+        self.config = config
+        self.sender = sender
+        self._storage = self._get_storage()
+        self._changes = None
+        self._confirmations = None
+        self._get_list()
+        METRICS.register(('subscribers', config.maillist_file), 'subscribers',
+                         self._count_subscribers)
+
+    def _count_subscribers(self) -> list[tuple[dict, int]]:
+        """
+        Get the number of subscribers per scope, for the metrics.
+        """
+        return [({'list': self.config.list_name, 'scope': key}, count)
+                for key, count in self._list.counts().items()]
+
+    def _get_storage(self):
+        """
+        Get the configured storage backend.
+        """
+        if self.config.storage_backend == 'sqlite':
+            return SqliteStorage(self.config)
+        if self.config.storage_backend == 'journal':
+            return JournalStorage(self.config)
+        return JsonStorage(self.config)
+
+    def _get_list(self):
+        """
+        Read maillist from the storage.
+
+        The SQLite storage is queried directly, instead of loading
+        the list into memory.
+        """
+        if isinstance(self._storage, SqliteStorage):
+            self._list = self._storage.table()
+            logging.info('Using subscriber list of %s.', self._storage.path)
+            return
+
+        data = self._storage.load()
+        if data is not None:
+            self._list = SubscriberTable(data)
+            logging.info('Loading existing list.')
+        else:
+            self._list = SubscriberTable({'subscribers': []})
+            self._save_list()
+
+        logging.debug('Subscribers: %r', self._list)
+
+    def _save_list(self):
+        """
+        Save the complete maillist.
+        """
+        self._storage.save(self._list)
+
+    def _save_changes(self, changes: list[tuple[str, str, str]]):
+        """
+        Save the given changes of the maillist.
+
+        Inside a transaction, the changes are saved at its end.
+        """
+        if self._changes is not None:
+            self._changes += changes
+        else:
+            self._storage.apply(self._list, changes)
+
+    def _send_confirmation(self, message: Message):
+        """
+        Send a subscribe or unsubscribe confirmation.
+
+        Inside a transaction, the message is sent at its end.
+        """
+        if self._confirmations is not None:
+            self._confirmations.append(message)
+        else:
+            self.sender.send_mail(message)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager to process several commands as one transaction.
+
+        All changes of the maillist are saved together, and all
+        confirmation mails are sent as one batch, at the end.
+        """
+        self._changes = []
+        self._confirmations = []
+        try:
+            yield
+        finally:
+            changes = self._changes
+            confirmations = self._confirmations
+            self._changes = None
+            self._confirmations = None
+
+            if len(changes) > 0:
+                logging.info('Saving %i subscriber changes', len(changes))
+                self._storage.apply(self._list, changes)
+            if len(confirmations) > 0:
+                logging.info('Sending %i confirmations', len(confirmations))
+                self.sender.send_mails(confirmations)
+
+    def _get_key(self, tags: list[str] = None) -> str:
+        """
+        Get key calculates a unique key for the given tags.
+
+        If the list is empty, the default key is 'subscribers'.
+        """
+        if tags is None or len(tags) == 0:
+            return 'subscribers'
+
+        lower_tags = [tag.lower() for tag in tags]
+        lower_tags.sort()
+        return '#'.join(lower_tags)
+
+    def _get_subscribers(self, tags: list[str] = None) -> list[str]:
+        if tags is None or len(tags) == 0:
+            return self._list.receivers(['subscribers'])
+
+        keys = {'subscribers', self._get_key(tags)}
+        keys.update(self._list.scopes_with(tags))
+        return self._list.receivers(sorted(keys))
+
+    def _is_allowed(self, sender: str, tags: list[str] = None) -> bool:
+        scopes = self._list.scopes_of(sender)
+        if 'subscribers' in scopes:
+            return True
+
+        tags_set = set(tags or [])
+        return any(self._list.key_tags(key).issubset(tags_set) for key in scopes)
+
+    def _get_tags(self, subject: str) -> list[str]:
+        tags = []
+        for part in subject.strip().split(' '):
+            part = part.strip()
+            if part.startswith('#') and len(part) > 1:
+                tag = part[1:]
+                if '#' in tag:
+                    tags += tag.split('#')
+                else:
+                    tags.append(tag)
+
+        if len(tags) == 0:
+            return None
+        return tags
+
+    def check(self, subject: str, sender: str) -> SubscriberCheckResult:
+        """
+        Check if mail is valid, process commands, and get
+        all receivers for the given subject and sender.
+        """
+        tags = self._get_tags(subject)
+        forward = self._handle_command(subject, sender, tags)
+
+        if not forward:
+            return SubscriberCheckResult()
+
+        if self._is_allowed(sender, tags):
+            receivers = [receiver for receiver in self._get_subscribers(tags)
+                         if receiver != sender]
+
+            result = SubscriberCheckResult()
+            result.receivers = receivers
+            result.forward = True
+            result.scope = self._get_key(tags)
+            if tags is not None:
+                result.unsubscribe_tag = '#' + ' #'.join(tags)
+            return result
+        else:
             logging.warning(
                 'sender %s tried to send %s, but is no subscriber', sender, subject)
+            METRICS.inc('rejections')
 
         return SubscriberCheckResult()
 
     def _handle_command(self, subject: str, sender: str, tags: list[str] = None) -> bool:
         """
-        Process subscribe and unsubscribe commands.
+        Process subscribe and unsubscribe commands.
+        """
+        forward = True
+        sub = subject.strip()
+        if sub.startswith('$>'):
+            # do not forward command messages
+            forward = False
+            METRICS.inc('commands')
+            command = sub[2:]
+            if command.lower().startswith('subscribe'):
+                self._add_subscriber(sender, tags)
+            elif command.lower().startswith('unsubscribe'):
+                self._remove_subscriber(sender, tags)
+
+        return forward
+
+    def _add_subscriber(self, address, tags: list[str] = None):
+        """
+        Add a new subscriber for the given tags.
+
+        If tags are None, all messages are forwarded to the subscriber.
+        """
+        logging.info('New subscriber: %s', address)
+
+        key = self._get_key(tags)
+
+        if self._list.add(key, address):
+            self._save_changes([('add', key, address)])
+            logging.info('added %s to subscriber list %r', address, key)
+
+        message = Message()
+        message.subject = self.config.subscribe_subject
+        message.text = self.config.subscribe_text
+        message.html = self.config.subscribe_html
+        message.receivers = [address]
+
+        self._send_confirmation(message)
+
+    def _remove_subscriber(self, address, tags: list[str] = None):
+        """
+        Remove a subscriber for the given tags.
+
+        If tags are None, the subscriber is removed from the global list.
+        """
+        logging.info('User canceled subscription: %s', address)
+
+        if tags is None:
+            keys = list(self._list.scopes_of(address))
+        else:
+            keys = [self._get_key(tags)]
+
+        changes = []
+        for key in keys:
+            if self._list.remove(key, address):
+                changes.append(('remove', key, address))
+                logging.info('removed %s from subscriber list %r', address, key)
+        self._save_changes(changes)
+
+        message = Message()
+        message.subject = self.config.unsubscribe_subject
+        message.text = self.config.unsubscribe_text
+        message.html = self.config.unsubscribe_html
+        message.receivers = [address]
+
+        self._send_confirmation(message)
+
+
+class MailboxPool:
+    """
+    MailboxPool shares mailbox sessions between hosted lists.
+
+    Lists using the same server and credentials share one logged-in
+    session, and the folder of the list is selected when the list
+    gets the session.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._folders = {}
+
+    def _interface_imap(self, config: Config) -> MailBox:
+        """
+        Encapsulate calls to imap_tools.
+        """
+        return open_mailbox(config).login(
+            config.mailbox_user,
+            config.mailbox_password,
+            initial_folder=None)
+
+    def _key(self, config: Config) -> tuple:
+        """
+        Get the key of the session for the given list.
+        """
+        return (config.mailbox_server, config.mailbox_user, config.mailbox_password)
+
+    def get(self, config: Config) -> MailBox:
+        """
+        Get the session for the given list, login if needed.
+        """
+        key = self._key(config)
+        mailbox = self._sessions.get(key)
+        if mailbox is None:
+            logging.info('Opening shared mailbox session for %s.', config.mailbox_user)
+            mailbox = self._sessions[key] = self._interface_imap(config)
+            self._folders[key] = None
+        if self._folders[key] != config.mailbox_folder:
+            mailbox.folder.set(config.mailbox_folder)
+            self._folders[key] = config.mailbox_folder
+        return mailbox
+
+    def drop(self, config: Config):
+        """
+        Drop the session of the given list.
+        """
+        key = self._key(config)
+        mailbox = self._sessions.pop(key, None)
+        self._folders.pop(key, None)
+        if mailbox is None:
+            return
+        try:
+            mailbox.logout()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def close(self):
+        """
+        Logout all sessions.
+        """
+        for mailbox in self._sessions.values():
+            try:
+                mailbox.logout()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        self._sessions = {}
+        self._folders = {}
+
+
+class TokenBucket:
+    """
+    TokenBucket allows rate mails per hour, with bursts of burst mails.
+    """
+
+    def __init__(self, rate: int, burst: int, now: float):
+        self.rate = rate / 3600
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float):
+        """
+        Add the tokens earned since the last update.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        """
+        Take one token, if available.
+        """
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    RateLimiter keeps the token buckets per sender and per scope.
+
+    A rate of 0 disables the limit. Full buckets are dropped when
+    there are more than max_buckets, since they are equal to new ones.
+    """
+
+    max_buckets = 10000
+
+    def __init__(self, config: Config):
+        self.limits = {'sender': (config.limit_sender_rate, config.limit_sender_burst),
+                       'scope': (config.limit_scope_rate, config.limit_scope_burst)}
+        self._buckets = {}
+
+    def allow(self, kind: str, key: str) -> bool:
+        """
+        Take a token from the bucket of the sender or scope.
+        """
+        rate, burst = self.limits[kind]
+        if rate == 0:
+            return True
+        now = monotonic()
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[(kind, key)] = TokenBucket(rate, burst, now)
+        return bucket.take(now)
+
+    def refund(self, kind: str, key: str):
+        """
+        Give back a token taken by allow, for a mail which was not sent.
+        """
+        bucket = self._buckets.get((kind, key))
+        if bucket is not None:
+            bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+
+    def _prune(self, now: float):
+        """
+        Drop the full buckets.
+        """
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+
+class DedupeStore:
+    """
+    DedupeStore remembers the forwarded posts, to drop duplicates.
+
+    Posts are keyed by their Message-ID, or by a hash of the sender,
+    subject, date and size if they have no Message-ID. The store file
+    next to the maillist JSON file holds fixed size DEDUPE_RECORDs,
+    and new records are appended after each page. Records older than
+    dedupe_ttl seconds are evicted, at most dedupe_max_entries records
+    are kept, and the file is rewritten when it holds twice as many
+    records as live entries.
+
+    A post is reserved while it is forwarded, and added only when it
+    was sent, so a failed post is not dropped when it is delivered again.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = config.dedupe_file
+        # oldest first, so eviction pops from the front in constant time
+        self._entries = collections.OrderedDict()
+        self._reserved = set()
+        self._pending = []
+        self._records = 0
+        self._load()
+
+    @staticmethod
+    def key(msg) -> bytes:
+        """
+        Get the digest of the Message-ID, or of the content headers.
+        """
+        message_id = msg.headers.get('message-id', ('',))[0].strip()
+        if message_id:
+            key = 'id:' + message_id
+        else:
+            key = f'hash:{msg.from_}\0{msg.subject}\0{msg.date_str}\0{msg.size_rfc822}'
+        return hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+
+    def _load(self):
+        """
+        Read the store file, and drop expired records.
+        """
+        if not exists(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        complete = len(data) - len(data) % DEDUPE_RECORD.size
+        if complete < len(data):
+            logging.warning('Ignoring incomplete dedupe record')
+        for digest, seen in DEDUPE_RECORD.iter_unpack(data[:complete]):
+            self._entries[digest] = seen
+            self._entries.move_to_end(digest)
+        self._records = complete // DEDUPE_RECORD.size
+        self._evict(time.time())
+        logging.debug('%i dedupe entries', len(self._entries))
+        if complete < len(data) or self._records > 2 * len(self._entries):
+            self._compact()
+
+    def _evict(self, now: float):
+        """
+        Drop the expired and the oldest entries over the limit.
+        """
+        expired = now - self.config.dedupe_ttl
+        while len(self._entries) > 0:
+            seen = next(iter(self._entries.values()))
+            if seen >= expired and len(self._entries) <= self.config.dedupe_max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def seen(self, digest: bytes) -> bool:
+        """
+        True if a post with this digest was forwarded within the TTL,
+        or is being forwarded.
+        """
+        if digest in self._reserved:
+            return True
+        seen = self._entries.get(digest)
+        return seen is not None and seen >= time.time() - self.config.dedupe_ttl
+
+    def reserve(self, digest: bytes):
+        """
+        Mark a post as being forwarded, until it is added or released.
+        """
+        self._reserved.add(digest)
+
+    def release(self):
+        """
+        Forget the reserved posts which were not added.
+        """
+        self._reserved.clear()
+
+    def add(self, digest: bytes):
+        """
+        Remember a forwarded post, written to the file by flush.
+        """
+        self._reserved.discard(digest)
+        now = int(time.time())
+        self._entries[digest] = now
+        self._entries.move_to_end(digest)
+        self._pending.append(DEDUPE_RECORD.pack(digest, now))
+        self._evict(now)
+
+    def flush(self):
+        """
+        Append the new records to the file, or rewrite it if too many
+        records were evicted.
+        """
+        if len(self._pending) == 0:
+            return
+        if self._records + len(self._pending) > 2 * len(self._entries):
+            self._compact()
+            return
+        with open(self.path, 'ab') as file:
+            file.write(b''.join(self._pending))
+            file.flush()
+            os.fsync(file.fileno())
+        self._records += len(self._pending)
+        self._pending = []
+
+    def _compact(self):
+        """
+        Rewrite the file with the live entries.
+        """
+        write_file_atomic(self.path, b''.join(DEDUPE_RECORD.pack(digest, seen)
+                                              for digest, seen in self._entries.items()))
+        self._records = len(self._entries)
+        self._pending = []
+
+
+class Receiver:
+    """
+    The receiver takes care of checking for incoming messages.
+    """
+
+    def __init__(self, config: Config, subscribers: Subscribers, sender: Sender,
+                 mailboxes: MailboxPool = None):
+        self.config = config
+        self.subscribers = subscribers
+        self.sender = sender
+        self.mailboxes = mailboxes
+        self.dedupe = DedupeStore(config) if config.dedupe else None
+        self.limiter = RateLimiter(config)
+        self.list_id = sender.list_id
+        self._mailbox = None
+        self._sync_state = self._load_sync_state()
+        self._footers = functools.lru_cache(maxsize=FOOTER_CACHE_SIZE)(
+            self._render_footers)
+
+    def _load_sync_state(self) -> dict:
+        """
+        Read the UIDVALIDITY, last processed UID and deferred UIDs
+        of the mailbox.
+
+        The deferred UIDs map to the time the mail was deferred first.
+        """
+        if exists(self.config.sync_file):
+            with open(self.config.sync_file, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            logging.debug('sync state: %r', state)
+            deferred = state.get('deferred', {})
+            if isinstance(deferred, list):
+                deferred = {uid: int(time.time()) for uid in deferred}
+            state['deferred'] = deferred
+            return state
+        return {'uidvalidity': None, 'last_uid': 0, 'deferred': {}}
+
+    def _save_sync_state(self):
+        """
+        Save the UIDVALIDITY, last processed UID and deferred UIDs
+        of the mailbox.
+        """
+        write_file_atomic(self.config.sync_file,
+                          json.dumps(self._sync_state).encode('utf-8'))
+
+    def _interface_imap(self) -> MailBox:
+        """
+        Encapsulate calls to imap_tools.
+        """
+        return open_mailbox(self.config).login(
+            self.config.mailbox_user,
+            self.config.mailbox_password,
+            initial_folder=self.config.mailbox_folder)
+
+    def _get_mailbox(self) -> MailBox:
+        """
+        Get the long-lived mailbox session, login if needed.
+        """
+        if self.mailboxes is not None:
+            return self.mailboxes.get(self.config)
+        if self._mailbox is None:
+            logging.info('Opening mailbox session.')
+            self._mailbox = self._interface_imap()
+        return self._mailbox
+
+    def _drop_mailbox(self):
+        """
+        Drop the long-lived mailbox session.
+        """
+        if self.mailboxes is not None:
+            self.mailboxes.drop(self.config)
+            return
+        if self._mailbox is None:
+            return
+        try:
+            self._mailbox.logout()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        self._mailbox = None
+
+    def process_mails(self) -> CycleResult:
+        """
+        Fetch and process all new mails.
+        """
+        logging.info("Processing new messages ...")
+
+        if not self.config.idle and self.mailboxes is None:
+            with self._interface_imap() as mailbox:
+                return self._process_mailbox(mailbox)
+
+        try:
+            return self._process_mailbox(self._get_mailbox())
+        except IMAP_CONNECTION_ERRORS as e:
+            logging.warning('Mailbox session lost (%s), reconnecting.', e)
+            self._drop_mailbox()
+            return self._process_mailbox(self._get_mailbox())
+
+    def _with_deferred(self, uids: list[str], present: list[str]) -> list[str]:
+        """
+        Add the UIDs of the deferred mails to the new mails.
+
+        Deferred mails which are not present in the mailbox anymore
+        are forgotten.
+        """
+        deferred = self._sync_state['deferred']
+        for uid in set(deferred) - set(present):
+            logging.debug('deferred message %s was removed from the mailbox', uid)
+            del deferred[uid]
+        if len(deferred) > 0:
+            logging.debug('%i deferred messages', len(deferred))
+        return sorted(set(uids) | set(deferred), key=int)
+
+    def _limit_uids(self, uids: list[str], resync: bool) -> CycleResult:
+        """
+        Limit the new mails to schedule_max_messages per cycle.
+
+        The UIDs are shortened in place. The limit doesn't apply to a
+        resync, since the last UID is not known until all unseen mails
+        are processed. Deferred mails are not counted as processed, so
+        retrying them doesn't keep the scheduler active.
+        """
+        limit = self.config.schedule_max_messages
+        result = CycleResult()
+        if limit > 0 and not resync and len(uids) > limit:
+            result.remaining = len(uids) - limit
+            del uids[limit:]
+            logging.info('Processing %i new messages, %i left for the next cycle',
+                         limit, result.remaining)
+        deferred = self._sync_state['deferred']
+        result.processed = len([uid for uid in uids if uid not in deferred])
+        return result
+
+    def _process_mailbox(self, mailbox: MailBox) -> CycleResult:
+        """
+        Fetch and process all new mails of the given mailbox.
+
+        The new mails are fetched in pages of mailbox_page_size
+        messages, using one FETCH and one STORE per page.
+
+        For each page, only the headers are fetched first. Commands and
+        permissions are handled using the headers, and the full messages
+        are fetched only for the posts which are forwarded, as raw bytes
+        which are not parsed into a message object.
+
+        The last processed UID is saved after each page, so only messages
+        with higher UIDs, and the deferred messages, are fetched in the
+        next cycle. If the UIDVALIDITY of the mailbox changed, all unseen
+        messages are processed.
+
+        Returns the number of processed and remaining new mails.
+        """
+        status = mailbox.folder.status(options=['UIDVALIDITY', 'UIDNEXT'])
+        resync = status['UIDVALIDITY'] != self._sync_state['uidvalidity']
+        if resync:
+            logging.info('UIDVALIDITY changed to %i, processing all unseen messages',
+                         status['UIDVALIDITY'])
+            uids = mailbox.uids(AND(seen=False))
+            last_uid = status['UIDNEXT'] - 1
+            self._sync_state['deferred'] = {}
+        else:
+            last_uid = self._sync_state['last_uid']
+            deferred = list(self._sync_state['deferred'])
+            uids = self._with_deferred(
+                [uid for uid in mailbox.uids(AND(uid=U(last_uid + 1, '*')))
+                 if int(uid) > last_uid],
+                mailbox.uids(AND(uid=deferred)) if len(deferred) > 0 else [])
+        uids.sort(key=int)
+        logging.debug('%i new messages', len(uids))
+        cycle = self._limit_uids(uids, resync)
+
+        page_size = self.config.mailbox_page_size
+        for i in range(0, len(uids), page_size):
+            METRICS.set('backlog', len(uids) - i, stage='mailbox')
+            page = uids[i:i + page_size]
+            with METRICS.timer('fetch'):
+                headers = list(mailbox.fetch(AND(uid=page), mark_seen=False,
+                                             headers_only=True, bulk=True))
+
+            logging.debug('mark messages %r as seen', page)
+            mailbox.flag(page, [MailMessageFlags.SEEN], True)
+
+            posts = {}
+            with self.subscribers.transaction():
+                for msg in headers:
+                    result = self._triage_message(msg)
+                    if result is not None:
+                        posts[msg.uid] = result
+
+            try:
+                if len(posts) > 0:
+                    for msg, raw in self._fetch_posts(
+                            mailbox, [msg for msg in headers if msg.uid in posts]):
+                        try:
+                            self._process_message(msg, raw, posts[msg.uid])
+                        finally:
+                            raw.close()
+            finally:
+                if self.dedupe is not None:
+                    self.dedupe.release()
+
+            if self.dedupe is not None:
+                self.dedupe.flush()
+            if not resync:
+                self._sync_state['last_uid'] = max(last_uid, int(page[-1]))
+                self._save_sync_state()
+
+        if resync:
+            self._sync_state = {'uidvalidity': status['UIDVALIDITY'],
+                                'last_uid': max([last_uid] + [int(uid) for uid in uids]),
+                                'deferred': self._sync_state['deferred']}
+            self._save_sync_state()
+        METRICS.set('backlog', cycle.remaining, stage='mailbox')
+        return cycle
+
+    def _fetch_posts(self, mailbox: MailBox, msgs: list):
+        """
+        Fetch the full posts, as RawMessage.
+
+        Posts are fetched in batches of at most spool_threshold bytes
+        using one FETCH per batch. Larger posts are fetched in chunks
+        into a spool file, so a post is never held in memory.
+
+        Yields the header only message and the RawMessage.
+        """
+        threshold = self.config.spool_threshold
+        for batch in fetch_batches(msgs, threshold):
+            if batch[0].size_rfc822 > threshold:
+                raw = self._fetch_spooled(mailbox, batch[0].uid)
+                if raw is not None:
+                    yield batch[0], raw
+                continue
+
+            with METRICS.timer('fetch'):
+                literals = self._fetch_raw(mailbox, [msg.uid for msg in batch], '')
+            for msg in batch:
+                if msg.uid in literals:
+                    yield msg, RawMessage(literals.pop(msg.uid))
+
+    def _fetch_spooled(self, mailbox: MailBox, uid: str) -> RawMessage:
+        """
+        Fetch a large post in chunks of spool_threshold bytes into a spool file.
+        """
+        chunk_size = self.config.spool_threshold
+        file = tempfile.TemporaryFile(dir=self.config.spool_path)  # pylint: disable=consider-using-with
+        size = 0
+        while True:
+            with METRICS.timer('fetch'):
+                chunk = self._fetch_raw(mailbox, [uid], f'<{size}.{chunk_size}>').get(uid, b'')
+            file.write(chunk)
+            size += len(chunk)
+            # servers without partial fetch send the full message
+            if len(chunk) != chunk_size:
+                break
+
+        if size == 0:
+            file.close()
+            return None
+        logging.debug('Spooled message %s of %i bytes to disk', uid, size)
+        return RawMessage.open(file)
+
+    def _fetch_raw(self, mailbox: MailBox, uids: list[str], partial: str) -> dict:
+        """
+        Fetch the raw messages, or a range of their bytes, without
+        marking them as seen.
+        """
+        typ, data = mailbox.client.uid('FETCH', ','.join(uids), f'(UID BODY.PEEK[]{partial})')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f'FETCH failed: {data!r}')
+        return fetch_literals(data)
+
+    def wait(self, timeout: int):
+        """
+        Wait until new mails arrive or the timeout expires.
+
+        Uses IMAP IDLE if the server supports it, and NOOP
+        polling otherwise.
+        """
+        timeout = min(timeout, IDLE_MAX_TIMEOUT)
+        try:
+            mailbox = self._get_mailbox()
+            if 'IDLE' in mailbox.client.capabilities:
+                logging.info('Waiting for new mails (IDLE) ...')
+                responses = mailbox.idle.wait(timeout=timeout)
+                logging.debug('IDLE responses: %r', responses)
+            else:
+                logging.info('Waiting for new mails (NOOP) ...')
+                self._poll(mailbox, timeout)
+        except IMAP_CONNECTION_ERRORS as e:
+            logging.warning('Mailbox session lost (%s), reconnecting.', e)
+            self._drop_mailbox()
+            sleep(NOOP_POLL_INTERVAL)
+
+    def _poll(self, mailbox: MailBox, timeout: int):
+        """
+        Poll with NOOP until the server reports new mails.
+        """
+        end = monotonic() + timeout
+        while monotonic() < end:
+            mailbox.client.noop()
+            untagged = mailbox.client.untagged_responses
+            if untagged.pop('EXISTS', None) or untagged.pop('RECENT', None):
+                return
+            sleep(min(NOOP_POLL_INTERVAL, max(0, end - monotonic())))
+
+    def _triage_message(self, msg) -> SubscriberCheckResult:
+        """
+        Handle a new message using only its headers.
+
+        Returns the check result if the message shall be forwarded,
+        or None.
+        """
+        with METRICS.timer('triage'):
+            return self._triage(msg)
+
+    def _triage(self, msg) -> SubscriberCheckResult:
+        """
+        Check the headers of a new message.
+        """
+        logging.info('Processing message %r', msg.uid)
+        METRICS.inc('messages_in')
+        since = self._sync_state['deferred'].pop(msg.uid, None)
+
+        self._log_headers(msg)
+
+        loop = self._check_loop(msg)
+        if loop is not None:
+            logging.warning('message %s from %s is a loop or auto-reply (%s), dropped',
+                            msg.uid, msg.from_, loop)
+            METRICS.inc('loops')
+            return None
+
+        digest = None
+        if self.dedupe is not None:
+            digest = self.dedupe.key(msg)
+            if self.dedupe.seen(digest):
+                logging.warning('message %s from %s is a duplicate, dropped',
+                                msg.uid, msg.from_)
+                METRICS.inc('duplicates')
+                return None
+
+        if not self._check_limit(msg, 'sender', msg.from_.lower(), since):
+            return None
+
+        subject = msg.subject
+        with METRICS.timer('resolve'):
+            result = self.subscribers.check(subject, msg.from_)
+        if not result.forward:
+            logging.debug('message shall be not forwarded')
+            return None
+
+        if not self._check_limit(msg, 'scope', result.scope, since):
+            self.limiter.refund('sender', msg.from_.lower())
+            return None
+
+        if len(result.receivers) == 0:
+            logging.info('no subscribers for %s', subject)
+            self._refund_limits(msg, result.scope)
+            return None
+
+        max_size = self.config.mailbox_max_size
+        if max_size > 0 and msg.size_rfc822 > max_size:
+            logging.warning('message %s from %s is too large (%i bytes), rejected',
+                            msg.uid, msg.from_, msg.size_rfc822)
+            METRICS.inc('rejections')
+            self._refund_limits(msg, result.scope)
+            return None
+
+        if digest is not None:
+            self.dedupe.reserve(digest)
+            result.digest = digest
+        return result
+
+    def _check_loop(self, msg) -> str:
+        """
+        Check the headers for mails sent by this list, or auto-replies.
+
+        Returns the header which identifies the loop, or None.
+        """
+        headers = msg.headers
+        if any(value.strip().lower() == self.config.sender_address.lower()
+               for value in headers.get('x-loop', ())):
+            return 'X-Loop'
+        if any(self.list_id in value for value in headers.get('list-id', ())):
+            return 'List-Id'
+        if any(value.strip().lower() != 'no' for value in headers.get('auto-submitted', ())):
+            return 'Auto-Submitted'
+        if any(value.strip().lower() in self.config.loop_precedence
+               for value in headers.get('precedence', ())):
+            return 'Precedence'
+        return None
+
+    def _check_limit(self, msg, kind: str, key: str, since: int = None) -> bool:
+        """
+        Check the rate limit of the sender or scope.
+
+        A limited message is deferred to a later cycle, or dropped,
+        depending on limit_policy. A deferred message is dropped when it
+        was deferred first longer than limit_defer_max_age ago, or when
+        limit_defer_max_count messages are deferred already.
+        """
+        if self.limiter.allow(kind, key):
+            return True
+        METRICS.inc('rate_limited')
+        now = int(time.time())
+        deferred = self._sync_state['deferred']
+        if self.config.limit_policy == 'defer':
+            if since is not None and now - since > self.config.limit_defer_max_age:
+                logging.warning('message %s from %s was deferred too long, dropped',
+                                msg.uid, msg.from_)
+            elif len(deferred) >= self.config.limit_defer_max_count:
+                logging.warning('message %s from %s exceeds the %s rate limit of %s, '
+                                'too many deferred messages, dropped',
+                                msg.uid, msg.from_, kind, key)
+            else:
+                logging.warning('message %s from %s exceeds the %s rate limit of %s, deferred',
+                                msg.uid, msg.from_, kind, key)
+                deferred[msg.uid] = now if since is None else since
+        else:
+            logging.warning('message %s from %s exceeds the %s rate limit of %s, dropped',
+                            msg.uid, msg.from_, kind, key)
+        return False
+
+    def _refund_limits(self, msg, scope: str):
+        """
+        Give back the sender and scope tokens of a message which is not forwarded.
+        """
+        self.limiter.refund('sender', msg.from_.lower())
+        self.limiter.refund('scope', scope)
+
+    def _process_message(self, msg, raw: RawMessage, result: SubscriberCheckResult):
+        """
+        Forward a new message, given as header only message and RawMessage.
+        """
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self._log_body(raw)
+
+        METRICS.inc('posts_forwarded')
+        with METRICS.timer('render'):
+            message = self._render_message(msg, raw, result)
+        sent = self.sender.send_mail(message)
+        if result.digest is not None and len(sent.failed) == 0:
+            self.dedupe.add(result.digest)
+
+    def _render_message(self, msg, raw: RawMessage, result: SubscriberCheckResult) -> Message:
+        """
+        Create the message to forward, with the footers.
+
+        The attachments are forwarded as RawPart, so their payload is
+        copied when the message is serialized.
+        """
+        message = Message()
+        message.subject = msg.subject
+        message.receivers = list(result.receivers)
+        message.sender_name = msg.from_values.name
+
+        footer_text, footer_html = self._footers(result.unsubscribe_tag)
+
+        if self.config.forward_mode == 'raw':
+            message.raw = raw
+            self._splice_footer(raw, footer_text, footer_html)
+            return message
+
+        message.text = raw.text + '\n\n' + footer_text
+
+        html = raw.html
+        if len(html.strip()) > 0:
+            message.html = self._insert_html_footer(html, footer_html)
+
+        message.attachments = []
+        for part in raw.attachments:
+            attachment = Attachment()
+            attachment.filename = part.filename
+            attachment.mimetype = part.content_type
+            attachment.part = part
+            message.attachments.append(attachment)
+
+        return message
+
+    def _render_footers(self, tags: str) -> tuple:
+        """
+        Render the text and HTML footer for an unsubscribe tag scope.
+        """
+        values = {'list_name': self.config.list_name,
+                  'tags': tags,
+                  'address': self.config.sender_address}
+        if self.config.personalize:
+            # filled in per receiver by the sender
+            values.update(self.sender.markers)
+        return (self.config.footer_text_template.render(**values),
+                self.config.footer_html_template.render(**values))
+
+    def _insert_html_footer(self, html: str, footer_html: str) -> str:
+        """
+        Insert the footer before the end of the HTML body.
+
+        The closing body tag is searched case-insensitive from the end.
+        """
+        i = len(html)
+        while True:
+            i = html.rfind('</', 0, i)
+            if i < 0:
+                return html + footer_html
+            if html[i + 2:i + 7].lower() == 'body>':
+                return html[:i] + footer_html + html[i:]
+
+    def _set_text_payload(self, part: EmailMessage, text: str):
+        """
+        Replace the text of a leaf part, keeping its charset if possible.
+        """
+        charset = part.get_content_charset() or 'us-ascii'
+        try:
+            text.encode(charset)
+        except (UnicodeEncodeError, LookupError):
+            charset = 'utf-8'
+        del part['Content-Transfer-Encoding']
+        part.set_payload(text, charset)
+
+    def _splice_footer(self, raw: RawMessage, footer_text: str, footer_html: str):
+        """
+        Add the footers to the first text and HTML body parts of
+        the original message. All other parts are not changed.
+        """
+        text_done = False
+        html_done = False
+        for part in raw.parts:
+            if part.headers.get_content_disposition() == 'attachment':
+                continue
+
+            content_type = part.content_type
+            if content_type not in ('text/plain', 'text/html'):
+                continue
+            if (content_type == 'text/plain' and text_done) or \
+                    (content_type == 'text/html' and html_done):
+                continue
+
+            leaf = part.get_message()
+            text = decode_text(leaf)
+            if content_type == 'text/plain':
+                self._set_text_payload(leaf, text + '\n\n' + footer_text)
+                text_done = True
+            else:
+                self._set_text_payload(leaf, self._insert_html_footer(text, footer_html))
+                html_done = True
+            raw.replace(part, leaf)
+
+    def _log_headers(self, msg):
+        """
+        Log the headers of the given message
+        """
+        logging.info('From: %s', msg.from_)
+        logging.debug('To: %s', msg.to)
+        logging.info('Subject: %s', msg.subject)
+        logging.debug('Flags: %s', msg.flags)
+        logging.debug('Size: %i', msg.size_rfc822)
+        logging.info('Sender name: %s', msg.from_values)
+
+    def _log_body(self, raw: RawMessage):
+        """
+        Log the body of the given message
+        """
+        text = raw.text
+        if len(text) > 0:
+            logging.debug('Message Text:\n%s', text)
+        html = raw.html
+        if len(html) > 0:
+            logging.debug('Message HTML:\n%s', html)
+        for part in raw.attachments:
+            logging.debug('Attachment: %s %s', part.filename, part.content_type)
+
+
+class AsyncImapClient:
+    """
+    AsyncImapClient is a minimal IMAP client using asyncio streams.
+
+    It supports the commands needed to fetch new mails from the
+    mailbox folder. Commands are serialized, so several tasks can share
+    one client. FETCH results use the format of imaplib, and are
+    returned as imap_tools MailMessage objects.
+    """
+
+    literal_pattern = re.compile(rb'\{(\d+)\}\r\n$')
+    code_pattern = re.compile(rb'\[(UIDVALIDITY|UIDNEXT) (\d+)\]')
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.status = {}
+        self._reader = None
+        self._writer = None
+        self._tag = 0
+        self._lock = asyncio.Lock()
+
+    async def _interface_open(self):
+        """
+        Encapsulate calls to asyncio.open_connection.
+        """
+        return await asyncio.open_connection(
+            self.config.mailbox_server, self.config.mailbox_port,
+            ssl=ssl.create_default_context() if self.config.mailbox_ssl else None)
+
+    async def connect(self):
+        """
+        Connect, login and select the mailbox folder.
+        """
+        self._reader, self._writer = await self._interface_open()
+        greeting = await self._read_response()
+        logging.debug('IMAP greeting: %r', greeting)
+        await self.command(b'LOGIN', self._quote(self.config.mailbox_user),
+                           self._quote(self.config.mailbox_password or ''))
+        for response in await self.command(b'SELECT', self._quote(self.config.mailbox_folder)):
+            for name, value in self.code_pattern.findall(response[0]):
+                self.status[name.decode()] = int(value)
+        logging.debug('%s status: %r', self.config.mailbox_folder, self.status)
+
+    def _quote(self, value: str) -> bytes:
+        """
+        Quote a string argument.
+        """
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{value}"'.encode('utf-8')
+
+    async def _read_response(self) -> list:
         """
-        forward = True
-        sub = subject.strip()
-        if sub.startswith('$>'):
-            # do not forward command messages
-            forward = False
-            command = sub[2:]
-            if command.lower().startswith('subscribe'):
-                self._add_subscriber(sender, tags)
-            elif command.lower().startswith('unsubscribe'):
-                self._remove_subscriber(sender, tags)
+        Read one response, including its literals.
 
-        return forward
+        Literals are returned as (line, literal) tuples, like imaplib does.
+        """
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('IMAP connection closed')
+        parts = []
+        match = self.literal_pattern.search(line)
+        while match is not None:
+            literal = await self._reader.readexactly(int(match.group(1)))
+            parts.append((line[:-2], literal))
+            line = await self._reader.readline()
+            match = self.literal_pattern.search(line)
+        parts.append(line.rstrip(b'\r\n'))
+        return parts
+
+    async def command(self, *args: bytes) -> list:
+        """
+        Run a command and return the untagged responses.
+        """
+        async with self._lock:
+            self._tag += 1
+            tag = b'A%04d' % self._tag
+            self._writer.write(b' '.join((tag,) + args) + b'\r\n')
+            await self._writer.drain()
+
+            responses = []
+            while True:
+                response = await self._read_response()
+                first = response[0] if isinstance(response[0], bytes) else response[0][0]
+                if first.startswith(b'* '):
+                    responses.append(response)
+                elif first.startswith(tag + b' '):
+                    if not first[len(tag) + 1:].startswith(b'OK'):
+                        raise imaplib.IMAP4.error(first.decode(errors='replace'))
+                    return responses
+
+    async def search(self, criteria: bytes) -> list[str]:
+        """
+        Get the UIDs of the matching messages.
+        """
+        uids = []
+        for response in await self.command(b'UID', b'SEARCH', criteria):
+            if response[0].startswith(b'* SEARCH'):
+                uids += response[0].split()[2:]
+        return [uid.decode() for uid in uids]
 
-    def _add_subscriber(self, address, tags: list[str] = None):
+    async def fetch(self, uids: list[str], headers_only: bool = False) -> list:
         """
-        Add a new subscriber for the given tags.
+        Fetch the given messages, without marking them as seen.
+        """
+        body = b'BODY.PEEK[HEADER]' if headers_only else b'BODY.PEEK[]'
+        responses = await self.command(b'UID', b'FETCH', ','.join(uids).encode(),
+                                       b'(UID FLAGS RFC822.SIZE ' + body + b')')
+        messages = []
+        for response in responses:
+            if isinstance(response[0], tuple):
+                line, literal = response[0]
+                messages.append(MailMessage([(line[2:], literal)] + response[1:]))
+        return messages
+
+    async def fetch_raw(self, uids: list[str], partial: bytes = b'') -> dict:
+        """
+        Fetch the raw messages, or a range of their bytes, by UID,
+        without marking them as seen.
+        """
+        responses = await self.command(b'UID', b'FETCH', ','.join(uids).encode(),
+                                       b'(UID BODY.PEEK[]' + partial + b')')
+        return fetch_literals([part for response in responses for part in response])
 
-        If tags are None, all messages are forwarded to the subscriber.
+    async def mark_seen(self, uids: list[str]):
         """
-        logging.info('New subscriber: %s', address)
+        Add the SEEN flag to the given messages.
+        """
+        await self.command(b'UID', b'STORE', ','.join(uids).encode(),
+                           b'+FLAGS.SILENT', b'(\\Seen)')
 
-        key = self._get_key(tags)
+    async def logout(self):
+        """
+        Logout and close the connection.
+        """
+        try:
+            await self.command(b'LOGOUT')
+        except (imaplib.IMAP4.error, ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug('IMAP logout failed: %s', e)
+        self._writer.close()
 
-        if key not in self._list:
-            self._list[key] = []
 
-        if address not in self._list[key]:
-            self._list[key].append(address)
-            self._save_list()
+class AsyncSmtpClient:
+    """
+    AsyncSmtpClient is a minimal SMTP client using asyncio streams.
 
-        logging.info('new subscriber list for %r: %r', tags, self._list[key])
+    It connects, uses STARTTLS and AUTH PLAIN like the SmtpPool, and
+    sends serialized messages, bytes or MessageSpool, streaming the
+    DATA in chunks.
+    """
 
-        message = Message()
-        message.subject = self.config.subscribe_subject
-        message.text = self.config.subscribe_text
-        message.html = self.config.subscribe_html
-        message.receivers = [address]
+    def __init__(self, config: Config):
+        self.config = config
+        self._reader = None
+        self._writer = None
+        self._extensions = set()
 
-        self.sender.send_mail(message)
+    async def _interface_open(self):
+        """
+        Encapsulate calls to asyncio.open_connection.
+        """
+        return await asyncio.open_connection(self.config.smtp_server,
+                                             int(self.config.smtp_port))
 
-    def _remove_subscriber(self, address, tags: list[str] = None):
+    async def connect(self):
         """
-        Remove a subscriber for the given tags.
+        Connect and login.
+        """
+        self._reader, self._writer = await self._interface_open()
+        await self._expect(None, 220)
+        await self._ehlo()
+        if self.config.smtp_tls:
+            await self._expect(b'STARTTLS', 220)
+            await self._writer.start_tls(ssl.create_default_context(),
+                                         server_hostname=self.config.smtp_server)
+            await self._ehlo()
+        if self.config.smtp_user:
+            auth = base64.b64encode(b'\0' + self.config.smtp_user.encode('utf-8') +
+                                    b'\0' + (self.config.smtp_password or '').encode('utf-8'))
+            await self._expect(b'AUTH PLAIN ' + auth, 235)
+
+    async def _ehlo(self):
+        """
+        Greet the server and read the supported extensions.
+        """
+        _, lines = await self._expect(b'EHLO ' + socket.getfqdn().encode(), 250)
+        self._extensions = {line.split(b' ')[0].upper() for line in lines[1:]}
 
-        If tags are None, the subscriber is removed from the global list.
+    async def command(self, line: bytes) -> tuple:
         """
-        logging.info('User canceled subscription: %s', address)
+        Send a command, or only read a reply if line is None.
 
-        if tags is None:
-            for key in self._list.keys():
-                if address in self._list[key]:
-                    self._list[key].remove(address)
-                    self._save_list()
-                    logging.info('new subscriber list for %r: %r',
-                                 tags, self._list[key])
-        else:
-            key = self._get_key(tags)
-            if address in self._list[key]:
-                self._list[key].remove(address)
-                self._save_list()
-                logging.info('new subscriber list for %r: %r',
-                             tags, self._list[key])
+        Returns the reply code and the reply lines.
+        """
+        if line is not None:
+            self._writer.write(line + b'\r\n')
+            await self._writer.drain()
+        lines = []
+        while True:
+            reply = await self._reader.readline()
+            if len(reply) < 4:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(reply[4:].rstrip(b'\r\n'))
+            if reply[3:4] != b'-':
+                return int(reply[:3]), lines
+
+    async def _expect(self, line: bytes, expected: int) -> tuple:
+        """
+        Send a command and check the reply code.
+        """
+        code, lines = await self.command(line)
+        if code != expected:
+            raise smtplib.SMTPResponseException(code, b'\n'.join(lines))
+        return code, lines
 
-        message = Message()
-        message.text = self.config.unsubscribe_text
-        message.html = self.config.unsubscribe_html
-        message.receivers = [address]
+    async def sendmail(self, sender: str, receivers: list[str], message) -> dict:
+        """
+        Send a message, and return the refused receivers like smtplib.
+        """
+        size = len(message) if isinstance(message, bytes) else message.size
+        option = b' SIZE=%i' % size if b'SIZE' in self._extensions else b''
+        code, lines = await self.command(b'MAIL FROM:<' + sender.encode() + b'>' + option)
+        if code != 250:
+            await self.command(b'RSET')
+            raise smtplib.SMTPSenderRefused(code, b'\n'.join(lines), sender)
+
+        refused = {}
+        for receiver in receivers:
+            code, lines = await self.command(b'RCPT TO:<' + receiver.encode() + b'>')
+            if code not in (250, 251):
+                refused[receiver] = (code, b'\n'.join(lines))
+        if len(refused) == len(receivers):
+            await self.command(b'RSET')
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, lines = await self.command(b'DATA')
+        if code != 354:
+            await self.command(b'RSET')
+            raise smtplib.SMTPDataError(code, b'\n'.join(lines))
+        chunks = [message] if isinstance(message, bytes) else message.chunks()
+        for data in smtp_data_chunks(chunks):
+            self._writer.write(data)
+            await self._writer.drain()
+        code, lines = await self.command(None)
+        if code != 250:
+            await self.command(b'RSET')
+            raise smtplib.SMTPDataError(code, b'\n'.join(lines))
+        return refused
+
+    async def quit(self):
+        """
+        Quit and close the connection.
+        """
+        try:
+            await self.command(b'QUIT')
+        except (smtplib.SMTPException, OSError) as e:
+            logging.debug('SMTP quit failed: %s', e)
+        self.close()
 
-        self.sender.send_mail(message)
+    def close(self):
+        """
+        Close the connection.
+        """
+        if self._writer is not None:
+            self._writer.close()
 
 
-class Receiver:
+class AsyncEngine:
     """
-    The receiver takes care of checking for incoming messages.
+    AsyncEngine processes new mails using asyncio.
+
+    Fetching, processing and delivering run as concurrent stages,
+    connected by bounded queues. The fetch stage reads the headers
+    of new mails page by page, the process stage handles them using
+    the Receiver and Subscribers logic, and the deliver stage sends
+    the serialized messages using smtp_workers SMTP connections. The
+    Subscribers logic runs in a worker thread, so the event loop is
+    never blocked by the storage.
+
+    If an outbox is configured, the processed messages are queued
+    in the outbox instead of the deliver stage.
+
+    The Receiver of the list is used, so the sync state, dedupe store
+    and rate limits are shared, and its posts are sent by the engine.
     """
 
-    def __init__(self, config: Config, subscribers: Subscribers, sender: Sender):
+    # Attempts to deliver a batch, temporary failures are retried with a new connection.
+    delivery_attempts = 3
+    # Seconds before the first retry of a delivery, doubled for each further retry.
+    delivery_backoff = 1
+
+    def __init__(self, config: Config, subscribers: Subscribers, outbox: Outbox = None,
+                 pool: SmtpPool = None, executor: ThreadPoolExecutor = None,
+                 receiver: Receiver = None):
         self.config = config
+        self.sender = Sender(config, pool, executor)
+        self.sender.outbox = outbox if outbox is not None else self
+        if receiver is None:
+            receiver = Receiver(config, subscribers, self.sender)
+        receiver.sender = self.sender
+        self.receiver = receiver
         self.subscribers = subscribers
-        self.sender = sender
+        self._loop = None
+        self._deliveries = None
+        self._delivery = None
+        self._delivered = []
 
-    def process_mails(self):
+    def _interface_imap(self) -> AsyncImapClient:
         """
-        Fetch and process all new mails.
+        Encapsulate the async IMAP client.
         """
-        logging.info("Processing new messages ...")
+        return AsyncImapClient(self.config)
 
-        with MailBox(self.config.mailbox_server).login(
-                self.config.mailbox_user,
-                self.config.mailbox_password) as mailbox:
+    def _interface_smtp(self) -> AsyncSmtpClient:
+        """
+        Encapsulate the async SMTP client.
+        """
+        return AsyncSmtpClient(self.config)
 
-            for msg in mailbox.fetch(criteria=AND(seen=False)):
-                logging.debug('mark message %s as seen', msg.uid)
+    async def process_mails(self) -> CycleResult:
+        """
+        Fetch, process and deliver all new mails.
+        """
+        logging.info("Processing new messages (asyncio) ...")
+        self._loop = asyncio.get_running_loop()
+        self._deliveries = asyncio.Queue(maxsize=self.config.async_queue_size)
+        pages = asyncio.Queue(maxsize=2)
+        METRICS.register(('deliver', id(self)), 'backlog',
+                         lambda: [({'stage': 'deliver'}, self._deliveries.qsize())])
+
+        imap = self._interface_imap()
+        await imap.connect()
+        workers = [asyncio.create_task(self._deliver())
+                   for _ in range(self.config.smtp_workers)]
+        state = self.receiver._sync_state  # pylint: disable=protected-access
+        try:
+            uids, resync, last_uid = await self._new_uids(imap)
+            result = self.receiver._limit_uids(uids, resync)  # pylint: disable=protected-access
+            async with asyncio.TaskGroup() as group:
+                group.create_task(self._fetch(imap, uids, pages))
+                group.create_task(self._process(imap, pages, resync, last_uid))
+            await self._deliveries.join()
+            await self._flush_dedupe()
+
+            if resync:
+                self.receiver._sync_state = {  # pylint: disable=protected-access
+                    'uidvalidity': imap.status['UIDVALIDITY'],
+                    'last_uid': max([last_uid] + [int(uid) for uid in uids]),
+                    'deferred': state['deferred']}
+                await asyncio.to_thread(self.receiver._save_sync_state)  # pylint: disable=protected-access
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self.receiver.dedupe is not None:
+                self.receiver.dedupe.release()
+            await imap.logout()
+        METRICS.set('backlog', result.remaining, stage='mailbox')
+        return result
+
+    async def _new_uids(self, imap: AsyncImapClient) -> tuple:
+        """
+        Get the UIDs of the new mails, like Receiver._process_mailbox.
+        """
+        state = self.receiver._sync_state  # pylint: disable=protected-access
+        resync = imap.status['UIDVALIDITY'] != state['uidvalidity']
+        if resync:
+            logging.info('UIDVALIDITY changed to %i, processing all unseen messages',
+                         imap.status['UIDVALIDITY'])
+            uids = await imap.search(b'UNSEEN')
+            last_uid = imap.status['UIDNEXT'] - 1
+            state['deferred'] = {}
+        else:
+            last_uid = state['last_uid']
+            deferred = list(state['deferred'])
+            present = await imap.search(b'UID ' + ','.join(deferred).encode()) \
+                if len(deferred) > 0 else []
+            uids = self.receiver._with_deferred(  # pylint: disable=protected-access
+                [uid for uid in await imap.search(b'UID %i:*' % (last_uid + 1))
+                 if int(uid) > last_uid], present)
+        uids.sort(key=int)
+        logging.debug('%i new messages', len(uids))
+        return uids, resync, last_uid
+
+    async def _fetch(self, imap: AsyncImapClient, uids: list[str], pages: asyncio.Queue):
+        """
+        Fetch stage: read the headers of the new mails page by page.
+        """
+        page_size = self.config.mailbox_page_size
+        for i in range(0, len(uids), page_size):
+            METRICS.set('backlog', len(uids) - i, stage='mailbox')
+            page = uids[i:i + page_size]
+            with METRICS.timer('fetch'):
+                headers = await imap.fetch(page, headers_only=True)
+            logging.debug('mark messages %r as seen', page)
+            await imap.mark_seen(page)
+            await pages.put((page, headers))
+        await pages.put(None)
+
+    async def _process(self, imap: AsyncImapClient, pages: asyncio.Queue,
+                       resync: bool, last_uid: int):
+        """
+        Process stage: handle commands and forward the posts.
+        """
+        while True:
+            item = await pages.get()
+            if item is None:
+                return
+            page, headers = item
+
+            posts = await asyncio.to_thread(self._triage, headers)
+            if len(posts) > 0:
+                async for msg, raw in self._fetch_posts(
+                        imap, [msg for msg in headers if msg.uid in posts]):
+                    try:
+                        await self._process_post(msg, raw, posts[msg.uid])
+                    finally:
+                        raw.close()
+
+            await self._flush_dedupe()
+            if not resync:
+                self.receiver._sync_state['last_uid'] = max(  # pylint: disable=protected-access
+                    last_uid, int(page[-1]))
+                await asyncio.to_thread(self.receiver._save_sync_state)  # pylint: disable=protected-access
+
+    async def _process_post(self, msg, raw: RawMessage, result: SubscriberCheckResult):
+        """
+        Forward a post, and track its messages in the deliver stage.
 
-                mailbox.flag([msg.uid], [MailMessageFlags.SEEN], True)
-                self._process_message(msg)
+        The post is remembered for dedupe by the deliver stage, since it
+        is not sent yet when it is queued.
+        """
+        if self.sender.outbox is not self:
+            await asyncio.to_thread(
+                self.receiver._process_message, msg, raw, result)  # pylint: disable=protected-access
+            return
 
-    def _process_message(self, msg):
+        delivery = self._delivery = PostDelivery(result.digest)
+        result.digest = None
+        try:
+            await asyncio.to_thread(
+                self.receiver._process_message, msg, raw, result)  # pylint: disable=protected-access
+        except BaseException:
+            delivery.failed = True
+            raise
+        finally:
+            self._delivery = None
+            self._delivered_one(delivery)
+
+    def _delivered_one(self, delivery: PostDelivery):
         """
-        Process a new message.
+        Count a finished message of a post, in the event loop.
         """
-        logging.info('Processing message %r', msg.uid)
-
-        self._log_message(msg)
+        delivery.pending -= 1
+        if delivery.pending == 0 and not delivery.failed and delivery.digest is not None:
+            self._delivered.append(delivery.digest)
 
-        subject = msg.subject
-        result = self.subscribers.check(subject, msg.from_)
-        if not result.forward:
-            logging.debug('message shall be not forwarded')
+    async def _flush_dedupe(self):
+        """
+        Remember the delivered posts, and write the dedupe records.
+        """
+        if self.receiver.dedupe is None:
             return
+        digests, self._delivered = self._delivered, []
 
-        if len(result.receivers) == 0:
-            logging.info('no subscribers for %s', subject)
+        def flush():
+            for digest in digests:
+                self.receiver.dedupe.add(digest)
+            self.receiver.dedupe.flush()
+
+        await asyncio.to_thread(flush)
+
+    async def _fetch_posts(self, imap: AsyncImapClient, msgs: list):
+        """
+        Fetch the full posts as RawMessage, like Receiver._fetch_posts.
+        """
+        threshold = self.config.spool_threshold
+        for batch in fetch_batches(msgs, threshold):
+            if batch[0].size_rfc822 > threshold:
+                raw = await self._fetch_spooled(imap, batch[0].uid)
+                if raw is not None:
+                    yield batch[0], raw
+                continue
+
+            with METRICS.timer('fetch'):
+                literals = await imap.fetch_raw([msg.uid for msg in batch])
+            for msg in batch:
+                if msg.uid in literals:
+                    yield msg, RawMessage(literals.pop(msg.uid))
+
+    async def _fetch_spooled(self, imap: AsyncImapClient, uid: str) -> RawMessage:
+        """
+        Fetch a large post in chunks of spool_threshold bytes into a spool file.
+        """
+        chunk_size = self.config.spool_threshold
+        file = tempfile.TemporaryFile(dir=self.config.spool_path)  # pylint: disable=consider-using-with
+        size = 0
+        while True:
+            with METRICS.timer('fetch'):
+                literals = await imap.fetch_raw([uid], b'<%i.%i>' % (size, chunk_size))
+            chunk = literals.get(uid, b'')
+            file.write(chunk)
+            size += len(chunk)
+            # servers without partial fetch send the full message
+            if len(chunk) != chunk_size:
+                break
+
+        if size == 0:
+            file.close()
+            return None
+        return RawMessage.open(file)
+
+    def _triage(self, headers: list) -> dict:
+        """
+        Handle the headers of one page, as one subscribers transaction.
+        """
+        posts = {}
+        with self.subscribers.transaction():
+            for msg in headers:
+                result = self.receiver._triage_message(msg)  # pylint: disable=protected-access
+                if result is not None:
+                    posts[msg.uid] = result
+        return posts
+
+    def put(self, sender: str, receivers: list[str], data):
+        """
+        Queue a serialized message for the deliver stage.
+
+        Called by the sender, from the thread of the process stage.
+        Blocks while the queue is full.
+        """
+        if isinstance(data, MessageSpool):
+            # the sender closes its spool after queuing
+            file = tempfile.SpooledTemporaryFile(  # pylint: disable=consider-using-with
+                max_size=self.config.spool_threshold, dir=self.config.spool_path)
+            for chunk in data.chunks():
+                file.write(chunk)
+            data = MessageSpool(file, data.size)
+        asyncio.run_coroutine_threadsafe(
+            self._queue((sender, receivers, data, self._delivery)), self._loop).result()
+
+    async def _queue(self, item: tuple):
+        """
+        Put a message into the deliver queue, in the event loop.
+        """
+        if item[3] is not None:
+            item[3].pending += 1
+        await self._deliveries.put(item)
+
+    async def _connect_smtp(self) -> AsyncSmtpClient:
+        """
+        Open a new authenticated SMTP connection.
+        """
+        logging.debug('opening new async smtp connection to %s', self.config.smtp_server)
+        smtp = self._interface_smtp()
+        try:
+            await smtp.connect()
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    async def _deliver(self):
+        """
+        Deliver stage: send queued messages using one SMTP connection.
+
+        Errors are handled per message, so the worker keeps running
+        and the queue is always done.
+        """
+        smtp = None
+        try:
+            while True:
+                sender, receivers, data, delivery = await self._deliveries.get()
+                sent = False
+                try:
+                    size = self.config.smtp_batch_size
+                    results = []
+                    for i in range(0, len(receivers), size):
+                        smtp, ok = await self._deliver_batch(
+                            smtp, sender, receivers[i:i + size], data)
+                        results.append(ok)
+                    sent = all(results)
+                finally:
+                    if isinstance(data, MessageSpool):
+                        data.close()
+                    if delivery is not None:
+                        delivery.failed = delivery.failed or not sent
+                        self._delivered_one(delivery)
+                    self._deliveries.task_done()
+        finally:
+            if smtp is not None:
+                await smtp.quit()
+
+    async def _deliver_batch(self, smtp: AsyncSmtpClient, sender: str, receivers: list[str],
+                             data) -> tuple:
+        """
+        Send a message to one batch of receivers.
+
+        Temporary failures are retried up to delivery_attempts times,
+        using a new connection. Refused receivers and permanent errors
+        are not retried.
+
+        Returns the connection for the next batch, or None, and whether
+        the message was accepted by the server.
+        """
+        for attempt in range(1, self.delivery_attempts + 1):
+            try:
+                if smtp is None:
+                    smtp = await self._connect_smtp()
+                with METRICS.timer('submit'):
+                    refused = await smtp.sendmail(sender, receivers, data)
+                METRICS.inc('recipients_delivered', len(receivers) - len(refused))
+                METRICS.inc('recipients_refused', len(refused))
+                if len(refused) > 0:
+                    logging.error('Sending failed, refused: %r', refused)
+                return smtp, True
+            except smtplib.SMTPRecipientsRefused as e:
+                METRICS.inc('recipients_refused', len(e.recipients))
+                logging.error('Sending failed, refused: %r', e.recipients)
+                return smtp, True
+            except smtplib.SMTPResponseException as e:
+                METRICS.inc('smtp_errors')
+                logging.error('Sending to %i receivers failed: %s', len(receivers), e)
+                if e.smtp_code >= 500:
+                    return smtp, False
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                METRICS.inc('smtp_errors')
+                logging.error('Sending to %i receivers failed: %s', len(receivers), e)
+
+            # temporary failure, retry using a new connection
+            if smtp is not None:
+                smtp.close()
+            smtp = None
+            if attempt < self.delivery_attempts:
+                delay = self.delivery_backoff * 2 ** (attempt - 1)
+                logging.warning('Retrying delivery to %i receivers in %i seconds',
+                                len(receivers), delay)
+                await asyncio.sleep(delay)
+
+        logging.error('Giving up delivery to %r', receivers)
+        return smtp, False
+
+
+class StackSampler:
+    """
+    StackSampler is a sampling profiler for all threads.
+
+    The stacks of all threads are sampled every interval seconds,
+    and counted in the collapsed stack format used by flame graph
+    tools: one line per stack, with the frames separated by
+    semicolons, rooted at the thread name, and the sample count.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler',
+                                        daemon=True)
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self._thread.start()
+
+    def _sample(self):
+        """
+        Take one sample of all other threads.
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == self._thread.ident:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                              f':{code.co_firstlineno})')
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stack = ';'.join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def _run(self):
+        """
+        Sample until stopped.
+        """
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def stop(self) -> str:
+        """
+        Stop sampling, and get the collapsed stacks.
+        """
+        self._stop.set()
+        self._thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.items())
+
+
+class CycleProfiler:
+    """
+    CycleProfiler profiles mail processing cycles.
+
+    Cycles slower than profile_threshold seconds are written to the
+    profile_path folder, as cProfile .prof files or as .collapsed
+    stacks of the StackSampler, and only the newest profile_keep
+    files are kept. cProfile sees only the thread running the cycle,
+    the sampler also sees the thread pools and the asyncio engine.
+    """
+
+    extensions = ('.prof', '.collapsed')
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.enabled = config.profile
+
+    def install_signal(self):
+        """
+        Toggle profiling with SIGUSR1.
+        """
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.toggle)
+
+    def toggle(self, signum=None, frame=None):  # pylint: disable=unused-argument
+        """
+        Enable or disable profiling.
+        """
+        self.enabled = not self.enabled
+        logging.warning('Profiling %s', 'enabled' if self.enabled else 'disabled')
+
+    @contextmanager
+    def cycle(self, name: str):
+        """
+        Profile the with block, if profiling is enabled.
+        """
+        if not self.enabled:
+            yield
             return
 
-        message = Message()
-        message.subject = subject
-
-        footer_text = self.config.footer_text.format(
-            list_name=self.config.list_name,
-            tags=result.unsubscribe_tag,
-            address=self.config.sender_address)
-        message.text = msg.text + '\n\n' + footer_text
-
-        if len(msg.html.strip()) > 0:
-            footer_html = self.config.footer_html.format(
-                list_name=self.config.list_name,
-                tags=result.unsubscribe_tag,
-                address=self.config.sender_address)
-            if '</body>' in msg.html:
-                i = msg.html.index('</body>')
-                message.html = msg.html[:i] + footer_html + msg.html[i:]
+        if self.config.profile_mode == 'sample':
+            profiler = StackSampler(self.config.profile_interval / 1000)
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # another profiler is already active
+                logging.warning('Profiling the cycle failed: %s', e)
+                yield
+                return
+
+        start = monotonic()
+        try:
+            yield
+        finally:
+            duration = monotonic() - start
+            if self.config.profile_mode == 'sample':
+                stacks = profiler.stop()
             else:
-                message.html = msg.html + footer_html
+                profiler.disable()
+            if duration >= self.config.profile_threshold:
+                path = self._get_path(name, duration)
+                if self.config.profile_mode == 'sample':
+                    write_file_atomic(path, stacks.encode('utf-8'))
+                else:
+                    profiler.dump_stats(path)
+                logging.info('Cycle took %.3f seconds, profile written to %s', duration, path)
+                self._rotate()
 
-        message.receivers += result.receivers
-        message.sender_name = msg.from_values.name
+    def _get_path(self, name: str, duration: float) -> str:
+        """
+        Get the file name of a new profile.
+        """
+        os.makedirs(self.config.profile_path, exist_ok=True)
+        extension = '.collapsed' if self.config.profile_mode == 'sample' else '.prof'
+        name = re.sub(r'[^\w.-]+', '_', name)
+        return os.path.join(self.config.profile_path,
+                            f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}'
+                            f'-{int(duration * 1000)}ms{extension}')
+
+    def _rotate(self):
+        """
+        Remove the oldest profiles.
+        """
+        paths = [os.path.join(self.config.profile_path, name)
+                 for name in os.listdir(self.config.profile_path)
+                 if name.endswith(self.extensions)]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:-self.config.profile_keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    MetricsHandler serves the metrics in the Prometheus text format.
+    """
 
-        for att in msg.attachments:
-            attachment = Attachment()
-            attachment.filename = att.filename
-            attachment.mimetype = att.content_type
-            attachment.data = att.payload
-            message.attachments.append(attachment)
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handle a GET request.
+        """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = METRICS.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Log requests as debug messages.
+        """
+        logging.debug('metrics request: ' + format, *args)
 
-        self.sender.send_mail(message)
 
-    def _log_message(self, msg):
+class MetricsExporter:
+    """
+    MetricsExporter exports the metrics of the process.
+
+    The metrics are served on http://<metrics_address>:<metrics_port>/metrics,
+    if a port is configured, and dumped as JSON to the metrics_dump file
+    every metrics_dump_interval seconds, if a file is configured.
+    """
+
+    def __init__(self, config: Config, port_offset: int = 0):
+        self.config = config
+        self.port = config.metrics_port + port_offset if config.metrics_port else 0
+        self._server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _interface_server(self, address: tuple) -> http.server.HTTPServer:
         """
-        Log the given message
+        Encapsulate calls to http.server.
         """
-        logging.info('From: %s', msg.from_)
-        logging.debug('To: %s', msg.to)
-        logging.info('Subject: %s', msg.subject)
-        logging.debug('Flags: %s', msg.flags)
-        logging.info('Sender name: %s', msg.from_values)
-        if len(msg.text) > 0:
-            logging.debug('Message Text:\n%s', msg.text)
-        if len(msg.html) > 0:
-            logging.debug('Message HTML:\n%s', msg.html)
-        for att in msg.attachments:
-            logging.debug('Attachment: %s %s', att.filename, att.content_type)
+        return http.server.ThreadingHTTPServer(address, MetricsHandler)
+
+    def start(self):
+        """
+        Start the HTTP server and the dump thread.
+        """
+        if self.port:
+            self._server = self._interface_server((self.config.metrics_address, self.port))
+            self._threads.append(threading.Thread(target=self._server.serve_forever,
+                                                  name='metrics-http', daemon=True))
+            logging.info('Serving metrics on %s:%i', self.config.metrics_address, self.port)
+        if self.config.metrics_dump is not None:
+            self._threads.append(threading.Thread(target=self._run_dump,
+                                                  name='metrics-dump', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def dump(self):
+        """
+        Write the metrics to the dump file.
+        """
+        write_file_atomic(self.config.metrics_dump,
+                          json.dumps(METRICS.snapshot()).encode('utf-8'))
+
+    def _run_dump(self):
+        """
+        Dump the metrics periodically.
+        """
+        while not self._stop.wait(self.config.metrics_dump_interval):
+            try:
+                self.dump()
+            except OSError as e:
+                logging.error('Writing metrics to %s failed: %s', self.config.metrics_dump, e)
+
+    def stop(self):
+        """
+        Stop the HTTP server and write a final dump.
+        """
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.config.metrics_dump is not None:
+            self.dump()
+
+
+class Scheduler:
+    """
+    Scheduler computes the sleep time between the processing cycles.
+
+    While new mails are left, the next cycle starts immediately. After
+    a cycle which processed mails, the next cycle starts after
+    schedule_active_sleep seconds. The sleep time of idle cycles starts
+    with sleep seconds, and is multiplied by schedule_backoff for each
+    further idle cycle, up to schedule_max_sleep seconds. The default
+    backoff of 1 keeps the sleep time of idle cycles. The duration
+    of the cycle is subtracted, so the sleep time is the period between
+    the starts of two cycles.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.idle_cycles = 0
+        self.delay = config.sleep
+
+    def update(self, result: CycleResult, duration: float) -> float:
+        """
+        Compute the sleep time after a cycle.
+        """
+        if result.remaining > 0:
+            self.idle_cycles = 0
+            period = 0
+        elif result.processed > 0:
+            self.idle_cycles = 0
+            period = self.config.schedule_active_sleep
+        else:
+            period = min(self.config.sleep * self.config.schedule_backoff ** self.idle_cycles,
+                         max(self.config.schedule_max_sleep, self.config.sleep))
+            self.idle_cycles += 1
+        self.delay = max(0.0, period - duration)
+        logging.debug('Cycle took %.3f seconds, next cycle in %.3f seconds',
+                      duration, self.delay)
+        return self.delay
 
 
 class Maillist:
@@ -678,14 +4871,31 @@ class Maillist:
     Maillist receives mails and forwards it to subscribers.
     """
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, pool: SmtpPool = None,
+                 mailboxes: MailboxPool = None, profiler: CycleProfiler = None,
+                 executor: ThreadPoolExecutor = None):
         """
         Create a new maillist.
+
+        Hosted lists share the SMTP pool, SMTP workers, mailbox
+        sessions and profiler.
         """
         self.config = config
-        self.sender = Sender(self.config)
+        self.profiler = profiler or CycleProfiler(config)
+        self.scheduler = Scheduler(config)
+        self.sender = Sender(self.config, pool, executor)
+        self.outbox = None
+        if self.config.outbox_path is not None:
+            self.outbox = Outbox(self.config, self.sender)
+            self.sender.outbox = self.outbox
+            if self.config.daemon:
+                self.outbox.start()
         self.subscribers = Subscribers(self.config, self.sender)
-        self.receiver = Receiver(self.config, self.subscribers, self.sender)
+        self.receiver = Receiver(self.config, self.subscribers, self.sender, mailboxes)
+        self.engine = None
+        if self.config.use_asyncio:
+            self.engine = AsyncEngine(self.config, self.subscribers, self.outbox,
+                                      self.sender.pool, executor, self.receiver)
 
         if self.config.send_test_mail:
             self._send_test_mail()
@@ -703,18 +4913,186 @@ class Maillist:
 
         self.sender.send_mail(message)
 
-    def process_mails(self):
+    def process_mails(self) -> CycleResult:
         """
         Receive message and forward to subscribers.
         """
-        self.receiver.process_mails()
+        start = monotonic()
+        with self.profiler.cycle(self.config.list_name):
+            if self.engine is not None:
+                result = asyncio.run(self.engine.process_mails())
+            else:
+                result = self.receiver.process_mails()
+            if self.outbox is not None and not self.outbox.running:
+                self.outbox.deliver()
+        self.scheduler.update(result, monotonic() - start)
+        return result
+
+    def sleep(self):
+        """
+        Sleep until next check for new mails, as computed by the scheduler.
+        """
+        delay = self.scheduler.delay
+        if delay <= 0:
+            logging.info('New mails left, processing next cycle ...')
+            return
+        self.sender.keepalive()
+        if self.config.idle:
+            self.receiver.wait(delay)
+            return
+        logging.info('Sleeping for %.1f seconds ...', delay)
+        sleep(delay)
+
+    def close(self):
+        """
+        Close all SMTP sessions.
+        """
+        self.sender.close()
+        if self.engine is not None:
+            self.engine.sender.close()
+
+
+def list_names(path: str) -> list[str]:
+    """
+    Get the names of the lists hosted in the given folder.
+    """
+    return sorted(name for name in os.listdir(path)
+                  if exists(os.path.join(path, name, 'config')))
+
+
+class ListHost:
+    """
+    ListHost runs several mail-lists in one process.
+
+    Lists using the same SMTP server and credentials share one
+    SmtpPool, and lists using the same mailbox credentials share one
+    mailbox session. All lists share one pool of SMTP workers, and are
+    processed by one scheduler loop.
+
+    IMAP IDLE is not supported, since the lists use several mailboxes.
+    """
+
+    def __init__(self, config: Config, names: list[str], shard: int = 0):
+        self.config = config
+        self.mailboxes = MailboxPool()
+        self.pools = {}
+        self.lists = {}
+        self.exporter = None
+        self.profiler = None
+        self.scheduler = None
+        self.executor = None
+        for name in names:
+            list_config = config.for_list(os.path.join(config.lists_path, name))
+            list_config.check_config()
+            if self.exporter is None:
+                # The lists share the metrics, the profiler and the
+                # scheduler of the process, so the settings of the
+                # first list are used.
+                self.exporter = MetricsExporter(list_config, shard)
+                self.exporter.start()
+                self.profiler = CycleProfiler(list_config)
+                self.scheduler = Scheduler(list_config)
+                self.executor = smtp_executor(list_config)
+            self.lists[name] = Maillist(list_config, self._get_pool(list_config),
+                                        self.mailboxes, self.profiler, self.executor)
+        logging.info('Hosting %i lists, using %i SMTP pools', len(self.lists), len(self.pools))
+
+    def _get_pool(self, config: Config) -> SmtpPool:
+        """
+        Get the shared SMTP pool for the server and credentials of the list.
+        """
+        key = (config.smtp_server, config.smtp_port, config.smtp_user,
+               config.smtp_password, config.smtp_tls)
+        if key not in self.pools:
+            self.pools[key] = SmtpPool(config)
+        return self.pools[key]
+
+    def process_mails(self) -> CycleResult:
+        """
+        Process the new mails of all lists.
+
+        An error of one list doesn't stop the other lists.
+        """
+        start = monotonic()
+        result = CycleResult()
+        for name, maillist in self.lists.items():
+            logging.info('Processing list %s ...', name)
+            try:
+                result.add(maillist.process_mails())
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Processing list %s failed: %s', name, e)
+                self.mailboxes.drop(maillist.config)
+        if self.scheduler is not None:
+            self.scheduler.update(result, monotonic() - start)
+        return result
 
     def sleep(self):
         """
-        Sleep until next check for new mails.
+        Sleep until next check for new mails, as computed by the scheduler.
+        """
+        delay = self.scheduler.delay if self.scheduler is not None else self.config.sleep
+        if delay <= 0:
+            logging.info('New mails left, processing next cycle ...')
+            return
+        for pool in self.pools.values():
+            pool.keepalive()
+        logging.info('Sleeping for %.1f seconds ...', delay)
+        sleep(delay)
+
+    def run(self):
+        """
+        Run the scheduler loop, or one cycle if not in daemon mode.
+        """
+        if self.profiler is not None:
+            self.profiler.install_signal()
+        if self.config.daemon:
+            while True:
+                self.process_mails()
+                self.sleep()
+        else:
+            self.process_mails()
+            self.close()
+
+    def close(self):
+        """
+        Close all SMTP and mailbox sessions.
         """
-        logging.info('Sleeping for %i seconds ...', self.config.sleep)
-        sleep(self.config.sleep)
+        for maillist in self.lists.values():
+            maillist.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.mailboxes.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+
+
+def _run_lists(config: Config, names: list[str], shard: int):
+    """
+    Run a shard of the hosted lists, in a child process.
+
+    The metrics port is offset by the shard index.
+    """
+    ListHost(config, names, shard).run()
+
+
+def host_lists(config: Config):
+    """
+    Run all lists of the lists folder, sharded across processes.
+    """
+    names = list_names(config.lists_path)
+    if config.processes == 1 or len(names) <= 1:
+        ListHost(config, names).run()
+        return
+
+    shards = [names[i::config.processes] for i in range(config.processes)]
+    processes = [multiprocessing.Process(target=_run_lists, args=(config, shard, i),
+                                         name=f'maillist-{i}')
+                 for i, shard in enumerate(shards) if len(shard) > 0]
+    logging.info('Hosting %i lists in %i processes', len(names), len(processes))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
 
 def main():
@@ -722,9 +5100,17 @@ def main():
     Run the maillist service.
     """
     config = Config()
+
+    if config.lists_path is not None:
+        host_lists(config)
+        return
+
     config.check_config()
 
     maillist = Maillist(config)
+    maillist.profiler.install_signal()
+    exporter = MetricsExporter(config)
+    exporter.start()
 
     if config.daemon:
         while True:
@@ -732,6 +5118,8 @@ def main():
             maillist.sleep()
     else:
         maillist.process_mails()
+        maillist.close()
+        exporter.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,479 @@
+"""
+Throughput benchmark for mail-list.
+
+Starts local in-process IMAP and SMTP servers, seeds the mailbox with
+synthetic posts, commands and attachments, runs Maillist.process_mails
+for several list sizes, and prints the results as JSON.
+
+Each list size runs in an own process, so the peak RSS of one run is
+not hidden by an earlier, larger run. The fake servers run in the same
+process, and are included in the peak RSS.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
+from time import perf_counter
+
+import maillist
+
+
+def parse_set(text: str, last: int) -> list[int]:
+    """
+    Parse an IMAP sequence set, like 1,3:5 or 7:*.
+    """
+    numbers = []
+    for part in text.split(','):
+        if ':' in part:
+            start, end = part.split(':')
+            start = last if start == '*' else int(start)
+            end = last if end == '*' else int(end)
+            numbers += range(min(start, end), max(start, end) + 1)
+        else:
+            numbers.append(last if part == '*' else int(part))
+    return [number for number in numbers if 1 <= number <= last]
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """
+    One IMAP session of the FakeImapServer.
+
+    UIDs are equal to the sequence numbers, since nothing is expunged.
+    """
+
+    def _send(self, line: bytes):
+        """
+        Send one response line.
+        """
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        self._send(b'* OK [CAPABILITY IMAP4rev1 IDLE] fake imap ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.rstrip(b'\r\n').decode().split(' ', 2)
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+            by_uid = command == 'UID'
+            if by_uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            handler = getattr(self, 'do_' + command.lower(), None)
+            if handler is None:
+                self._send(tag.encode() + b' BAD unknown command')
+                continue
+            if handler(args, by_uid) is False:
+                self._send(tag.encode() + b' OK bye')
+                return
+            self._send(tag.encode() + b' OK done')
+
+    def do_capability(self, args, by_uid):
+        """ CAPABILITY """
+        self._send(b'* CAPABILITY IMAP4rev1 IDLE')
+
+    def do_login(self, args, by_uid):
+        """ LOGIN, all credentials are accepted. """
+
+    def do_noop(self, args, by_uid):
+        """ NOOP """
+
+    def do_expunge(self, args, by_uid):
+        """ EXPUNGE, nothing is deleted. """
+
+    def do_logout(self, args, by_uid):
+        """ LOGOUT """
+        self._send(b'* BYE fake imap')
+        return False
+
+    def do_select(self, args, by_uid):
+        """ SELECT, every folder is the same. """
+        server = self.server
+        self._send(b'* %i EXISTS' % len(server.messages))
+        self._send(b'* OK [UIDVALIDITY %i] ok' % server.uidvalidity)
+        self._send(b'* OK [UIDNEXT %i] ok' % (len(server.messages) + 1))
+
+    def do_status(self, args, by_uid):
+        """ STATUS """
+        server = self.server
+        folder = args.split(' ')[0]
+        self._send(b'* STATUS %s (UIDVALIDITY %i UIDNEXT %i)' % (
+            folder.encode(), server.uidvalidity, len(server.messages) + 1))
+
+    def do_search(self, args, by_uid):
+        """ SEARCH, supports UID sets and UNSEEN. """
+        server = self.server
+        numbers = range(1, len(server.messages) + 1)
+        match = re.search(r'UID ([0-9,:*]+)', args)
+        if match is not None:
+            numbers = parse_set(match.group(1), len(server.messages))
+        if 'UNSEEN' in args or 'NOT SEEN' in args:
+            numbers = [number for number in numbers if not server.seen[number - 1]]
+        self._send(b'* SEARCH ' + ' '.join(str(number) for number in numbers).encode())
+
+    def do_fetch(self, args, by_uid):
+        """ FETCH of UID, FLAGS, RFC822.SIZE and BODY[HEADER], BODY[] or BODY[]<partial>. """
+        server = self.server
+        numbers, _, items = args.partition(' ')
+        items = items.upper()
+        for number in parse_set(numbers, len(server.messages)):
+            message = server.messages[number - 1]
+            if 'BODY' in items and '.PEEK' not in items:
+                server.seen[number - 1] = True
+            flags = b'(\\Seen)' if server.seen[number - 1] else b'()'
+            head = b'* %i FETCH (UID %i FLAGS %s RFC822.SIZE %i' % (
+                number, number, flags, len(message))
+            if 'BODY' not in items:
+                self._send(head + b')')
+                continue
+            if 'HEADER' in items:
+                data = message.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+                section = b'BODY[HEADER]'
+            else:
+                data = message
+                section = b'BODY[]'
+                partial = re.search(r'<(\d+)\.(\d+)>', items)
+                if partial is not None:
+                    start = int(partial.group(1))
+                    data = message[start:start + int(partial.group(2))]
+                    section = b'BODY[]<%i>' % start
+                with server.lock:
+                    server.fetched.setdefault(number, perf_counter())
+            self.wfile.write(head + b' ' + section + b' {%i}\r\n' % len(data) + data)
+            self._send(b')')
+
+    def do_store(self, args, by_uid):
+        """ STORE, only the SEEN flag is kept. """
+        server = self.server
+        numbers, _, flags = args.partition(' ')
+        if '\\SEEN' in flags.upper():
+            for number in parse_set(numbers, len(server.messages)):
+                server.seen[number - 1] = flags.startswith('+')
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    FakeImapServer serves the given messages from one folder.
+
+    It records the time of the first full fetch of each message.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: list[bytes]):
+        super().__init__(('127.0.0.1', 0), FakeImapHandler)
+        self.messages = messages
+        self.seen = [False] * len(messages)
+        self.uidvalidity = 1
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    """
+    One SMTP session of the FakeSmtpServer.
+    """
+
+    bench_pattern = re.compile(rb'^Subject: .*\[bench (\d+)\]', re.MULTILINE)
+
+    def _send(self, line: bytes):
+        """
+        Send one response line.
+        """
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        self._send(b'220 fake smtp ready')
+        receivers = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self._send(b'250-fake smtp\r\n250-SIZE 0\r\n250-8BITMIME\r\n250 PIPELINING')
+            elif command in (b'HELO', b'NOOP'):
+                self._send(b'250 ok')
+            elif command in (b'MAIL', b'RSET'):
+                receivers = 0
+                self._send(b'250 ok')
+            elif command == b'RCPT':
+                receivers += 1
+                self._send(b'250 ok')
+            elif command == b'DATA':
+                self._send(b'354 go ahead')
+                self._read_data(receivers)
+                self._send(b'250 queued')
+            elif command == b'QUIT':
+                self._send(b'221 bye')
+                return
+            else:
+                self._send(b'502 not implemented')
+
+    def _read_data(self, receivers: int):
+        """
+        Read the DATA of one mail, and count it.
+        """
+        header = b''
+        in_header = True
+        while True:
+            line = self.rfile.readline()
+            if line in (b'.\r\n', b''):
+                break
+            if in_header:
+                header += line
+                in_header = line != b'\r\n'
+
+        server = self.server
+        match = self.bench_pattern.search(header)
+        with server.lock:
+            server.messages += 1
+            server.receivers += receivers
+            if match is not None:
+                server.delivered[int(match.group(1))] = perf_counter()
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    """
+    FakeSmtpServer accepts all mails, and counts messages and receivers.
+
+    It records the time of the last delivery of each benchmark post.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSmtpHandler)
+        self.messages = 0
+        self.receivers = 0
+        self.delivered = {}
+        self.lock = threading.Lock()
+
+
+class BenchConfig(maillist.Config):
+    """
+    Config of one benchmark run, without command line arguments.
+    """
+
+    def __init__(self, path: str, options: argparse.Namespace):
+        self.path = path
+        self.options = options
+        super().__init__()
+
+    def _interface_argparse(self):
+        """
+        Use the options of the benchmark instead of the command line.
+        """
+        return argparse.Namespace(
+            config=os.path.join(self.path, 'config'),
+            maillist=os.path.join(self.path, 'maillist.json'),
+            logfile=os.path.join(self.path, 'maillist.log'),
+            sleep=60, verbose=False, test=False, daemon=False, idle=False,
+            asyncio=self.options.asyncio, lists=None, processes=1, profile=False,
+            reduce_logs=True)
+
+    def _get_args(self):
+        """
+        Read the secrets of the benchmark run.
+        """
+        super()._get_args()
+        self.env_file = os.path.join(self.path, '.env')
+
+
+def create_messages(options: argparse.Namespace, subscribers: int) -> tuple:
+    """
+    Create the synthetic posts and commands.
+
+    Returns the messages and the bench ids of the posts.
+    """
+    messages = []
+    posts = []
+    attachment = os.urandom(options.attachment_size)
+    for i in range(options.posts + options.commands):
+        msg = EmailMessage()
+        if i < options.posts:
+            msg['From'] = f'Poster <subscriber{i % subscribers}@bench.example>'
+            msg['Subject'] = f'Post [bench {i}]'
+            msg.set_content('Lorem ipsum dolor sit amet. ' * (options.body_size // 28 + 1))
+            if options.attachment_every > 0 and i % options.attachment_every == 0:
+                msg.add_attachment(attachment, maintype='application', subtype='octet-stream',
+                                   filename=f'attachment{i}.bin')
+            posts.append(i)
+        else:
+            msg['From'] = f'New <new{i}@bench.example>'
+            msg['Subject'] = '$>subscribe'
+            msg.set_content('Please subscribe me.')
+        msg['To'] = 'list@bench.example'
+        msg['Message-ID'] = f'<bench-{i}@bench.example>'
+        messages.append(msg.as_bytes(policy=msg.policy.clone(linesep='\r\n')))
+    return messages, posts
+
+
+def write_config(path: str, options: argparse.Namespace, subscribers: int,
+                 imap_port: int, smtp_port: int):
+    """
+    Write the config, snippets and subscriber list of a benchmark run.
+    """
+    snippets = os.path.join(path, 'snippets')
+    os.makedirs(snippets)
+    with open(os.path.join(snippets, 'footer.txt'), 'w', encoding='utf-8') as file:
+        file.write('Sent by {list_name}, reply with $>unsubscribe {tags} to leave.')
+    with open(os.path.join(snippets, 'footer.html'), 'w', encoding='utf-8') as file:
+        file.write('<p>Sent by {list_name}.</p>')
+
+    with open(os.path.join(path, 'config'), 'w', encoding='utf-8') as file:
+        file.write(f'''[mailbox]
+server = 127.0.0.1
+user = list@bench.example
+ssl = false
+port = {imap_port}
+
+[smtp]
+server = 127.0.0.1
+user =
+port = {smtp_port}
+tls = false
+
+[sender]
+address = list@bench.example
+name = Bench
+
+[test]
+receiver = list@bench.example
+
+[forwarding]
+mode = {options.mode}
+
+[storage]
+backend = {options.storage}
+
+[limits]
+sender_rate = 0
+scope_rate = 0
+
+[snippets]
+list_name = Bench
+footer_text = {snippets}/footer.txt
+footer_html = {snippets}/footer.html
+''')
+
+    with open(os.path.join(path, '.env'), 'w', encoding='utf-8') as file:
+        file.write('mailbox_password = bench\n')
+
+    with open(os.path.join(path, 'maillist.json'), 'w', encoding='utf-8') as file:
+        json.dump({'subscribers': [f'subscriber{i}@bench.example'
+                                   for i in range(subscribers)]}, file)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Get the p-th percentile, using the nearest rank.
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def run(options: argparse.Namespace, subscribers: int) -> dict:
+    """
+    Run the benchmark for one list size.
+    """
+    messages, posts = create_messages(options, subscribers)
+    imap = FakeImapServer(messages)
+    smtp = FakeSmtpServer()
+    for server in (imap, smtp):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            write_config(path, options, subscribers,
+                         imap.server_address[1], smtp.server_address[1])
+            config = BenchConfig(path, options)
+            config.check_config()
+
+            mail_list = maillist.Maillist(config)
+            start = perf_counter()
+            mail_list.process_mails()
+            elapsed = perf_counter() - start
+            mail_list.close()
+    finally:
+        imap.shutdown()
+        smtp.shutdown()
+
+    latencies = [smtp.delivered[i] - imap.fetched[i + 1]
+                 for i in posts if i in smtp.delivered and i + 1 in imap.fetched]
+    return {'subscribers': subscribers,
+            'messages': len(messages),
+            'posts': len(posts),
+            'sent_messages': smtp.messages,
+            'sent_receivers': smtp.receivers,
+            'elapsed_s': elapsed,
+            'messages_per_s': len(messages) / elapsed,
+            'receivers_per_s': smtp.receivers / elapsed,
+            'latency_p50_ms': percentile([t * 1000 for t in latencies], 50),
+            'latency_p99_ms': percentile([t * 1000 for t in latencies], 99),
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def main():
+    """
+    Run the benchmark and print the results as JSON.
+    """
+    parser = argparse.ArgumentParser(description='Mail-list throughput benchmark.')
+    parser.add_argument('--subscribers', default='10,100,1000,10000,100000', type=str,
+                        help='comma separated list sizes')
+    parser.add_argument('--posts', default=20, type=int,
+                        help='number of posts per run')
+    parser.add_argument('--commands', default=5, type=int,
+                        help='number of subscribe commands per run')
+    parser.add_argument('--body-size', default=2000, type=int,
+                        help='size of the post text in bytes')
+    parser.add_argument('--attachment-size', default=100 * 1024, type=int,
+                        help='size of the attachments in bytes')
+    parser.add_argument('--attachment-every', default=5, type=int,
+                        help='add an attachment to every n-th post, 0 for none')
+    parser.add_argument('--mode', default='rebuild', choices=('rebuild', 'raw'),
+                        help='forwarding mode')
+    parser.add_argument('--storage', default='json', choices=('json', 'journal', 'sqlite'),
+                        help='subscriber storage backend')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='use the asyncio engine')
+    parser.add_argument('--output', default=None, type=str,
+                        help='write the JSON results to this file instead of stdout')
+    options = parser.parse_args()
+
+    results = []
+    for subscribers in (int(size) for size in options.subscribers.split(',')):
+        # one process per run, to measure the peak RSS of each run
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(run, options, subscribers).result())
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'options': vars(options),
+              'results': results}
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,34 @@ Tests for mail-list.
 
 import logging
 import os
+import asyncio
 import base64
+import email
+import json
+import urllib.request
+import smtplib
 import pytest
-from maillist import Config, Maillist, main, Sender, Message, Attachment, Subscribers
+import imaplib
+import re
+import maillist
+from imap_tools import MailMessage
+from maillist import Config, Maillist, main, Sender, Message, Attachment, Subscribers, SmtpPool, \
+    Receiver, Outbox, SubscriberCheckResult, MessageSpool, \
+    SnippetTemplate, FOOTER_FIELDS, UNSUBSCRIBE_URL_FIELDS, unsubscribe_token, \
+    AsyncEngine, AsyncImapClient, AsyncSmtpClient, ListHost, MailboxPool, list_names, \
+    host_lists, Metrics, MetricsExporter, CycleProfiler, CycleResult, Scheduler, DedupeStore, \
+    RateLimiter, RawMessage, SendResult, PostDelivery
 
 
 class ArgsDummy:
     """ Replacement for argparser return value. """
     logfile: str = './data/maillist.log'
     daemon: bool = False
+    idle: bool = False
+    asyncio: bool = False
+    lists: str = None
+    processes: int = 1
+    profile: bool = False
     sleep: int = 60
     config: str = './data/config'
     maillist: str = './data/maillist.json'
@@ -131,6 +150,7 @@ class TestConfig:
         config = Config()
         assert config.mailbox_server is None
         assert config.mailbox_user is None
+        assert config.mailbox_page_size == 100
 
     def test_get_config_smtp(self, mocker):
         """ Test smtp config options. """
@@ -151,6 +171,8 @@ class TestConfig:
         assert config.smtp_port is '587'
         assert config.smtp_user is None
         assert config.smtp_tls is True
+        assert config.smtp_pool_size == 4
+        assert config.smtp_max_messages == 100
 
     def test_get_config_sender(self, mocker):
         """ Test sender config options. """
@@ -218,6 +240,17 @@ class TestConfig:
             text = text.format(list_name=config.list_name)
             assert config.unsubscribe_html == text, "subscribe html"
 
+    def test_get_config_snippets_invalid(self, mocker, tmp_path):
+        """ Test broken snippets are reported at startup. """
+        footer = tmp_path / 'footer.txt'
+        footer.write_text('Unsubscribe {tag}', encoding='utf-8')
+        config = self.config.copy()
+        config['snippets'] = dict(config['snippets'], footer_text=str(footer))
+        self._patch_config(mocker, config)
+
+        with pytest.raises(SystemExit):
+            Config()
+
     def test_get_config_no_snippets(self, mocker):
         """ Test snippets config options defaults. """
         config = self.config.copy()
@@ -293,6 +326,15 @@ class TestConfig:
         with pytest.raises(AssertionError):
             config.check_config()
 
+    def test_check_config_idle_asyncio(self, mocker):
+        """ Test that check config detects issues - IDLE with asyncio. """
+        self._patch_defaults(mocker)
+        config = Config()
+        config.idle = True
+        config.use_asyncio = True
+        with pytest.raises(AssertionError):
+            config.check_config()
+
 
 class TestSender:
     """ Test for maillist.Sender. """
@@ -327,10 +369,10 @@ class TestSender:
         args = Sender._interface_smtplib.call_args.args
         assert args[0] == config.sender_address
         assert args[1] == message.receivers
-        assert message.sender_name in args[2]
-        assert message.subject in args[2]
-        assert message.html in args[2]
-        assert message.text in args[2]
+        assert message.sender_name in args[2].decode()
+        assert message.subject in args[2].decode()
+        assert message.html in args[2].decode()
+        assert message.text in args[2].decode()
 
     def test_send_mail_sender_config(self, mocker):
         """ Test for fallback to config sender name. """
@@ -345,7 +387,7 @@ class TestSender:
         sender._interface_smtplib.assert_called_once()
 
         args = Sender._interface_smtplib.call_args.args
-        assert config.sender_name in args[2]
+        assert config.sender_name in args[2].decode()
 
     def test_send_mail_sender_address_fallback(self, mocker):
         """ Test for fallback to sender address as sender name. """
@@ -362,7 +404,7 @@ class TestSender:
         sender._interface_smtplib.assert_called_once()
 
         args = Sender._interface_smtplib.call_args.args
-        assert f'{config.sender_address} <{config.sender_address}>' in args[2]
+        assert f'{config.sender_address} <{config.sender_address}>' in args[2].decode()
 
     def test_send_mail_attachment(self, mocker):
         """ Test for sending mails with attachments. """
@@ -384,9 +426,437 @@ class TestSender:
         sender._interface_smtplib.assert_called_once()
 
         args = Sender._interface_smtplib.call_args.args
-        assert attachment.filename in args[2]
+        assert attachment.filename in args[2].decode()
         assert base64.b64encode(attachment.data).decode(
-            encoding='utf-8') in args[2]
+            encoding='utf-8') in args[2].decode()
+
+    def test_send_mail_attachment_passthrough(self, mocker):
+        """ Test forwarding of original attachment parts. """
+        mocker.patch("maillist.Sender._interface_smtplib")
+        mocker.patch("maillist.encoders.encode_base64")
+        config = self._get_config(mocker)
+        sender = Sender(config)
+
+        original = email.message_from_bytes(
+            b'Content-Type: application/pdf; name="doc.pdf"\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            b'Content-Disposition: attachment; filename="doc.pdf"\r\n'
+            b'\r\n'
+            b'JVBERi0xLjQKJcfsj6IK\r\n')
+        attachment = Attachment()
+        attachment.filename = 'doc.pdf'
+        attachment.mimetype = 'application/pdf'
+        attachment.part = original
+        message = Message()
+        message.text = 'TEXT'
+        message.attachments = [attachment]
+
+        sender.send_mail(message)
+
+        data = Sender._interface_smtplib.call_args.args[2]
+        assert isinstance(data, bytes)
+        assert b'filename="doc.pdf"' in data
+        assert b'JVBERi0xLjQKJcfsj6IK' in data
+        maillist.encoders.encode_base64.assert_not_called()
+
+    def _get_personalized_sender(self, mocker):
+        """ Get sender for personalized messages. """
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        config = self._get_config(mocker)
+        config.personalize = True
+        config.unsubscribe_secret = 'secret'
+        config.personalize_url = SnippetTemplate(
+            'https://list.example/u?a={receiver}&t={token}', UNSUBSCRIBE_URL_FIELDS)
+        return Sender(config)
+
+    def test_send_mail_personalized(self, mocker):
+        """ Test one personalized message per receiver. """
+        sender = self._get_personalized_sender(mocker)
+
+        message = Message()
+        message.receivers = ['a@example.com', 'b+x@example.com']
+        message.text = f'Grüße\nBye: {sender.markers["unsubscribe_url"]}'
+        message.html = f'<p>{sender.markers["receiver"]}</p>'
+        sender.send_mail(message)
+
+        calls = Sender._interface_smtplib.call_args_list
+        assert [call.args[1] for call in calls] == [['a@example.com'], ['b+x@example.com']]
+        for call in calls:
+            receiver = call.args[1][0]
+            token = unsubscribe_token('secret', receiver)
+            url = f'https://list.example/u?a={receiver.replace("+", "%2B")}&t={token}'
+            mail = email.message_from_bytes(call.args[2])
+            assert mail['List-Unsubscribe'] == \
+                f'<{url}>, <mailto:{sender.config.sender_address}?subject=$>unsubscribe>'
+            assert mail['List-Unsubscribe-Post'] == 'List-Unsubscribe=One-Click'
+            parts = {part.get_content_type(): part for part in mail.walk()}
+            text = parts['text/plain'].get_payload(decode=True).decode('utf-8')
+            assert text == f'Grüße\r\nBye: {url}'
+            html = parts['text/html'].get_payload(decode=True).decode('utf-8')
+            assert html == f'<p>{receiver}</p>'
+
+    def test_send_mail_personalized_long_line(self, mocker):
+        """ Test personalized parts keep short lines without 8bit encoding. """
+        sender = self._get_personalized_sender(mocker)
+
+        message = Message()
+        message.receivers = ['a@example.com']
+        message.text = 'Text'
+        message.html = '<html><body><p>' + 'Grüße, ' * 400 + '</p>' + \
+            f'<a href="{sender.markers["unsubscribe_url"]}">{sender.markers["receiver"]}</a>' + \
+            '</body></html>'
+        sender.send_mail(message)
+
+        data = Sender._interface_smtplib.call_args.args[2]
+        body = data.split(b'\r\n\r\n', 1)[1]
+        assert all(len(line) <= 76 for line in body.split(b'\r\n'))
+        assert max(data) < 128
+        mail = email.message_from_bytes(data)
+        parts = {part.get_content_type(): part for part in mail.walk()}
+        assert parts['text/html']['Content-Transfer-Encoding'] == 'quoted-printable'
+        html = parts['text/html'].get_payload(decode=True).decode('utf-8')
+        token = unsubscribe_token('secret', 'a@example.com')
+        assert html == '<html><body><p>' + 'Grüße, ' * 400 + '</p>' + \
+            f'<a href="https://list.example/u?a=a@example.com&t={token}">a@example.com</a>' + \
+            '</body></html>'
+
+    def test_send_mail_personalized_spool(self, mocker):
+        """ Test personalized messages of a spooled message. """
+        sender = self._get_personalized_sender(mocker)
+        sender.config.spool_threshold = 1000
+        spooled = []
+        Sender._interface_smtplib.side_effect = \
+            lambda sender, receivers, data: spooled.append(b''.join(data.chunks(7))) or {}
+
+        message = Message()
+        message.receivers = ['a@example.com', 'b@example.com']
+        message.text = 'TEXT\n' * 500 + sender.markers['receiver']
+        sender.send_mail(message)
+
+        assert len(spooled) == 2
+        for receiver, data in zip(message.receivers, spooled):
+            mail = email.message_from_bytes(data)
+            text = mail.get_payload()[0].get_payload(decode=True).decode('utf-8')
+            assert text.endswith('TEXT\r\n' + receiver)
+
+    def test_send_mail_spool(self, mocker):
+        """ Test spooling of large messages. """
+        spooled = []
+        mocker.patch("maillist.Sender._interface_smtplib",
+                     side_effect=lambda sender, receivers, data: spooled.append(
+                         b''.join(data.chunks(100))) or {})
+        config = self._get_config(mocker)
+        config.spool_threshold = 1000
+        sender = Sender(config)
+
+        message = Message()
+        message.text = 'TEXT\n' * 1000
+        sender.send_mail(message)
+
+        assert len(spooled) == 1
+        assert len(spooled[0]) > 1000
+        assert b'\r\n' in spooled[0]
+        assert b'\n' not in spooled[0].replace(b'\r\n', b'')
+
+    def test_send_mail_batches(self, mocker):
+        """ Test splitting of receivers in batches. """
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        config = self._get_config(mocker)
+        config.smtp_batch_size = 50
+        sender = Sender(config)
+
+        message = Message()
+        message.receivers = [f'{i}@example.com' for i in range(120)]
+
+        result = sender.send_mail(message)
+
+        assert result.ok
+        calls = Sender._interface_smtplib.call_args_list
+        assert len(calls) == 3
+        assert sorted(len(call.args[1]) for call in calls) == [20, 50, 50]
+        assert {r for call in calls for r in call.args[1]} == set(message.receivers)
+        assert all(call.args[2] is calls[0].args[2] for call in calls)
+
+    def test_send_mail_batches_result(self, mocker):
+        """ Test aggregation of batch results. """
+        def interface(sender, receivers, message):
+            if '0@example.com' in receivers:
+                raise smtplib.SMTPDataError(554, b'rejected')
+            return {receivers[0]: (550, b'unknown')}
+
+        mocker.patch("maillist.Sender._interface_smtplib", side_effect=interface)
+        config = self._get_config(mocker)
+        config.smtp_batch_size = 2
+        sender = Sender(config)
+
+        message = Message()
+        message.receivers = [f'{i}@example.com' for i in range(6)]
+
+        result = sender.send_mail(message)
+
+        assert not result.ok
+        assert result.failed == ['0@example.com', '1@example.com']
+        assert set(result.refused.keys()) == {'2@example.com', '4@example.com'}
+
+    def test_submit_metrics(self, mocker):
+        """ Test the metrics of the submit stage. """
+        metrics = mocker.patch("maillist.METRICS", Metrics())
+        mocker.patch("maillist.Sender._interface_smtplib",
+                     side_effect=[smtplib.SMTPDataError(554, b'rejected'),
+                                  {'2@example.com': (550, b'unknown')}])
+        config = self._get_config(mocker)
+        config.smtp_batch_size = 2
+        config.smtp_workers = 1
+        sender = Sender(config)
+
+        message = Message()
+        message.receivers = [f'{i}@example.com' for i in range(4)]
+        sender.send_mail(message)
+
+        snapshot = metrics.snapshot()
+        assert snapshot['counters'] == {'smtp_errors': 1,
+                                        'recipients_delivered': 1,
+                                        'recipients_refused': 1}
+        assert snapshot['stages']['submit']['count'] == 2
+        assert snapshot['stages']['build']['count'] == 1
+
+
+class TestSmtpPool:
+    """ Test for maillist.SmtpPool. """
+
+    def _get_pool(self, mocker):
+        """ Get pool with mocked smtplib connections. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        mocker.patch("maillist.SmtpPool._interface_smtplib",
+                     side_effect=lambda: mocker.MagicMock(
+                         **{'rset.return_value': (250, b'OK'),
+                            'noop.return_value': (250, b'OK'),
+                            'sendmail.return_value': {}}))
+        return SmtpPool(Config())
+
+    def test_session_reuse(self, mocker):
+        """ Test that sessions are reused across mails. """
+        pool = self._get_pool(mocker)
+
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+        pool.sendmail('a@example.com', ['c@example.com'], 'MAIL')
+
+        pool._interface_smtplib.assert_called_once()
+        smtp = pool._idle[0].smtp
+        assert smtp.sendmail.call_count == 2
+        smtp.rset.assert_called_once()
+
+    def test_reconnect(self, mocker):
+        """ Test transparent reconnect of dropped sessions. """
+        pool = self._get_pool(mocker)
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+        pool._idle[0].smtp.rset.side_effect = smtplib.SMTPServerDisconnected()
+
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+
+        assert pool._interface_smtplib.call_count == 2
+        assert len(pool._idle) == 1
+
+    def test_reconnect_on_send(self, mocker):
+        """ Test resend if the session is dropped during sending. """
+        pool = self._get_pool(mocker)
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+        pool._idle[0].smtp.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+
+        assert pool._interface_smtplib.call_count == 2
+        assert pool._idle[0].messages == 1
+
+    def test_max_messages(self, mocker):
+        """ Test that sessions are closed after max messages. """
+        pool = self._get_pool(mocker)
+        pool.config.smtp_max_messages = 2
+
+        for _ in range(3):
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+
+        assert pool._interface_smtplib.call_count == 2
+
+    def test_pinned(self, mocker):
+        """ Test sending several mails using one pinned session. """
+        pool = self._get_pool(mocker)
+
+        with pool.pinned():
+            for _ in range(3):
+                pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+            assert len(pool._idle) == 0
+
+        pool._interface_smtplib.assert_called_once()
+        smtp = pool._idle[0].smtp
+        assert smtp.sendmail.call_count == 3
+        smtp.rset.assert_not_called()
+
+    def test_pinned_reconnect(self, mocker):
+        """ Test a pinned session is reconnected after a connection error. """
+        pool = self._get_pool(mocker)
+
+        with pool.pinned():
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+            pool._local.session.smtp.sendmail.side_effect = ConnectionResetError()
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+
+        assert pool._interface_smtplib.call_count == 2
+        assert pool._idle[0].smtp.sendmail.call_count == 2
+
+    def test_pinned_reply_error(self, mocker):
+        """ Test an SMTP error reply neither reconnects nor resends. """
+        pool = self._get_pool(mocker)
+
+        with pool.pinned():
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+            pool._local.session.smtp.sendmail.side_effect = [
+                smtplib.SMTPDataError(554, b'rejected'), {}]
+            with pytest.raises(smtplib.SMTPDataError):
+                pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+            pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+
+        pool._interface_smtplib.assert_called_once()
+        assert pool._idle[0].smtp.sendmail.call_count == 3
+
+    def test_send_spool(self, mocker, tmp_path):
+        """ Test streaming of spooled messages. """
+        pool = self._get_pool(mocker)
+        path = tmp_path / 'message.eml'
+        path.write_bytes(b'Subject: test\n\n' + b'.dot\r\n' * 10000 + b'end')
+        spool = MessageSpool.open(str(path))
+        smtp = mocker.MagicMock(does_esmtp=True)
+        smtp.mail.return_value = (250, b'OK')
+        smtp.rcpt.side_effect = [(250, b'OK'), (550, b'unknown')]
+        smtp.docmd.return_value = (354, b'go ahead')
+        smtp.getreply.return_value = (250, b'OK')
+
+        refused = pool._send(smtp, 'a@example.com', ['b@example.com', 'c@example.com'], spool)
+        spool.close()
+
+        assert refused == {'c@example.com': (550, b'unknown')}
+        assert smtp.send.call_count > 2
+        data = b''.join(call.args[0] for call in smtp.send.call_args_list)
+        assert data == b'Subject: test\r\n\r\n' + b'..dot\r\n' * 10000 + b'end\r\n.\r\n'
+
+    def test_send_spool_data_refused(self, mocker, tmp_path):
+        """ Test the session is reset if DATA is refused. """
+        pool = self._get_pool(mocker)
+        path = tmp_path / 'message.eml'
+        path.write_bytes(b'Subject: test\n\nbody')
+        spool = MessageSpool.open(str(path))
+        smtp = mocker.MagicMock(does_esmtp=True)
+        smtp.mail.return_value = (250, b'OK')
+        smtp.rcpt.return_value = (250, b'OK')
+        smtp.docmd.return_value = (451, b'try again')
+
+        with pytest.raises(smtplib.SMTPDataError):
+            pool._send(smtp, 'a@example.com', ['b@example.com'], spool)
+        spool.close()
+
+        smtp.rset.assert_called_once()
+        smtp.send.assert_not_called()
+
+    def test_keepalive(self, mocker):
+        """ Test that dead idle sessions are dropped. """
+        pool = self._get_pool(mocker)
+        pool.sendmail('a@example.com', ['b@example.com'], 'MAIL')
+        smtp = pool._idle[0].smtp
+        smtp.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+        pool.keepalive()
+
+        assert len(pool._idle) == 0
+        smtp.quit.assert_called_once()
+
+
+class TestOutbox:
+    """ Test for maillist.Outbox. """
+
+    def _get_outbox(self, mocker, path):
+        """ Get outbox in the given folder. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        config = Config()
+        config.outbox_path = str(path)
+        sender = Sender(config)
+        sender.outbox = Outbox(config, sender)
+        return sender.outbox
+
+    def test_send_mail_spool(self, mocker, tmp_path):
+        """ Test that sent mails are written to the outbox. """
+        outbox = self._get_outbox(mocker, tmp_path)
+
+        message = Message()
+        message.receivers = ['a@example.com', 'b@example.com']
+        message.text = 'TEXT'
+        outbox.sender.send_mail(message)
+
+        Sender._interface_smtplib.assert_not_called()
+        assert len(list(tmp_path.glob('*.eml'))) == 1
+        assert len(list(tmp_path.glob('*.json'))) == 1
+
+    def test_deliver(self, mocker, tmp_path):
+        """ Test delivery of outbox entries. """
+        outbox = self._get_outbox(mocker, tmp_path)
+        outbox.put('list@example.com', ['a@example.com'], 'MAIL')
+
+        assert outbox.deliver() is None
+
+        Sender._interface_smtplib.assert_called_once_with(
+            'list@example.com', ['a@example.com'], b'MAIL')
+        assert len(list(tmp_path.glob('*.eml'))) == 0
+        assert len(list(tmp_path.glob('*.json'))) == 0
+
+    def test_deliver_retry(self, mocker, tmp_path):
+        """ Test retry of failed receivers with backoff. """
+        outbox = self._get_outbox(mocker, tmp_path)
+        outbox.config.outbox_backoff = 10
+        Sender._interface_smtplib.return_value = {'b@example.com': (451, b'later'),
+                                                  'c@example.com': (550, b'unknown')}
+        entry_id = outbox.put('list@example.com',
+                              ['a@example.com', 'b@example.com', 'c@example.com'], 'MAIL')
+
+        assert 0 < outbox.deliver() <= 10
+
+        with open(tmp_path / f'{entry_id}.json', 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        assert meta['receivers'] == ['b@example.com']
+        assert meta['attempts'] == 1
+
+        # not due yet
+        Sender._interface_smtplib.reset_mock()
+        outbox.deliver()
+        Sender._interface_smtplib.assert_not_called()
+
+    def test_deliver_give_up(self, mocker, tmp_path):
+        """ Test that entries are moved to failed after all retries. """
+        outbox = self._get_outbox(mocker, tmp_path)
+        outbox.config.outbox_retries = 0
+        Sender._interface_smtplib.side_effect = smtplib.SMTPServerDisconnected()
+        entry_id = outbox.put('list@example.com', ['a@example.com'], 'MAIL')
+
+        assert outbox.deliver() is None
+
+        assert (tmp_path / 'failed' / f'{entry_id}.eml').exists()
+        assert (tmp_path / 'failed' / f'{entry_id}.json').exists()
+
+    def test_cleanup(self, mocker, tmp_path):
+        """ Test removal of incomplete entries. """
+        (tmp_path / '1-abc.eml').write_bytes(b'MAIL')
+        (tmp_path / '2-abc.json.tmp').write_bytes(b'{}')
+
+        self._get_outbox(mocker, tmp_path)
+
+        assert list(tmp_path.glob('*.eml')) == []
+        assert list(tmp_path.glob('*.tmp')) == []
 
 
 class TestSubscribers:
@@ -410,6 +880,7 @@ class TestSubscribers:
     def _get_subscribers(self, mocker):
         """ Get default subscriber. """
         mocker.patch("maillist.Subscribers._save_list")
+        mocker.patch("maillist.JsonStorage.save")
         self.config = self._get_config(mocker)
         self.sender = self._get_sender(mocker, self.config)
         self.config.maillist_file = 'NO_FILE'
@@ -461,6 +932,20 @@ class TestSubscribers:
                                       'b_test@subscriber.de',
                                       'a_b_test@subscriber.de']), 'b, test'
 
+    def test_get_subscribers_index(self, mocker):
+        """ Test that the tag index follows list changes. """
+        subscribers = self._get_subscribers(mocker)
+        subscribers._list['a#test'] = ['a_test@subscriber.de']
+
+        subscribers._add_subscriber('b_test@subscriber.de', ['Test', 'B'])
+        assert subscribers._list.scopes_with(['test']) == {'a#test', 'b#test'}
+        assert set(subscribers._get_subscribers(['test'])) == set(['a_test@subscriber.de',
+                                                                   'b_test@subscriber.de'])
+
+        del subscribers._list['a#test']
+        assert subscribers._list.scopes_with(['a']) == set()
+        assert subscribers._get_subscribers(['test']) == ['b_test@subscriber.de']
+
     def test_is_allowed(self, mocker):
         """ Test for allowed senders.  """
         subscribers = self._get_subscribers(mocker)
@@ -486,6 +971,166 @@ class TestSubscribers:
         allowed = subscribers._is_allowed('no@subscriber.de', tags)
         assert allowed is False, 'no subscriber'
 
+    def test_is_allowed_no_tags(self, mocker):
+        """ Test that tag subscribers can't send to the full list. """
+        subscribers = self._get_subscribers(mocker)
+        subscribers._list['test'] = ['test@subscriber.de']
+
+        assert subscribers._is_allowed('test@subscriber.de') is False
+        assert subscribers._is_allowed('test@subscriber.de', ['test']) is True
+
+    def test_address_index(self, mocker):
+        """ Test scope lookup by address. """
+        subscribers = self._get_subscribers(mocker)
+        subscribers._list['subscribers'] = ['full@subscriber.de']
+        subscribers._list['test'] = ['test@subscriber.de', 'full@subscriber.de']
+
+        assert subscribers._list.scopes_of('full@subscriber.de') == {'subscribers', 'test'}
+
+        subscribers._list['test'] = ['test@subscriber.de']
+        assert subscribers._list.scopes_of('full@subscriber.de') == {'subscribers'}
+
+        subscribers._add_subscriber('test@subscriber.de', ['a'])
+        assert subscribers._list.scopes_of('test@subscriber.de') == {'test', 'a'}
+
+        subscribers._remove_subscriber('test@subscriber.de')
+        assert subscribers._list.scopes_of('test@subscriber.de') == set()
+        assert subscribers._list['test'] == []
+        assert subscribers._list['a'] == []
+
+        subscribers._remove_subscriber('full@subscriber.de', ['unknown'])
+        assert subscribers._list.scopes_of('full@subscriber.de') == {'subscribers'}
+
+    def test_check_sender_not_in_receivers(self, mocker):
+        """ Test forwarding a post to a narrower scope than the sender's. """
+        subscribers = self._get_subscribers(mocker)
+        subscribers._list['test'] = ['test@subscriber.de']
+        subscribers._list['b#test'] = ['b_test@subscriber.de']
+
+        result = subscribers.check('Hello #test #b', 'test@subscriber.de')
+
+        assert result.forward is True
+        assert result.receivers == ['b_test@subscriber.de']
+
+    def _get_storage_subscribers(self, mocker, tmp_path, backend):
+        """ Get subscribers using files in tmp_path. """
+        config = self._get_config(mocker)
+        config.maillist_file = str(tmp_path / 'maillist.json')
+        config.database_file = str(tmp_path / 'maillist.db')
+        config.storage_backend = backend
+        return Subscribers(config, self._get_sender(mocker, config))
+
+    @pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+    def test_storage(self, mocker, tmp_path, backend):
+        """ Test that changes are persisted by the storage backends. """
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, backend)
+        subscribers._add_subscriber('full@subscriber.de')
+        subscribers._add_subscriber('test@subscriber.de', ['test'])
+        subscribers._add_subscriber('other@subscriber.de', ['test'])
+        subscribers._remove_subscriber('test@subscriber.de')
+
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, backend)
+        assert subscribers._list['subscribers'] == ['full@subscriber.de']
+        assert subscribers._list['test'] == ['other@subscriber.de']
+
+    def test_storage_journal(self, mocker, tmp_path):
+        """ Test journal replay and compaction. """
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'journal')
+        subscribers._storage.compact_after = 3
+        subscribers._add_subscriber('a@subscriber.de')
+        subscribers._add_subscriber('b@subscriber.de')
+
+        with open(tmp_path / 'maillist.json', 'r', encoding='utf-8') as file:
+            assert json.load(file) == {'subscribers': []}
+        assert len((tmp_path / 'maillist.journal').read_text().splitlines()) == 2
+
+        subscribers._add_subscriber('c@subscriber.de')
+
+        with open(tmp_path / 'maillist.json', 'r', encoding='utf-8') as file:
+            assert json.load(file) == {'subscribers': ['a@subscriber.de', 'b@subscriber.de',
+                                                       'c@subscriber.de']}
+        assert (tmp_path / 'maillist.journal').read_text() == ''
+
+    def test_storage_journal_torn_record(self, mocker, tmp_path):
+        """ Test that a torn last journal record is ignored on replay. """
+        with open(tmp_path / 'maillist.json', 'w', encoding='utf-8') as file:
+            json.dump({'subscribers': ['a@subscriber.de']}, file)
+        (tmp_path / 'maillist.journal').write_text(
+            '{"op": "add", "key": "test", "address": "b@subscriber.de"}\n'
+            '{"op": "remove", "key": "subscr')
+
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'journal')
+
+        assert subscribers._list == {'subscribers': ['a@subscriber.de'],
+                                     'test': ['b@subscriber.de']}
+        assert (tmp_path / 'maillist.journal').read_text() == ''
+
+    def test_transaction(self, mocker, tmp_path):
+        """ Test one save and one confirmation batch per transaction. """
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'json')
+        mocker.patch("maillist.JsonStorage.save")
+        mocker.patch("maillist.Sender.send_mails")
+
+        with subscribers.transaction():
+            subscribers.check('$>subscribe', 'a@subscriber.de')
+            subscribers.check('$>subscribe #test', 'b@subscriber.de')
+            subscribers.check('$>unsubscribe', 'a@subscriber.de')
+            subscribers.check('$>unsubscribe #other', 'c@subscriber.de')
+            Sender._interface_smtplib.assert_not_called()
+
+        maillist.JsonStorage.save.assert_called_once()
+        Sender.send_mails.assert_called_once()
+        confirmations = Sender.send_mails.call_args.args[0]
+        assert [message.subject for message in confirmations] == ['Welcome!', 'Welcome!',
+                                                                  'Bye!', 'Bye!']
+        assert subscribers._list == {'subscribers': [], 'test': ['b@subscriber.de']}
+
+    def test_storage_sqlite_migration(self, mocker, tmp_path):
+        """ Test import of the JSON file into a new SQLite database. """
+        with open(tmp_path / 'maillist.json', 'w', encoding='utf-8') as file:
+            json.dump({'subscribers': ['full@subscriber.de'],
+                       'test': ['test@subscriber.de']}, file)
+
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'sqlite')
+        assert dict(subscribers._list) == {'subscribers': ['full@subscriber.de'],
+                                           'test': ['test@subscriber.de']}
+
+        subscribers._remove_subscriber('test@subscriber.de')
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'sqlite')
+        assert dict(subscribers._list) == {'subscribers': ['full@subscriber.de'],
+                                           'test': []}
+
+    def test_storage_sqlite_queries(self, mocker, tmp_path):
+        """ Test that the SQLite storage is queried instead of loaded. """
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'sqlite')
+        mocker.patch("maillist.SqliteStorage.load", side_effect=AssertionError)
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'sqlite')
+        assert dict(subscribers._list) == {'subscribers': []}
+        receivers = mocker.spy(maillist.SqliteStorage, 'receivers')
+
+        with subscribers.transaction():
+            subscribers.check('$>subscribe', 'full@subscriber.de')
+            subscribers.check('$>subscribe #test', 'test@subscriber.de')
+            subscribers.check('$>subscribe #test#other', 'other@subscriber.de')
+            subscribers.check('$>subscribe #test', 'test@subscriber.de')
+            assert subscribers._list.scopes_of('test@subscriber.de') == {'test'}
+
+        # the scopes are not read for logging the changes
+        receivers.assert_not_called()
+        assert subscribers._list.scopes_with(['test']) == {'test', 'other#test'}
+        assert not subscribers._storage._db.in_transaction
+        assert subscribers._is_allowed('test@subscriber.de', ['test'])
+        assert not subscribers._is_allowed('test@subscriber.de', ['other'])
+        assert sorted(subscribers._get_subscribers(['test'])) == [
+            'full@subscriber.de', 'other@subscriber.de', 'test@subscriber.de']
+        assert subscribers._get_subscribers() == ['full@subscriber.de']
+        assert subscribers._list.counts() == {'subscribers': 1, 'test': 1, 'other#test': 1}
+
+        subscribers.check('$>unsubscribe', 'test@subscriber.de')
+        subscribers = self._get_storage_subscribers(mocker, tmp_path, 'sqlite')
+        assert subscribers._list.counts() == {'subscribers': 1, 'test': 0, 'other#test': 1}
+        assert subscribers._list.scopes_with(['other', 'test']) == {'other#test'}
+
     def test_get_tags(self, mocker):
         """ Test for tag extraction. """
         subscribers = self._get_subscribers(mocker)
@@ -499,9 +1144,1215 @@ class TestSubscribers:
         assert tags is None
 
 
+class TestDedupeStore:
+    """ Test for maillist.DedupeStore. """
+
+    def _get_store(self, mocker, tmp_path):
+        """ Get store in tmp_path. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        config = Config()
+        config.dedupe_file = str(tmp_path / 'maillist.dedupe')
+        config.dedupe_ttl = 3600
+        config.dedupe_max_entries = 3
+        return DedupeStore(config)
+
+    def test_key(self, mocker):
+        """ Test the Message-ID key and the content hash fallback. """
+        msg = mocker.MagicMock(from_='a@example.com', subject='Hi', date_str='now',
+                               size_rfc822=10)
+        msg.headers = {'message-id': (' <1@example.com> ',)}
+        other = mocker.MagicMock(from_='b@example.com', subject='Hi', date_str='now',
+                                 size_rfc822=10)
+        other.headers = {'message-id': ('<1@example.com>',)}
+        assert DedupeStore.key(msg) == DedupeStore.key(other)
+
+        msg.headers = {}
+        other.headers = {}
+        assert DedupeStore.key(msg) != DedupeStore.key(other)
+        assert len(DedupeStore.key(msg)) == 16
+
+    def test_persistence(self, mocker, tmp_path):
+        """ Test records are appended by flush and read on startup. """
+        store = self._get_store(mocker, tmp_path)
+        store.add(b'a' * 16)
+        store.add(b'b' * 16)
+        assert not os.path.exists(store.path)
+        store.flush()
+
+        store = DedupeStore(store.config)
+        assert store.seen(b'a' * 16)
+        assert store.seen(b'b' * 16)
+        assert not store.seen(b'c' * 16)
+        assert os.path.getsize(store.path) == 2 * maillist.DEDUPE_RECORD.size
+
+    def test_eviction(self, mocker, tmp_path):
+        """ Test TTL and size bound eviction, and compaction. """
+        store = self._get_store(mocker, tmp_path)
+        now = int(maillist.time.time())
+        with open(store.path, 'wb') as file:
+            file.write(maillist.DEDUPE_RECORD.pack(b'a' * 16, now - 7200))
+            for digest in (b'b', b'c', b'd', b'e'):
+                file.write(maillist.DEDUPE_RECORD.pack(digest * 16, now))
+            file.write(b'torn')
+
+        store = DedupeStore(store.config)
+
+        assert not store.seen(b'a' * 16)
+        assert not store.seen(b'b' * 16)
+        assert all(store.seen(digest * 16) for digest in (b'c', b'd', b'e'))
+        assert os.path.getsize(store.path) == 3 * maillist.DEDUPE_RECORD.size
+
+    def test_eviction_linear(self, mocker, tmp_path):
+        """ Test evicting many expired records takes linear time. """
+        store = self._get_store(mocker, tmp_path)
+        store.config.dedupe_max_entries = 100000
+        now = int(maillist.time.time())
+        with open(store.path, 'wb') as file:
+            file.write(b''.join(maillist.DEDUPE_RECORD.pack(i.to_bytes(16, 'little'), now - 7200)
+                                for i in range(100000)))
+
+        start = maillist.monotonic()
+        store = DedupeStore(store.config)
+
+        assert maillist.monotonic() - start < 3
+        assert len(store._entries) == 0
+        assert os.path.getsize(store.path) == 0
+
+
+class TestRateLimiter:
+    """ Test for maillist.RateLimiter. """
+
+    def test_token_bucket(self, mocker):
+        """ Test bursts and refill of the token buckets. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        config = Config()
+        config.limit_sender_rate = 3600
+        config.limit_sender_burst = 2
+        config.limit_scope_rate = 0
+        clock = mocker.patch("maillist.monotonic", return_value=100.0)
+        limiter = RateLimiter(config)
+
+        assert [limiter.allow('sender', 'a') for _ in range(3)] == [True, True, False]
+        assert limiter.allow('sender', 'b')
+        assert all(limiter.allow('scope', 'subscribers') for _ in range(100))
+
+        clock.return_value = 101.5
+        assert [limiter.allow('sender', 'a') for _ in range(2)] == [True, False]
+
+
 class TestReceiver:
     """ Test for maillist.Receiver. """
 
+    @pytest.fixture(autouse=True)
+    def _tmp_path(self, tmp_path):
+        """ Keep the sync state in a temporary folder. """
+        self.tmp_path = tmp_path
+
+    def _get_mailbox(self, mocker):
+        """ Get mocked mailbox. """
+        mailbox = mocker.MagicMock()
+        mailbox.__enter__.return_value = mailbox
+        mailbox.folder.status.return_value = {'UIDVALIDITY': 7, 'UIDNEXT': 11}
+        mailbox.uids.return_value = []
+        mailbox.client.uid.return_value = ('OK', [])
+        return mailbox
+
+    def _get_receiver(self, mocker, idle=True):
+        """ Get receiver with mocked mailbox and sender. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        mocker.patch("maillist.Subscribers._save_list")
+        mocker.patch("maillist.JsonStorage.save")
+        mocker.patch("maillist.Receiver._interface_imap",
+                     side_effect=lambda: self._get_mailbox(mocker))
+        config = Config()
+        config.idle = idle
+        config.maillist_file = 'NO_FILE'
+        config.sync_file = str(self.tmp_path / 'maillist.sync.json')
+        config.dedupe = True
+        config.dedupe_file = str(self.tmp_path / 'maillist.dedupe')
+        sender = Sender(config)
+        return Receiver(config, Subscribers(config, sender), sender)
+
+    def test_session_reuse(self, mocker):
+        """ Test that IDLE mode keeps the mailbox session. """
+        receiver = self._get_receiver(mocker)
+
+        receiver.process_mails()
+        receiver.process_mails()
+
+        receiver._interface_imap.assert_called_once()
+
+    def test_session_per_cycle(self, mocker):
+        """ Test that polling mode logs in every cycle. """
+        receiver = self._get_receiver(mocker, idle=False)
+
+        receiver.process_mails()
+        receiver.process_mails()
+
+        assert receiver._interface_imap.call_count == 2
+
+    def test_session_reconnect(self, mocker):
+        """ Test re-login if the session was dropped. """
+        receiver = self._get_receiver(mocker)
+        receiver.process_mails()
+        mailbox = receiver._mailbox
+        mailbox.uids.side_effect = imaplib.IMAP4.abort('socket error: EOF')
+
+        receiver.process_mails()
+
+        assert receiver._interface_imap.call_count == 2
+        assert receiver._mailbox is not mailbox
+
+    def test_process_mails_pages(self, mocker):
+        """ Test paged bulk fetch and flagging per page. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.mailbox_page_size = 100
+        mocker.patch("maillist.Receiver._process_message")
+        mailbox = receiver._get_mailbox()
+        uids = [str(uid) for uid in range(1, 251)]
+        mailbox.uids.return_value = uids
+        mailbox.fetch.side_effect = lambda criteria, **kwargs: [mocker.MagicMock()]
+
+        mocker.patch("maillist.Receiver._triage_message", return_value=None)
+
+        receiver.process_mails()
+
+        assert mailbox.fetch.call_count == 3
+        assert all(call.kwargs['bulk'] for call in mailbox.fetch.call_args_list)
+        assert all(call.kwargs['headers_only'] for call in mailbox.fetch.call_args_list)
+        pages = [call.args[0] for call in mailbox.flag.call_args_list]
+        assert pages == [uids[:100], uids[100:200], uids[200:]]
+        assert receiver._triage_message.call_count == 3
+        receiver._process_message.assert_not_called()
+
+    def test_process_mails_limit(self, mocker):
+        """ Test the limit of new mails per cycle. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.mailbox_page_size = 100
+        receiver.config.schedule_max_messages = 150
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 0, 'deferred': {}}
+        mocker.patch("maillist.Receiver._triage_message", return_value=None)
+        mailbox = receiver._get_mailbox()
+        uids = [str(uid) for uid in range(1, 251)]
+        mailbox.uids.return_value = uids
+        mailbox.fetch.side_effect = lambda criteria, **kwargs: []
+
+        result = receiver.process_mails()
+
+        assert (result.processed, result.remaining) == (150, 100)
+        pages = [call.args[0] for call in mailbox.flag.call_args_list]
+        assert pages == [uids[:100], uids[100:150]]
+        assert receiver._sync_state['last_uid'] == 150
+
+    def _get_header(self, mocker, uid, subject, size=1000):
+        """ Get header only message. """
+        msg = mocker.MagicMock()
+        msg.uid = uid
+        msg.subject = subject
+        msg.from_ = 'full@subscriber.de'
+        msg.size_rfc822 = size
+        msg.headers = {'message-id': (f'<{uid}@subscriber.de>',)}
+        return msg
+
+    def test_process_mails_triage(self, mocker):
+        """ Test that only forwarded posts are fetched completely. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.mailbox_max_size = 10000
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        mocker.patch("maillist.Receiver._process_message")
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.return_value = ['1', '2', '3']
+        headers = [self._get_header(mocker, '1', '$>subscribe #test'),
+                   self._get_header(mocker, '2', 'Hello'),
+                   self._get_header(mocker, '3', 'Huge', size=20000)]
+        mailbox.fetch.side_effect = [headers]
+        mailbox.client.uid.return_value = ('OK', [
+            (b'1 (UID 2 BODY[] {22}', b'Subject: Hello\r\n\r\nHi\r\n'), b')'])
+
+        receiver.process_mails()
+
+        assert mailbox.fetch.call_count == 1
+        mailbox.client.uid.assert_called_once_with('FETCH', '2', '(UID BODY.PEEK[])')
+        receiver._process_message.assert_called_once()
+        msg, raw, result = receiver._process_message.call_args.args
+        assert msg is headers[1]
+        assert raw.text == 'Hi\r\n'
+        assert result.receivers == ['other@subscriber.de']
+
+    def test_process_mails_duplicate(self, mocker):
+        """ Test that a post is forwarded only once. """
+        receiver = self._get_receiver(mocker)
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        mocker.patch("maillist.Sender.send_mail", return_value=SendResult())
+        mocker.spy(receiver.subscribers, 'check')
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.return_value = ['1', '2']
+        first = self._get_header(mocker, '1', 'Hello')
+        second = self._get_header(mocker, '2', 'Hello')
+        second.headers = first.headers
+        mailbox.fetch.side_effect = [[first, second]]
+        mailbox.client.uid.return_value = ('OK', [
+            (b'1 (UID 1 BODY[] {22}', b'Subject: Hello\r\n\r\nHi\r\n'), b')'])
+
+        receiver.process_mails()
+
+        receiver.sender.send_mail.assert_called_once()
+        receiver.subscribers.check.assert_called_once()
+        assert DedupeStore(receiver.config).seen(DedupeStore.key(first))
+
+    def test_process_mails_duplicate_failed(self, mocker):
+        """ Test that a post which was not sent is forwarded when it arrives again. """
+        receiver = self._get_receiver(mocker)
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        failed = SendResult()
+        failed.failed = ['full@subscriber.de', 'other@subscriber.de']
+        mocker.patch("maillist.Sender.send_mail", side_effect=[failed, SendResult()])
+        mailbox = receiver._get_mailbox()
+        first = self._get_header(mocker, '1', 'Hello')
+        second = self._get_header(mocker, '12', 'Hello')
+        second.headers = first.headers
+        mailbox.fetch.side_effect = [[first], [second]]
+        mailbox.client.uid.return_value = ('OK', [
+            (b'1 (UID 1 BODY[] {22}', b'Subject: Hello\r\n\r\nHi\r\n'), b')'])
+
+        mailbox.uids.return_value = ['1']
+        receiver.process_mails()
+        assert not receiver.dedupe.seen(DedupeStore.key(first))
+
+        mailbox.uids.return_value = ['12']
+        mailbox.client.uid.return_value = ('OK', [
+            (b'2 (UID 12 BODY[] {22}', b'Subject: Hello\r\n\r\nHi\r\n'), b')'])
+        receiver.process_mails()
+
+        assert receiver.sender.send_mail.call_count == 2
+        assert DedupeStore(receiver.config).seen(DedupeStore.key(first))
+
+    @pytest.mark.parametrize('headers', [
+        {'x-loop': ('info@360tasks.de',)},
+        {'list-id': ('Info <info.360tasks.de>',)},
+        {'auto-submitted': ('auto-replied',)},
+        {'precedence': ('Bulk',)},
+    ])
+    def test_triage_loop(self, mocker, headers):
+        """ Test that mails of this list and auto-replies are dropped. """
+        receiver = self._get_receiver(mocker)
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        mocker.spy(receiver.subscribers, 'check')
+        msg = self._get_header(mocker, '1', 'Hello')
+        msg.headers = headers
+
+        assert receiver._triage_message(msg) is None
+        receiver.subscribers.check.assert_not_called()
+
+    def test_triage_no_loop(self, mocker):
+        """ Test that posts of other lists and manual replies are forwarded. """
+        receiver = self._get_receiver(mocker)
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        msg = self._get_header(mocker, '1', 'Hello')
+        msg.headers = {'auto-submitted': ('no',), 'list-id': ('<other.example.com>',),
+                       'x-loop': ('other@example.com',), 'precedence': ('list',)}
+
+        assert receiver._triage_message(msg).receivers == ['other@subscriber.de']
+
+    @pytest.mark.parametrize('policy', ['defer', 'drop'])
+    def test_rate_limit(self, mocker, policy):
+        """ Test limited posts are deferred to the next cycle, or dropped. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.limit_policy = policy
+        receiver.limiter.limits['sender'] = (1, 2)
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 0, 'deferred': {}}
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        mocker.patch("maillist.Receiver._process_message")
+        mocker.patch("maillist.time.time", return_value=1000)
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.return_value = ['1', '2', '3']
+        headers = [self._get_header(mocker, uid, 'Hello') for uid in ('1', '2', '3')]
+        mailbox.fetch.side_effect = lambda criteria, **kwargs: headers
+
+        assert receiver.process_mails().processed == 3
+
+        deferred = {'3': 1000} if policy == 'defer' else {}
+        assert receiver._load_sync_state() == {'uidvalidity': 7, 'last_uid': 3,
+                                               'deferred': deferred}
+
+        mailbox.uids.side_effect = lambda criteria: ['3'] if str(criteria) == '(UID 3)' else []
+        headers = headers[2:]
+        result = receiver.process_mails()
+
+        assert result.processed == 0
+        pages = [call.args[0] for call in mailbox.flag.call_args_list]
+        assert pages[1:] == ([['3']] if deferred else [])
+        assert receiver._load_sync_state()['deferred'] == deferred
+
+    def test_rate_limit_refund(self, mocker):
+        """ Test a post held back by the scope limit gives back the sender token. """
+        receiver = self._get_receiver(mocker)
+        receiver.limiter.limits['sender'] = (1, 1)
+        receiver.limiter.limits['scope'] = (1, 1)
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 0, 'deferred': {}}
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+        assert receiver.limiter.allow('scope', 'subscribers')
+
+        msg = self._get_header(mocker, '1', 'Hello')
+        assert receiver._triage_message(msg) is None
+        assert receiver.limiter.allow('sender', msg.from_.lower())
+
+    def test_rate_limit_refund_rejected(self, mocker):
+        """ Test a rejected post gives back the sender and scope tokens. """
+        receiver = self._get_receiver(mocker)
+        receiver.limiter.limits['sender'] = (1, 1)
+        receiver.limiter.limits['scope'] = (1, 1)
+        receiver.config.mailbox_max_size = 100
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 0, 'deferred': {}}
+        receiver.subscribers._list['subscribers'] = ['full@subscriber.de',
+                                                     'other@subscriber.de']
+
+        msg = self._get_header(mocker, '1', 'Hello')
+        msg.size_rfc822 = 1000
+        assert receiver._triage_message(msg) is None
+
+        msg.size_rfc822 = 10
+        assert receiver._triage_message(msg).receivers == ['other@subscriber.de']
+
+    def test_rate_limit_deferred_max(self, mocker):
+        """ Test deferred posts are dropped when too old, or too many. """
+        receiver = self._get_receiver(mocker)
+        receiver.limiter.limits['sender'] = (1, 1)
+        receiver.config.limit_defer_max_age = 100
+        receiver.config.limit_defer_max_count = 2
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 3,
+                                'deferred': {'1': 1000, '2': 1050}}
+        mocker.patch("maillist.time.time", return_value=1120)
+        assert receiver.limiter.allow('sender', 'full@subscriber.de')
+
+        receiver._triage_message(self._get_header(mocker, '1', 'Hello'))
+        receiver._triage_message(self._get_header(mocker, '2', 'Hello'))
+        assert receiver._sync_state['deferred'] == {'2': 1050}
+
+        receiver._sync_state['deferred']['3'] = 1100
+        receiver._triage_message(self._get_header(mocker, '4', 'Hello'))
+        assert receiver._sync_state['deferred'] == {'2': 1050, '3': 1100}
+
+    def test_rate_limit_deferred_expunged(self, mocker):
+        """ Test deferred posts removed from the mailbox are forgotten. """
+        receiver = self._get_receiver(mocker)
+        mocker.patch("maillist.Receiver._triage_message", return_value=None)
+        receiver._sync_state = {'uidvalidity': 7, 'last_uid': 10,
+                                'deferred': {'3': 1000, '5': 1000}}
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.side_effect = lambda criteria: ['5'] if str(criteria) == '(UID 3,5)' else []
+
+        receiver.process_mails()
+
+        assert str(mailbox.fetch.call_args.args[0]) == '(UID 5)'
+        assert receiver._sync_state['deferred'] == {'5': 1000}
+
+    def test_sync_state_deferred_list(self, mocker):
+        """ Test deferred UIDs saved as list are loaded with the current time. """
+        receiver = self._get_receiver(mocker)
+        mocker.patch("maillist.time.time", return_value=1000)
+        with open(receiver.config.sync_file, 'w', encoding='utf-8') as file:
+            json.dump({'uidvalidity': 7, 'last_uid': 3, 'deferred': ['3']}, file)
+
+        assert receiver._load_sync_state()['deferred'] == {'3': 1000}
+
+    def test_sync_state(self, mocker):
+        """ Test incremental fetch based on the last processed UID. """
+        receiver = self._get_receiver(mocker)
+        mocker.patch("maillist.Receiver._triage_message", return_value=None)
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.return_value = ['9', '4']
+
+        receiver.process_mails()
+
+        assert str(mailbox.uids.call_args.args[0]) == '(UNSEEN)'
+        assert receiver._load_sync_state() == {'uidvalidity': 7, 'last_uid': 10, 'deferred': {}}
+
+        mailbox.uids.return_value = ['10', '11', '12']
+        mailbox.fetch.reset_mock()
+        receiver.process_mails()
+
+        assert str(mailbox.uids.call_args.args[0]) == '(UID 11:*)'
+        assert str(mailbox.fetch.call_args.args[0]) == '(UID 11,12)'
+        assert receiver._load_sync_state() == {'uidvalidity': 7, 'last_uid': 12, 'deferred': {}}
+
+    def test_sync_state_uidvalidity(self, mocker):
+        """ Test full resync on UIDVALIDITY change. """
+        receiver = self._get_receiver(mocker)
+        mocker.patch("maillist.Receiver._triage_message", return_value=None)
+        receiver._sync_state = {'uidvalidity': 3, 'last_uid': 500, 'deferred': {}}
+        mailbox = receiver._get_mailbox()
+        mailbox.uids.return_value = ['4']
+
+        receiver.process_mails()
+
+        assert str(mailbox.uids.call_args.args[0]) == '(UNSEEN)'
+        assert str(mailbox.fetch.call_args.args[0]) == '(UID 4)'
+        assert receiver._load_sync_state() == {'uidvalidity': 7, 'last_uid': 10, 'deferred': {}}
+
+    def _get_post(self):
+        """ Get a post with alternative bodies, inline image and attachment. """
+        return (
+            b'From: Full Subscriber <full@subscriber.de>\r\n'
+            b'To: list@example.com\r\n'
+            b'Subject: Hello\r\n'
+            b'DKIM-Signature: v=1; a=rsa-sha256; b=abc\r\n'
+            b'MIME-Version: 1.0\r\n'
+            b'Content-Type: multipart/mixed; boundary="outer"\r\n'
+            b'\r\n'
+            b'--outer\r\n'
+            b'Content-Type: multipart/alternative; boundary="alt"\r\n'
+            b'\r\n'
+            b'--alt\r\n'
+            b'Content-Type: text/plain; charset="iso-8859-1"\r\n'
+            b'Content-Transfer-Encoding: quoted-printable\r\n'
+            b'\r\n'
+            b'Gr=FC=DFe\r\n'
+            b'--alt\r\n'
+            b'Content-Type: multipart/related; boundary="rel"\r\n'
+            b'\r\n'
+            b'--rel\r\n'
+            b'Content-Type: text/html; charset="utf-8"\r\n'
+            b'\r\n'
+            b'<html><BODY><img src="cid:logo"></BODY></html>\r\n'
+            b'--rel\r\n'
+            b'Content-Type: image/png\r\n'
+            b'Content-ID: <logo>\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            b'\r\n'
+            b'iVBORw0KGgo=\r\n'
+            b'--rel--\r\n'
+            b'--alt--\r\n'
+            b'--outer\r\n'
+            b'Content-Type: application/pdf\r\n'
+            b'Content-Disposition: attachment; filename="doc.pdf"\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            b'\r\n'
+            b'JVBERi0xLjQKJcfsj6IK\r\n'
+            b'--outer--\r\n')
+
+    def _process_post(self, receiver, data: bytes, receivers: list[str]):
+        """ Forward the post given as bytes. """
+        receiver._process_message(MailMessage.from_bytes(data), RawMessage(data),
+                                  self._get_result(receivers))
+
+    def _get_result(self, receivers):
+        """ Get check result for a post. """
+        result = SubscriberCheckResult()
+        result.forward = True
+        result.receivers = receivers
+        return result
+
+    def test_process_message_raw(self, mocker):
+        """ Test raw forwarding with rewritten headers and footers. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.forward_mode = 'raw'
+        receiver.config.footer_text_template = SnippetTemplate('FOOTER {list_name}', FOOTER_FIELDS)
+        receiver.config.footer_html_template = SnippetTemplate('<p>FOOTER</p>', FOOTER_FIELDS)
+        get_message = mocker.spy(maillist.RawPart, 'get_message')
+
+        self._process_post(receiver, self._get_post(), ['a@subscriber.de'])
+
+        # only the text parts are parsed, the other parts are copied
+        assert get_message.call_count == 2
+        args = Sender._interface_smtplib.call_args.args
+        assert args[1] == ['a@subscriber.de']
+        forwarded = email.message_from_bytes(args[2])
+        assert forwarded['From'] == f'Full Subscriber <{receiver.config.sender_address}>'
+        assert forwarded['DKIM-Signature'] is None
+        assert forwarded['List-Id'] == '<info.360tasks.de>'
+        assert forwarded['X-Loop'] == receiver.config.sender_address
+
+        parts = {part.get_content_type(): part for part in forwarded.walk()}
+        text = parts['text/plain'].get_payload(decode=True).decode('iso-8859-1')
+        assert text.startswith('Grüße') and text.endswith('FOOTER info@360tasks.de')
+        html = parts['text/html'].get_payload(decode=True).decode('utf-8')
+        assert '<p>FOOTER</p></BODY>' in html
+        assert parts['image/png']['Content-ID'] == '<logo>'
+        assert parts['image/png'].get_payload().strip() == 'iVBORw0KGgo='
+        assert parts['application/pdf'].get_payload().strip() == 'JVBERi0xLjQKJcfsj6IK'
+
+    def test_fetch_posts_spooled(self, mocker):
+        """ Test large posts are fetched in chunks into a spool file. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.spool_threshold = 256
+        data = self._get_post()
+
+        def uid(command, uids, items):
+            start, size = (int(value) for value in re.search(r'<(\d+)\.(\d+)>', items).groups())
+            chunk = data[start:start + size]
+            return 'OK', [(b'1 (UID 2 BODY[]<%i> {%i}' % (start, len(chunk)), chunk), b')']
+
+        mailbox = receiver._get_mailbox()
+        mailbox.client.uid.side_effect = uid
+        header = self._get_header(mocker, '2', 'Hello', size=len(data))
+
+        [(msg, raw)] = list(receiver._fetch_posts(mailbox, [header]))
+
+        assert msg is header
+        assert mailbox.client.uid.call_count == len(data) // 256 + 1
+        assert raw.data[:] == data
+        assert [part.content_type for part in raw.parts] == \
+            ['text/plain', 'text/html', 'image/png', 'application/pdf']
+        assert [part.filename for part in raw.attachments] == ['', 'doc.pdf']
+        assert raw.text == 'Grüße'
+        raw.close()
+
+    def test_process_message_rebuild(self, mocker):
+        """ Test forwarding as new message. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.footer_text_template = SnippetTemplate('FOOTER {list_name}', FOOTER_FIELDS)
+        receiver.config.footer_html_template = SnippetTemplate('<p>FOOTER</p>', FOOTER_FIELDS)
+
+        self._process_post(receiver, self._get_post(), ['a@subscriber.de'])
+
+        forwarded = email.message_from_bytes(Sender._interface_smtplib.call_args.args[2])
+        assert forwarded['DKIM-Signature'] is None
+        assert forwarded['List-Id'] == '<info.360tasks.de>'
+        assert forwarded['X-Loop'] == receiver.config.sender_address
+        parts = {part.get_content_type(): part for part in forwarded.walk()}
+        text = parts['text/plain'].get_payload(decode=True).decode('utf-8')
+        assert 'FOOTER info@360tasks.de' in text
+        assert parts['application/pdf'].get_payload().strip() == 'JVBERi0xLjQKJcfsj6IK'
+
+    def test_footers_cached(self, mocker):
+        """ Test footers are rendered once per unsubscribe tag scope. """
+        receiver = self._get_receiver(mocker)
+        receiver.config.footer_text_template = SnippetTemplate('Bye {tags}', FOOTER_FIELDS)
+        render = mocker.spy(receiver.config.footer_text_template, 'render')
+
+        assert receiver._footers('#a')[0] == 'Bye #a'
+        assert receiver._footers('#a')[0] == 'Bye #a'
+        assert receiver._footers('#b')[0] == 'Bye #b'
+        assert render.call_count == 2
+
+    def test_insert_html_footer(self, mocker):
+        """ Test footer insertion before the last closing body tag. """
+        receiver = self._get_receiver(mocker)
+
+        assert receiver._insert_html_footer('<body>a</Body >x</BODY>', 'F') == \
+            '<body>a</Body >xF</BODY>'
+        assert receiver._insert_html_footer('<p>a</p>', 'F') == '<p>a</p>F'
+
+    def test_wait_idle(self, mocker):
+        """ Test waiting using IMAP IDLE. """
+        receiver = self._get_receiver(mocker)
+        mailbox = receiver._get_mailbox()
+        mailbox.client.capabilities = ('IMAP4REV1', 'IDLE')
+
+        receiver.wait(60 * 60)
+
+        mailbox.idle.wait.assert_called_once_with(timeout=29 * 60)
+        mailbox.client.noop.assert_not_called()
+
+    def test_wait_noop(self, mocker):
+        """ Test NOOP polling fallback. """
+        receiver = self._get_receiver(mocker)
+        mailbox = receiver._get_mailbox()
+        mailbox.client.capabilities = ('IMAP4REV1',)
+        mailbox.client.untagged_responses = {'EXISTS': [b'3']}
+
+        receiver.wait(60)
+
+        mailbox.idle.wait.assert_not_called()
+        mailbox.client.noop.assert_called_once()
+
+
+class FakeStreamWriter:
+    """ Replacement for asyncio.StreamWriter. """
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        """ Collect written data. """
+        self.data += data
+
+    async def drain(self):
+        """ Nothing to drain. """
+
+    def close(self):
+        """ Nothing to close. """
+
+
+class TestAsyncEngine:
+    """ Test for maillist.AsyncEngine and the async clients. """
+
+    @pytest.fixture(autouse=True)
+    def _tmp_path(self, tmp_path):
+        """ Keep the sync state in a temporary folder. """
+        self.tmp_path = tmp_path
+
+    def _get_config(self, mocker):
+        """ Get default config. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        config = Config()
+        config.maillist_file = str(self.tmp_path / 'maillist.json')
+        config.sync_file = str(self.tmp_path / 'maillist.sync.json')
+        config.dedupe = True
+        config.dedupe_file = str(self.tmp_path / 'maillist.dedupe')
+        return config
+
+    def _patch_open(self, mocker, cls, script: bytes):
+        """ Connect the client to a scripted server. """
+        writer = FakeStreamWriter()
+
+        async def open_connection(_):
+            reader = asyncio.StreamReader()
+            reader.feed_data(script)
+            reader.feed_eof()
+            return reader, writer
+
+        mocker.patch(f"maillist.{cls}._interface_open", open_connection)
+        return writer
+
+    def test_imap_fetch(self, mocker):
+        """ Test IMAP login, select and fetch with literals. """
+        config = self._get_config(mocker)
+        raw = b'From: a@example.com\r\nSubject: hello\r\n\r\n'
+        writer = self._patch_open(mocker, 'AsyncImapClient', (
+            b'* OK ready\r\n'
+            b'A0001 OK logged in\r\n'
+            b'* 2 EXISTS\r\n'
+            b'* OK [UIDVALIDITY 7] ok\r\n'
+            b'* OK [UIDNEXT 13] ok\r\n'
+            b'A0002 OK [READ-WRITE] selected\r\n'
+            b'* 1 FETCH (UID 12 FLAGS () RFC822.SIZE 100 BODY[HEADER] {%i}\r\n' % len(raw) +
+            raw + b')\r\n'
+            b'A0003 OK done\r\n'))
+
+        async def run():
+            imap = AsyncImapClient(config)
+            await imap.connect()
+            return imap, await imap.fetch(['12'], headers_only=True)
+
+        imap, messages = asyncio.run(run())
+
+        assert imap.status == {'UIDVALIDITY': 7, 'UIDNEXT': 13}
+        assert writer.data.startswith(b'A0001 LOGIN "info@360tasks.de" ')
+        assert b'A0003 UID FETCH 12 (UID FLAGS RFC822.SIZE BODY.PEEK[HEADER])\r\n' in writer.data
+        assert len(messages) == 1
+        assert messages[0].uid == '12'
+        assert messages[0].size_rfc822 == 100
+        assert messages[0].subject == 'hello'
+
+    def test_smtp_sendmail(self, mocker):
+        """ Test SMTP login and sending with dot-stuffing. """
+        config = self._get_config(mocker)
+        config.smtp_tls = False
+        writer = self._patch_open(mocker, 'AsyncSmtpClient', (
+            b'220 ready\r\n'
+            b'250-smtp.example.com\r\n'
+            b'250 SIZE 1000\r\n'
+            b'235 ok\r\n'
+            b'250 ok\r\n'
+            b'250 ok\r\n'
+            b'550 unknown\r\n'
+            b'354 go ahead\r\n'
+            b'250 queued\r\n'))
+
+        async def run():
+            smtp = AsyncSmtpClient(config)
+            await smtp.connect()
+            return await smtp.sendmail('a@example.com', ['b@example.com', 'c@example.com'],
+                                       b'Subject: x\r\n\r\n.dot\r\n')
+
+        refused = asyncio.run(run())
+
+        assert refused == {'c@example.com': (550, b'unknown')}
+        assert b'MAIL FROM:<a@example.com> SIZE=20\r\n' in writer.data
+        assert writer.data.endswith(b'DATA\r\nSubject: x\r\n\r\n..dot\r\n.\r\n')
+
+    def test_process_mails(self, mocker):
+        """ Test the fetch, process and deliver stages. """
+        config = self._get_config(mocker)
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        raw = b'From: Sender <a@example.com>\r\nSubject: hello\r\n\r\nText\r\n'
+
+        def fetch(uids, headers_only=False):
+            return [MailMessage([(b'1 FETCH (UID %s RFC822.SIZE 10 BODY[] {%i}' % (
+                uid.encode(), len(raw)), raw), b')']) for uid in uids]
+
+        imap = mocker.MagicMock()
+        imap.status = {'UIDVALIDITY': 7, 'UIDNEXT': 13}
+        imap.connect = mocker.AsyncMock()
+        imap.search = mocker.AsyncMock(return_value=['11', '12'])
+        imap.fetch = mocker.AsyncMock(side_effect=fetch)
+        imap.fetch_raw = mocker.AsyncMock(
+            side_effect=lambda uids, partial=b'': {uid: raw for uid in uids})
+        imap.mark_seen = mocker.AsyncMock()
+        imap.logout = mocker.AsyncMock()
+        smtp = mocker.MagicMock()
+        smtp.connect = mocker.AsyncMock()
+        smtp.sendmail = mocker.AsyncMock(return_value={})
+        smtp.quit = mocker.AsyncMock()
+        mocker.patch("maillist.AsyncEngine._interface_imap", return_value=imap)
+        mocker.patch("maillist.AsyncEngine._interface_smtp", return_value=smtp)
+
+        result = SubscriberCheckResult()
+        result.forward = True
+        result.receivers = ['b@example.com']
+        mocker.patch("maillist.Receiver._triage_message",
+                     side_effect=lambda msg: result if msg.uid == '12' else None)
+        engine = AsyncEngine(config, Subscribers(config, Sender(config)))
+        engine.receiver._sync_state = {'uidvalidity': 7, 'last_uid': 10, 'deferred': {}}
+
+        asyncio.run(engine.process_mails())
+
+        imap.search.assert_awaited_once_with(b'UID 11:*')
+        imap.mark_seen.assert_awaited_once_with(['11', '12'])
+        imap.fetch_raw.assert_awaited_once_with(['12'])
+        smtp.sendmail.assert_awaited_once()
+        args = smtp.sendmail.await_args.args
+        assert args[:2] == (config.sender_address, ['b@example.com'])
+        assert b'Subject: hello' in args[2]
+        smtp.quit.assert_awaited_once()
+        with open(config.sync_file, 'r', encoding='utf-8') as file:
+            assert json.load(file) == {'uidvalidity': 7, 'last_uid': 12, 'deferred': {}}
+
+
+    def test_process_mails_sqlite(self, mocker):
+        """ Test commands are handled in worker threads with the sqlite backend. """
+        config = self._get_config(mocker)
+        config.storage_backend = 'sqlite'
+        config.database_file = str(self.tmp_path / 'maillist.db')
+        mocker.patch("maillist.Sender._interface_smtplib", return_value={})
+        raw = b'From: New <new@example.com>\r\nSubject: $>subscribe\r\n\r\n'
+
+        def fetch(uids, headers_only=False):
+            return [MailMessage([(b'1 FETCH (UID %s RFC822.SIZE 10 BODY[] {%i}' % (
+                uid.encode(), len(raw)), raw), b')']) for uid in uids]
+
+        imap = mocker.MagicMock()
+        imap.status = {'UIDVALIDITY': 7, 'UIDNEXT': 12}
+        imap.connect = mocker.AsyncMock()
+        imap.search = mocker.AsyncMock(return_value=['11'])
+        imap.fetch = mocker.AsyncMock(side_effect=fetch)
+        imap.mark_seen = mocker.AsyncMock()
+        imap.logout = mocker.AsyncMock()
+        mocker.patch("maillist.AsyncEngine._interface_imap", return_value=imap)
+        mocker.patch("maillist.AsyncEngine._interface_smtp")
+        subscribers = Subscribers(config, Sender(config))
+        engine = AsyncEngine(config, subscribers)
+        engine.receiver._sync_state = {'uidvalidity': 7, 'last_uid': 10, 'deferred': {}}
+
+        asyncio.run(engine.process_mails())
+
+        assert subscribers._storage.receivers(['subscribers']) == ['new@example.com']
+        Sender._interface_smtplib.assert_called_once()
+
+    def _get_deliver_engine(self, mocker, sendmail):
+        """ Get an engine with a mocked SMTP client for the deliver stage. """
+        config = self._get_config(mocker)
+        smtp = mocker.MagicMock()
+        smtp.connect = mocker.AsyncMock()
+        smtp.sendmail = mocker.AsyncMock(side_effect=sendmail)
+        smtp.quit = mocker.AsyncMock()
+        mocker.patch("maillist.AsyncEngine._interface_smtp", return_value=smtp)
+        engine = AsyncEngine(config, Subscribers(config, Sender(config)))
+        engine.delivery_backoff = 0
+        return engine, smtp
+
+    def _run_deliveries(self, engine, items: list):
+        """ Run one deliver worker for the given queue items. """
+
+        async def run():
+            engine._deliveries = asyncio.Queue()
+            for item in items:
+                engine._deliveries.put_nowait(item)
+            worker = asyncio.create_task(engine._deliver())
+            await asyncio.wait_for(engine._deliveries.join(), 5)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+        asyncio.run(run())
+
+    def test_deliver_retry(self, mocker):
+        """ Test temporary failures are retried with a new connection. """
+        engine, smtp = self._get_deliver_engine(
+            mocker, [OSError('reset'), smtplib.SMTPDataError(451, b'later'), {}])
+
+        self._run_deliveries(engine, [('a@example.com', ['b@example.com'], b'data', None)])
+
+        assert smtp.sendmail.await_count == 3
+        assert smtp.connect.await_count == 3
+
+    def test_deliver_error(self, mocker):
+        """ Test the worker keeps running after unexpected and permanent errors. """
+        engine, smtp = self._get_deliver_engine(
+            mocker, [RuntimeError('bug')] * AsyncEngine.delivery_attempts +
+            [smtplib.SMTPDataError(554, b'rejected'), {}])
+
+        self._run_deliveries(engine, [('a@example.com', ['b@example.com'], b'first', None),
+                                      ('a@example.com', ['c@example.com'], b'second', None),
+                                      ('a@example.com', ['d@example.com'], b'third', None)])
+
+        messages = [call.args[2] for call in smtp.sendmail.await_args_list]
+        assert messages == [b'first'] * AsyncEngine.delivery_attempts + [b'second', b'third']
+
+
+    def test_deliver_dedupe(self, mocker):
+        """ Test posts are remembered for dedupe only when they were delivered. """
+        engine, _ = self._get_deliver_engine(
+            mocker, [smtplib.SMTPDataError(554, b'rejected'), {}])
+        failed = PostDelivery(b'a' * 16)
+        sent = PostDelivery(b'b' * 16)
+
+        self._run_deliveries(engine, [('a@example.com', ['b@example.com'], b'first', failed),
+                                      ('a@example.com', ['c@example.com'], b'second', sent)])
+
+        assert failed.failed
+        assert engine._delivered == [b'b' * 16]
+        asyncio.run(engine._flush_dedupe())
+        assert not engine.receiver.dedupe.seen(b'a' * 16)
+        assert engine.receiver.dedupe.seen(b'b' * 16)
+
+
+class TestListHost:
+    """ Test for maillist.ListHost. """
+
+    def _get_config(self, mocker, tmp_path, names):
+        """ Get config for hosting the given lists. """
+        for name in names:
+            os.makedirs(tmp_path / name)
+            (tmp_path / name / 'config').write_text('', encoding='utf-8')
+            (tmp_path / name / '.env').write_text(f'smtp_password = {name}-secret\n',
+                                                  encoding='utf-8')
+        args = ArgsDummy()
+        args.lists = str(tmp_path)
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse", return_value=args)
+        mocker.patch.dict(os.environ)
+        os.environ.pop('smtp_password', None)
+        return Config()
+
+    def test_for_list(self, mocker, tmp_path):
+        """ Test the config of a hosted list. """
+        config = self._get_config(mocker, tmp_path, ['one', 'two'])
+
+        one = config.for_list(str(tmp_path / 'one'))
+        two = config.for_list(str(tmp_path / 'two'))
+
+        assert one.maillist_file == str(tmp_path / 'one' / 'maillist.json')
+        assert one.sync_file == str(tmp_path / 'one' / 'maillist.sync.json')
+        assert one.smtp_password == 'one-secret'
+        assert two.smtp_password == 'two-secret'
+        assert two.sender_address == 'info@360tasks.de'
+
+    def test_for_list_outbox(self, mocker, tmp_path):
+        """ Test each hosted list uses an own outbox. """
+        config = self._get_config(mocker, tmp_path, ['one', 'two'])
+        Config._interface_configparser.return_value = dict(TestConfig.config, outbox={})
+
+        one = config.for_list(str(tmp_path / 'one'))
+        two = config.for_list(str(tmp_path / 'two'))
+
+        assert one.outbox_path == str(tmp_path / 'one' / 'data' / 'outbox')
+        assert two.outbox_path == str(tmp_path / 'two' / 'data' / 'outbox')
+
+    def test_shared_pools(self, mocker, tmp_path):
+        """ Test lists with the same credentials share the SMTP pool. """
+        config = self._get_config(mocker, tmp_path, ['a', 'b', 'c'])
+        (tmp_path / 'c' / '.env').write_text('smtp_password = a-secret\n', encoding='utf-8')
+
+        host = ListHost(config, list_names(config.lists_path))
+
+        assert list(host.lists.keys()) == ['a', 'b', 'c']
+        assert len(host.pools) == 2
+        assert host.lists['a'].sender.pool is host.lists['c'].sender.pool
+        assert host.lists['a'].receiver.mailboxes is host.mailboxes
+        assert all(maillist.sender._executor is host.executor
+                   for maillist in host.lists.values())
+
+        host.close()
+
+        # the shared workers are shut down once, by the host
+        assert host.executor._shutdown
+
+    def test_shared_pools_asyncio(self, mocker, tmp_path):
+        """ Test the asyncio engines use the shared SMTP pool and workers. """
+        config = self._get_config(mocker, tmp_path, ['a', 'b'])
+        config.use_asyncio = True
+
+        host = ListHost(config, list_names(config.lists_path))
+
+        for maillist in host.lists.values():
+            assert maillist.engine.sender.pool is maillist.sender.pool
+            assert maillist.engine.sender._executor is host.executor
+            assert maillist.engine.receiver is maillist.receiver
+            assert maillist.receiver.sender is maillist.engine.sender
+
+    def test_idle_rejected(self, mocker, tmp_path):
+        """ Test IMAP IDLE is rejected for hosted lists. """
+        config = self._get_config(mocker, tmp_path, ['a'])
+        config.idle = True
+
+        with pytest.raises(AssertionError):
+            ListHost(config, list_names(config.lists_path))
+
+    def test_process_mails_error(self, mocker, tmp_path):
+        """ Test an error of one list doesn't stop the other lists. """
+        config = self._get_config(mocker, tmp_path, ['a', 'b'])
+        host = ListHost(config, ['a', 'b'])
+        mocker.patch("maillist.Maillist.process_mails",
+                     side_effect=[imaplib.IMAP4.error('failed'), CycleResult(3, 1)])
+
+        result = host.process_mails()
+
+        assert Maillist.process_mails.call_count == 2
+        assert (result.processed, result.remaining) == (3, 1)
+        assert host.scheduler.delay == 0
+
+    def test_mailbox_pool(self, mocker, tmp_path):
+        """ Test mailbox sessions are shared and select the folder of the list. """
+        config = self._get_config(mocker, tmp_path, ['a', 'b'])
+        pool = MailboxPool()
+        mocker.patch("maillist.MailboxPool._interface_imap",
+                     side_effect=lambda config: mocker.MagicMock())
+        one = config.for_list(str(tmp_path / 'a'))
+        two = config.for_list(str(tmp_path / 'b'))
+        two.mailbox_folder = 'lists/b'
+
+        mailbox = pool.get(one)
+        assert pool.get(two) is mailbox
+        assert pool.get(two) is mailbox
+
+        assert [call.args for call in mailbox.folder.set.call_args_list] == \
+            [('INBOX',), ('lists/b',)]
+        MailboxPool._interface_imap.assert_called_once()
+
+    def test_host_lists_processes(self, mocker, tmp_path):
+        """ Test sharding of the lists across processes. """
+        config = self._get_config(mocker, tmp_path, ['a', 'b', 'c'])
+        config.processes = 2
+        process = mocker.patch("multiprocessing.Process")
+
+        host_lists(config)
+
+        shards = [call.kwargs['args'][1] for call in process.call_args_list]
+        assert shards == [['a', 'c'], ['b']]
+        assert process.return_value.join.call_count == 2
+
+
+class TestMetrics:
+    """ Test for maillist.Metrics and maillist.MetricsExporter. """
+
+    def test_prometheus(self):
+        """ Test the Prometheus text format. """
+        metrics = Metrics()
+        metrics.observe('fetch', 0.003)
+        metrics.observe('fetch', 2.0)
+        metrics.inc('messages_in', 2)
+        metrics.set('backlog', 5, stage='mailbox')
+        metrics.register('key', 'subscribers',
+                         lambda: [({'list': 'a "list"', 'scope': 'subscribers'}, 3)])
+
+        text = metrics.prometheus()
+
+        assert 'maillist_stage_seconds_bucket{stage="fetch",le="0.001"} 0\n' in text
+        assert 'maillist_stage_seconds_bucket{stage="fetch",le="0.005"} 1\n' in text
+        assert 'maillist_stage_seconds_bucket{stage="fetch",le="+Inf"} 2\n' in text
+        assert 'maillist_stage_seconds_sum{stage="fetch"} 2.003\n' in text
+        assert 'maillist_messages_in_total 2\n' in text
+        assert 'maillist_backlog{stage="mailbox"} 5\n' in text
+        assert 'maillist_subscribers{list="a \\"list\\"",scope="subscribers"} 3\n' in text
+
+    def test_callback_error(self):
+        """ Test that a failing gauge callback is skipped. """
+        metrics = Metrics()
+        metrics.register('key', 'backlog', lambda: 1 / 0)
+        metrics.set('backlog', 1, stage='mailbox')
+
+        assert metrics.snapshot()['gauges'] == [
+            {'name': 'backlog', 'labels': {'stage': 'mailbox'}, 'value': 1}]
+
+    def _get_config(self, mocker):
+        """ Get default config object. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        return Config()
+
+    def test_exporter_dump(self, mocker, tmp_path):
+        """ Test the final JSON dump. """
+        mocker.patch("maillist.METRICS", Metrics())
+        maillist.METRICS.inc('posts_forwarded')
+        config = self._get_config(mocker)
+        config.metrics_dump = str(tmp_path / 'metrics.json')
+        config.metrics_dump_interval = 3600
+
+        exporter = MetricsExporter(config)
+        exporter.start()
+        exporter.stop()
+
+        with open(config.metrics_dump, 'r', encoding='utf-8') as file:
+            assert json.load(file)['counters'] == {'posts_forwarded': 1}
+
+    def test_exporter_http(self, mocker):
+        """ Test the /metrics endpoint. """
+        mocker.patch("maillist.METRICS", Metrics())
+        maillist.METRICS.inc('posts_forwarded')
+        config = self._get_config(mocker)
+        config.metrics_port = 9100
+        server = mocker.patch("maillist.MetricsExporter._interface_server",
+                              side_effect=lambda address: maillist.http.server.ThreadingHTTPServer(
+                                  ('127.0.0.1', 0), maillist.MetricsHandler))
+
+        exporter = MetricsExporter(config, port_offset=2)
+        exporter.start()
+        try:
+            server.assert_called_once_with(('127.0.0.1', 9102))
+            port = exporter._server.server_address[1]  # pylint: disable=protected-access
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+                assert b'maillist_posts_forwarded_total 1\n' in response.read()
+        finally:
+            exporter.stop()
+
+
+class TestCycleProfiler:
+    """ Test for maillist.CycleProfiler. """
+
+    def _get_profiler(self, mocker, tmp_path, mode='cprofile', threshold=0.0):
+        """ Get an enabled profiler writing to tmp_path. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        config = Config()
+        config.profile = True
+        config.profile_mode = mode
+        config.profile_path = str(tmp_path)
+        config.profile_threshold = threshold
+        config.profile_keep = 2
+        config.profile_interval = 1
+        return CycleProfiler(config)
+
+    def _busy(self, seconds):
+        """ Keep the CPU busy. """
+        end = maillist.monotonic() + seconds
+        while maillist.monotonic() < end:
+            pass
+
+    def test_cprofile_rotation(self, mocker, tmp_path):
+        """ Test that cycles are written as .prof files and rotated. """
+        profiler = self._get_profiler(mocker, tmp_path)
+
+        for i in range(3):
+            with profiler.cycle(f'list {i}@example.com'):
+                self._busy(0.01)
+            [path] = [os.path.join(tmp_path, name) for name in os.listdir(tmp_path)
+                      if f'-list_{i}_example.com-' in name]
+            os.utime(path, (i, i))
+
+        names = sorted(os.listdir(tmp_path))
+        assert len(names) == 2
+        assert all(name.endswith('.prof') for name in names)
+        assert 'list_0' not in ''.join(names)
+
+    def test_threshold(self, mocker, tmp_path):
+        """ Test that fast cycles are not written. """
+        profiler = self._get_profiler(mocker, tmp_path, threshold=60.0)
+
+        with profiler.cycle('list'):
+            pass
+
+        assert os.listdir(tmp_path) == []
+
+    def test_sample(self, mocker, tmp_path):
+        """ Test the collapsed stacks of the sampler. """
+        profiler = self._get_profiler(mocker, tmp_path, mode='sample')
+
+        with profiler.cycle('list'):
+            self._busy(0.1)
+
+        [name] = os.listdir(tmp_path)
+        assert name.endswith('.collapsed')
+        with open(os.path.join(tmp_path, name), 'r', encoding='utf-8') as file:
+            stacks = file.read()
+        assert 'MainThread;' in stacks
+        assert ';_busy (maillist_test.py:' in stacks
+
+    def test_toggle(self, mocker, tmp_path):
+        """ Test toggling the profiler at runtime. """
+        profiler = self._get_profiler(mocker, tmp_path)
+        profiler.toggle()
+
+        with profiler.cycle('list'):
+            pass
+
+        assert not profiler.enabled
+        assert os.listdir(tmp_path) == []
+
+
+class TestScheduler:
+    """ Test for maillist.Scheduler. """
+
+    def _get_scheduler(self, mocker):
+        """ Get scheduler with 60 seconds sleep time. """
+        mocker.patch("maillist.Config._interface_configparser",
+                     return_value=TestConfig.config)
+        mocker.patch("maillist.Config._interface_argparse",
+                     return_value=ArgsDummy())
+        config = Config()
+        config.schedule_active_sleep = 5
+        config.schedule_max_sleep = 300
+        config.schedule_backoff = 2.0
+        return Scheduler(config)
+
+    def test_backlog(self, mocker):
+        """ Test the next cycle starts immediately while mails are left. """
+        scheduler = self._get_scheduler(mocker)
+
+        assert scheduler.update(CycleResult(100, 20), 1.5) == 0
+
+    def test_active(self, mocker):
+        """ Test the shorter period after activity, minus the cycle duration. """
+        scheduler = self._get_scheduler(mocker)
+
+        assert scheduler.update(CycleResult(3, 0), 1.5) == 3.5
+        assert scheduler.update(CycleResult(3, 0), 7.0) == 0
+
+    def test_idle_backoff(self, mocker):
+        """ Test the exponential backoff of idle cycles, up to the ceiling. """
+        scheduler = self._get_scheduler(mocker)
+
+        delays = [scheduler.update(CycleResult(), 0) for _ in range(5)]
+        assert delays == [60, 120, 240, 300, 300]
+
+        scheduler.update(CycleResult(1, 0), 0)
+        assert scheduler.update(CycleResult(), 0) == 60
+
+    def test_idle_default(self, mocker):
+        """ Test idle cycles keep the sleep time without a configured backoff. """
+        scheduler = self._get_scheduler(mocker)
+        scheduler.config.schedule_backoff = Config().schedule_backoff
+
+        delays = [scheduler.update(CycleResult(), 0) for _ in range(5)]
+        assert delays == [60] * 5
+
 
 class TestMaillist:
     """ Test for maillist.Maillist. """